@@ -1,20 +1,23 @@
 import asyncio
 import logging
 import os
+import secrets
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
 from dotenv import load_dotenv
 from aiohttp import web  # <-- Добавляем веб-сервер
 
 # Импорты ваших модулей
 from database import init_db
-from middlewares import BotMiddleware
-from handlers.start import start_router
-from handlers.checkin import checkin_router
-from handlers.profile import profile_router
-from handlers.spots import spots_router
-from handlers.weather import weather_router
+from dispatcher import build_dispatcher
 from scheduler import start_scheduler
+from keyboards import start_menu_watcher
+from services.occupancy import start_occupancy_watcher
+from notifications import setup_notifications
+from services.loop_monitor import start_loop_monitor
+from services.metrics import render_metrics
+from services import offload
+from workers import Supervisor
 
 # Настройки
 load_dotenv()
@@ -23,33 +26,103 @@ if not TOKEN:
     raise ValueError("BOT_TOKEN не найден! Проверь .env файл.")
 logging.basicConfig(level=logging.INFO)
 
+# Режим вебхука включается, если задан внешний адрес (например, https://bot.example.com/webhook)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Для нескольких реплик за балансировщиком секрет должен быть общим и задаваться явно
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    WEBHOOK_SECRET = secrets.token_urlsafe(32)
+    logging.warning("WEBHOOK_SECRET не задан, сгенерирован случайный секрет для этого процесса")
+
+# Число процессов-воркеров; при значении больше 1 этот процесс становится супервизором
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+
 # Создаем веб-приложение для healthcheck
 async def healthcheck(request):
     return web.Response(text="OK")
 
+# Метрики (задержка цикла событий, зависания и т.д.) в формате Prometheus
+async def metrics(request):
+    return web.Response(text=render_metrics())
+
 app = web.Application()
 app.router.add_get("/health", healthcheck)
+app.router.add_get("/metrics", metrics)
 
-# Инициализация бота
-bot = Bot(token=TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(bot=bot, storage=storage)
-dp.message.middleware(BotMiddleware(bot))
-dp.callback_query.middleware(BotMiddleware(bot))
+async def start_webhook(bot: Bot, dp: Dispatcher) -> bool:
+    """Регистрирует вебхук в Telegram. Возвращает False, если нужно откатиться на polling."""
+    try:
+        await bot.set_webhook(
+            url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+            drop_pending_updates=False
+        )
+        logging.info(f"Вебхук установлен: {WEBHOOK_URL}")
+        return True
+    except Exception as e:
+        logging.error(f"Не удалось установить вебхук, переключаемся на polling: {e}")
+        return False
+
+async def run_supervisor(bot: Bot, dp: Dispatcher):
+    """Режим нескольких процессов: супервизор принимает обновления и раздаёт их воркерам."""
+    supervisor = Supervisor(bot, BOT_WORKERS, dp.resolve_used_update_types())
+    if WEBHOOK_URL:
+        app.router.add_post(WEBHOOK_PATH, supervisor.webhook_handler(WEBHOOK_SECRET))
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, port=30000)
+    await site.start()
 
-# Подключаем роутеры
-dp.include_router(start_router)
-dp.include_router(checkin_router)
-dp.include_router(profile_router)
-dp.include_router(spots_router)
-dp.include_router(weather_router)
+    supervisor.start()
+    watcher = asyncio.create_task(supervisor.watch())
+    logging.info(f"Супервизор запущен, воркеров: {BOT_WORKERS}")
+    try:
+        if WEBHOOK_URL and await start_webhook(bot, dp):
+            await asyncio.Event().wait()
+        else:
+            await supervisor.poll()
+    finally:
+        watcher.cancel()
+        await supervisor.stop()
+        offload.shutdown()
 
 async def main():
+    # Следим за задержками цикла событий
+    start_loop_monitor()
+
     # Инициализация БД
     await init_db()
+
+    # Bot и Dispatcher создаются здесь, а не при импорте: воркеры, запущенные
+    # через spawn, заново выполняют этот файл и строят собственный диспетчер
+    bot, dp = build_dispatcher(TOKEN)
+
+    if BOT_WORKERS > 1:
+        await run_supervisor(bot, dp)
+        return
+
+    # Обработчик вебхука монтируется на то же приложение, что и /health.
+    # Telegram получает ответ сразу, а обновление обрабатывается фоновой задачей.
+    # В режиме воркеров вебхук принимает супервизор (см. run_supervisor).
+    if WEBHOOK_URL:
+        SimpleRequestHandler(
+            dispatcher=dp,
+            bot=bot,
+            secret_token=WEBHOOK_SECRET,
+            handle_in_background=True
+        ).register(app, path=WEBHOOK_PATH)
     
+    # Уведомления пользователей о событиях чек-инов
+    setup_notifications(bot)
     # Запуск планировщика
-    start_scheduler(bot=bot)
+    start_scheduler()
+    # Сброс кеша главного меню при изменении каталога спотов
+    start_menu_watcher()
+    # Занятость спотов в памяти и её сверка с БД
+    start_occupancy_watcher()
     
     # Создаем фоновую задачу для веб-сервера
     runner = web.AppRunner(app)
@@ -59,7 +132,16 @@ async def main():
     
     # Запускаем бота
     logging.info("Бот и веб-сервер запущены")
-    await dp.start_polling(bot)
+    try:
+        if WEBHOOK_URL and await start_webhook(bot, dp):
+            # Обновления приходят через веб-сервер, просто держим процесс
+            await asyncio.Event().wait()
+        else:
+            # Polling не работает при установленном вебхуке
+            await bot.delete_webhook(drop_pending_updates=False)
+            await dp.start_polling(bot)
+    finally:
+        offload.shutdown()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
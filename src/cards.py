@@ -0,0 +1,180 @@
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from database import get_users
+from rows import Spot, Visitor
+from services import epoch
+from services.metrics import counter, gauge
+from services.occupancy import occupancy
+from services.rollups import busy_hours
+from services.weather import wind_direction_to_text
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Сколько карточек спотов держим в памяти процесса
+CARD_CACHE_SIZE = int(os.getenv("CARD_CACHE_SIZE", "1024"))
+# Страховочный срок жизни карточки (сек), даже если версия спота не менялась
+CARD_TTL = float(os.getenv("CARD_TTL", "600"))
+
+card_hits = counter("card_cache_hits_total", "Карточки спотов, взятые из кеша")
+card_misses = counter("card_cache_misses_total", "Карточки спотов, собранные заново")
+card_size = gauge("card_cache_size", "Карточек спотов в кеше")
+
+# Прогноз ещё загружается (None означает «данные недоступны»)
+PENDING = object()
+
+
+def format_arrivals(arriving_users: list, user_timezone) -> str:
+    """Список приезжающих с временем прибытия в поясе зрителя."""
+    if not arriving_users:
+        return "нет"
+    arriving_info_list = []
+    for user in arriving_users:
+        local_time = epoch.to_datetime(user.arrival_time, user_timezone)
+        arriving_info_list.append(f"{user.first_name} ({local_time.strftime('%H:%M')})")
+    return ", ".join(arriving_info_list)
+
+
+def format_forecast(wind_data) -> str:
+    """Строки ветра и воды: для загружающегося прогноза — заглушки, для None — «недоступны»."""
+    if wind_data is PENDING:
+        return "🌬 *Ветер:* ⏳ загружается...\n🌡 *Вода:* ⏳ загружается...\n"
+    wind_info = "🌬 *Ветер:* Данные недоступны."
+    water_info = "🌡 *Вода:* Данные недоступны."
+    if wind_data:
+        wind_speed = wind_data["speed"]
+        wind_direction = wind_data["direction"]
+        wind_gusts = wind_data.get("gusts")
+        direction_text = wind_direction_to_text(wind_direction)
+        wind_info = f"🌬 *Ветер:* {wind_speed:.1f} м/с, {direction_text} ({wind_direction:.0f}°)"
+        if wind_gusts is not None:
+            wind_info += f", порывы до {wind_gusts:.1f} м/с"
+        if wind_data.get("water_temperature") is not None:
+            water_info = f"🌡 *Вода:* {wind_data['water_temperature']:.1f} °C"
+    return f"{wind_info}\n{water_info}\n"
+
+
+class SpotCard:
+    """
+    Занятость спота на момент версии version и готовые фрагменты текста.
+
+    Строки «На месте» и «Приедут» зависят только от данных спота и пояса
+    зрителя, поэтому кешируются по названию пояса.
+    """
+    __slots__ = ("spot_id", "version", "loaded_at", "on_spot_count", "on_spot_users", "arriving_users", "_fragments")
+
+    def __init__(self, spot_id: int, version: int, occupancy: tuple):
+        self.spot_id = spot_id
+        self.version = version
+        self.loaded_at = time.monotonic()
+        self.on_spot_count, self.on_spot_users, self.arriving_users = occupancy
+        self._fragments = {}
+
+    @property
+    def active(self) -> bool:
+        """Есть ли на споте кто-то на месте или в пути."""
+        return self.on_spot_count > 0 or bool(self.arriving_users)
+
+    @property
+    def occupancy(self) -> tuple:
+        """Данные в формате get_checkins_for_spot."""
+        return self.on_spot_count, self.on_spot_users, self.arriving_users
+
+    def occupancy_text(self, user_timezone) -> str:
+        key = getattr(user_timezone, "zone", str(user_timezone))
+        text = self._fragments.get(key)
+        if text is None:
+            on_spot_names = ", ".join(user.first_name for user in self.on_spot_users) if self.on_spot_users else "никого"
+            text = (
+                f"👥 *На месте:* {self.on_spot_count} чел. ({on_spot_names})\n"
+                f"⏳ *Приедут:* {len(self.arriving_users)} чел. ({format_arrivals(self.arriving_users, user_timezone)})\n"
+            )
+            self._fragments[key] = text
+        return text
+
+
+class CardCache:
+    """
+    Кеш карточек спотов: (спот, версия) -> SpotCard, внутри — фрагменты по поясу зрителя.
+
+    Занятость и версии спотов берутся из модели занятости в памяти
+    (services.occupancy): версия спота меняется только при изменении его
+    активных чек-инов, поэтому проверка свежести не обращается к БД. Имена
+    посетителей берутся из кеша пользователей, смена имени видна после CARD_TTL.
+    Прогнозы приходят отдельно (экран рисуется постепенно), их строки
+    запоминаются по значениям прогноза: обновлённый прогноз даёт новый фрагмент.
+    """
+
+    def __init__(self, size: int = CARD_CACHE_SIZE, ttl: float = CARD_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._cards: "OrderedDict[int, SpotCard]" = OrderedDict()
+        self._forecasts = {}
+
+    async def get_many(self, spot_ids: list) -> dict:
+        """Карточки спотов {spot_id: SpotCard}; устаревшие собираются заново по модели занятости."""
+        checkins = await occupancy.spot_checkins(spot_ids)
+        await busy_hours.load(spot_ids)
+        now = time.monotonic()
+        result = {}
+        stale = []
+        for spot_id in spot_ids:
+            card = self._cards.get(spot_id)
+            if card is not None and card.version == checkins[spot_id][0] and now - card.loaded_at < self.ttl:
+                self._cards.move_to_end(spot_id)
+                result[spot_id] = card
+            else:
+                stale.append(spot_id)
+        card_hits.inc(len(result))
+
+        if stale:
+            card_misses.inc(len(stale))
+            # Имена всех посетителей устаревших карточек — одним обращением к кешу пользователей
+            users = await get_users(list({user_id for spot_id in stale for user_id, _, _ in checkins[spot_id][1]}))
+            for spot_id in stale:
+                version, entries = checkins[spot_id]
+                on_spot, arriving = [], []
+                for user_id, checkin_type, arrival_time in entries:
+                    user = users.get(user_id)
+                    first_name = user.first_name if user else str(user_id)
+                    if checkin_type == 1:
+                        on_spot.append(Visitor(first_name))
+                    else:
+                        arriving.append(Visitor(first_name, arrival_time))
+                card = SpotCard(spot_id, version, (len(on_spot), on_spot, arriving))
+                self._cards[spot_id] = card
+                self._cards.move_to_end(spot_id)
+                result[spot_id] = card
+            while len(self._cards) > self.size:
+                evicted, _ = self._cards.popitem(last=False)
+                self._forecasts.pop(evicted, None)
+            card_size.set(len(self._cards))
+        return result
+
+    def forecast_text(self, spot_id: int, wind_data) -> str:
+        """Строки ветра и воды для спота; пересчитываются только при новом прогнозе."""
+        if not wind_data or wind_data is PENDING:
+            return format_forecast(wind_data)
+        key = (wind_data["speed"], wind_data["direction"], wind_data.get("gusts"), wind_data.get("water_temperature"))
+        cached = self._forecasts.get(spot_id)
+        if cached is None or cached[0] != key:
+            cached = (key, format_forecast(wind_data))
+            self._forecasts[spot_id] = cached
+        return cached[1]
+
+
+cards = CardCache()
+
+
+def render_card(spot: Spot, distance: float, card: SpotCard, wind_data, user_timezone) -> str:
+    """Карточка для конкретного зрителя: кешированные фрагменты плюс его расстояние."""
+    return (
+        f"🏄‍♂️ **{spot.name}**\n"
+        f"📍 *Расстояние:* {distance:.2f} км\n"
+        f"{cards.forecast_text(spot.id, wind_data)}"
+        f"{card.occupancy_text(user_timezone)}"
+        f"{busy_hours.hint(spot.id, user_timezone)}\n"
+    )
@@ -1,21 +1,428 @@
 import aiosqlite
+import asyncio
 import logging
 import os
-import pytz
-from datetime import datetime, timedelta
+import sys
+import time
+from array import array
+from collections import OrderedDict
+from datetime import datetime
 from dateutil import parser
 from aiogram import Bot
+from rows import Spot, RankedSpot, Checkin, Visitor, UserStats, SpotColumns, row_factory
+from services import epoch
+from services.events import bus, CheckinCreated, Arrived, Left, Expired, ArrivalOverdue, CheckinRemoved, SpotChanged
+from services.metrics import counter, gauge
+from services.timezones import get_tz
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 DB_PATH = "data/database.db"
 
+user_cache_hits = counter("user_cache_hits_total", "Профили пользователей, взятые из кеша")
+user_cache_misses = counter("user_cache_misses_total", "Профили пользователей, прочитанные из БД")
+user_cache_size = gauge("user_cache_size", "Профилей пользователей в кеше")
+
+# Таблицы, изменения которых отслеживаются счётчиками поколений
+TRACKED_TABLES = ("users", "spots", "checkins", "favorite_spots")
+# Общий счётчик, увеличивается при изменении любой отслеживаемой таблицы
+ALL_TABLES = "*"
+
+def _change_tracking_script() -> str:
+    """
+    SQL для счётчиков поколений: триггеры увеличивают счётчик таблицы и общий
+    счётчик в той же транзакции, что и сама запись, поэтому учитываются все
+    писатели (включая прямые запросы из обработчиков и планировщика).
+    """
+    script = "".join(
+        f"INSERT OR IGNORE INTO change_counters (table_name, generation) VALUES ('{name}', 0);\n"
+        for name in TRACKED_TABLES + (ALL_TABLES,)
+    )
+    for table in TRACKED_TABLES:
+        for action in ("INSERT", "UPDATE", "DELETE"):
+            script += f'''
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_{action.lower()}_generation
+                AFTER {action} ON {table}
+                BEGIN
+                    UPDATE change_counters SET generation = generation + 1
+                    WHERE table_name IN ('{table}', '{ALL_TABLES}');
+                END;
+            '''
+    return script
+
+# Версии спотов для кеша карточек: любая запись в checkins по споту (а также смена имени
+# пользователя с активным чек-ином) увеличивает версию спота в той же транзакции
+SPOT_VERSION_TRIGGERS = '''
+    CREATE TRIGGER IF NOT EXISTS trg_checkins_insert_spot_version
+    AFTER INSERT ON checkins
+    BEGIN
+        INSERT INTO spot_versions (spot_id, version) VALUES (NEW.spot_id, 1)
+        ON CONFLICT(spot_id) DO UPDATE SET version = version + 1;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_checkins_update_spot_version
+    AFTER UPDATE ON checkins
+    BEGIN
+        INSERT INTO spot_versions (spot_id, version) VALUES (NEW.spot_id, 1)
+        ON CONFLICT(spot_id) DO UPDATE SET version = version + 1;
+        UPDATE spot_versions SET version = version + 1
+        WHERE spot_id = OLD.spot_id AND OLD.spot_id != NEW.spot_id;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_checkins_delete_spot_version
+    AFTER DELETE ON checkins
+    BEGIN
+        INSERT INTO spot_versions (spot_id, version) VALUES (OLD.spot_id, 1)
+        ON CONFLICT(spot_id) DO UPDATE SET version = version + 1;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_users_insert_spot_version
+    AFTER INSERT ON users
+    BEGIN
+        UPDATE spot_versions SET version = version + 1
+        WHERE spot_id IN (SELECT spot_id FROM checkins WHERE user_id = NEW.user_id AND active = 1);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_users_update_spot_version
+    AFTER UPDATE OF first_name ON users
+    BEGIN
+        UPDATE spot_versions SET version = version + 1
+        WHERE spot_id IN (SELECT spot_id FROM checkins WHERE user_id = NEW.user_id AND active = 1);
+    END;
+'''
+
+# Агрегаты для профиля: счётчики пользователя и его спотов обновляются триггерами
+# в той же транзакции, что и запись чек-ина (создание, подтверждение, выход, истечение,
+# удаление), поэтому профиль читает одну строку вместо всей истории чек-инов.
+# Первая/последняя сессия и любимый спот пересчитываются поиском по индексам
+# (история — в checkins и в архиве checkins_archive).
+_USER_STATS_REFRESH = '''
+        UPDATE user_stats SET
+            first_session = (SELECT MIN(moment) FROM (
+                SELECT MIN(timestamp) AS moment FROM checkins WHERE user_id = {user}
+                UNION ALL
+                SELECT MIN(timestamp) FROM checkins_archive WHERE user_id = {user}
+            )),
+            last_session = (SELECT MAX(moment) FROM (
+                SELECT MAX(timestamp) AS moment FROM checkins WHERE user_id = {user}
+                UNION ALL
+                SELECT MAX(timestamp) FROM checkins_archive WHERE user_id = {user}
+            )),
+            favorite_spot_id = (
+                SELECT spot_id FROM user_spot_stats
+                WHERE user_id = {user} AND checkins > 0
+                ORDER BY checkins DESC, total_hours DESC, spot_id
+                LIMIT 1
+            )
+        WHERE user_id = {user};
+'''
+
+_USER_STATS_ADD = '''
+        INSERT INTO user_spot_stats (user_id, spot_id, checkins, total_hours)
+        VALUES (NEW.user_id, NEW.spot_id, 1, COALESCE(NEW.duration_hours, 0))
+        ON CONFLICT(user_id, spot_id) DO UPDATE SET
+            checkins = checkins + 1, total_hours = total_hours + excluded.total_hours;
+        INSERT INTO user_stats (user_id, checkins, total_hours)
+        VALUES (NEW.user_id, 1, COALESCE(NEW.duration_hours, 0))
+        ON CONFLICT(user_id) DO UPDATE SET
+            checkins = checkins + 1, total_hours = total_hours + excluded.total_hours;
+'''
+
+_USER_STATS_REMOVE = '''
+        UPDATE user_spot_stats SET
+            checkins = checkins - 1, total_hours = total_hours - COALESCE(OLD.duration_hours, 0)
+        WHERE user_id = OLD.user_id AND spot_id = OLD.spot_id;
+        DELETE FROM user_spot_stats
+        WHERE user_id = OLD.user_id AND spot_id = OLD.spot_id AND checkins <= 0;
+        UPDATE user_stats SET
+            checkins = checkins - 1, total_hours = total_hours - COALESCE(OLD.duration_hours, 0)
+        WHERE user_id = OLD.user_id;
+'''
+
+# Триггеры пересоздаются при каждом запуске: их определение менялось вместе со схемой.
+# Перенос чек-ина в архив (удаление строки, уже вставленной в checkins_archive)
+# агрегаты не меняет, удаление из архива — вычитает.
+USER_STATS_TRIGGERS = f'''
+    CREATE INDEX IF NOT EXISTS idx_checkins_user_timestamp ON checkins(user_id, timestamp);
+
+    DROP TRIGGER IF EXISTS trg_checkins_insert_user_stats;
+    DROP TRIGGER IF EXISTS trg_checkins_update_user_stats;
+    DROP TRIGGER IF EXISTS trg_checkins_delete_user_stats;
+
+    CREATE TRIGGER IF NOT EXISTS trg_checkins_insert_user_stats
+    AFTER INSERT ON checkins
+    BEGIN
+        {_USER_STATS_ADD}
+        {_USER_STATS_REFRESH.format(user="NEW.user_id")}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_checkins_update_user_stats
+    AFTER UPDATE OF user_id, spot_id, timestamp, duration_hours ON checkins
+    BEGIN
+        {_USER_STATS_REMOVE}
+        {_USER_STATS_ADD}
+        {_USER_STATS_REFRESH.format(user="OLD.user_id")}
+        {_USER_STATS_REFRESH.format(user="NEW.user_id")}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_checkins_delete_user_stats
+    AFTER DELETE ON checkins
+    WHEN OLD.id NOT IN (SELECT id FROM checkins_archive)
+    BEGIN
+        {_USER_STATS_REMOVE}
+        {_USER_STATS_REFRESH.format(user="OLD.user_id")}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_checkins_archive_delete_user_stats
+    AFTER DELETE ON checkins_archive
+    BEGIN
+        {_USER_STATS_REMOVE}
+        {_USER_STATS_REFRESH.format(user="OLD.user_id")}
+    END;
+'''
+
+# Полный пересчёт агрегатов из всей истории (первый запуск, manage.py rebuild-stats)
+USER_STATS_REBUILD = f'''
+    DELETE FROM user_spot_stats;
+    DELETE FROM user_stats;
+    INSERT INTO user_spot_stats (user_id, spot_id, checkins, total_hours)
+    SELECT user_id, spot_id, COUNT(*), COALESCE(SUM(duration_hours), 0)
+    FROM checkins_all GROUP BY user_id, spot_id;
+    INSERT INTO user_stats (user_id, checkins, total_hours)
+    SELECT user_id, COUNT(*), COALESCE(SUM(duration_hours), 0)
+    FROM checkins_all GROUP BY user_id;
+    {_USER_STATS_REFRESH.format(user="user_stats.user_id")}
+'''
+
+# Популярность спота (число чек-инов) для порядка в списке выбора спота. Отдельная
+# таблица, а не колонка spots: иначе каждый чек-ин менял бы поколение каталога спотов.
+# Индекс по (checkins DESC, spot_id) даёт страницы по ключу без сканирования начала списка.
+SPOT_POPULARITY_TRIGGERS = '''
+    CREATE INDEX IF NOT EXISTS idx_spot_popularity ON spot_popularity(checkins DESC, spot_id);
+
+    CREATE TRIGGER IF NOT EXISTS trg_spots_insert_popularity
+    AFTER INSERT ON spots
+    BEGIN
+        INSERT OR IGNORE INTO spot_popularity (spot_id, checkins) VALUES (NEW.id, 0);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_spots_delete_popularity
+    AFTER DELETE ON spots
+    BEGIN
+        DELETE FROM spot_popularity WHERE spot_id = OLD.id;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_checkins_insert_popularity
+    AFTER INSERT ON checkins
+    BEGIN
+        UPDATE spot_popularity SET checkins = checkins + 1 WHERE spot_id = NEW.spot_id;
+    END;
+
+    DROP TRIGGER IF EXISTS trg_checkins_delete_popularity;
+    CREATE TRIGGER IF NOT EXISTS trg_checkins_delete_popularity
+    AFTER DELETE ON checkins
+    WHEN OLD.id NOT IN (SELECT id FROM checkins_archive)
+    BEGIN
+        UPDATE spot_popularity SET checkins = checkins - 1 WHERE spot_id = OLD.spot_id;
+    END;
+'''
+
+SPOT_POPULARITY_REBUILD = '''
+    DELETE FROM spot_popularity;
+    INSERT INTO spot_popularity (spot_id, checkins)
+    SELECT id, (SELECT COUNT(*) FROM checkins_all WHERE spot_id = spots.id) FROM spots;
+'''
+
+# Архив закрытых чек-инов: горячая таблица checkins остаётся маленькой, история
+# (статистика, пересчёт агрегатов) читается через checkins_all из обеих таблиц.
+# Архив живёт в том же файле, поэтому попадает в бэкапы вместе с остальной базой.
+_CHECKIN_COLUMNS = "id, user_id, spot_id, timestamp, active, checkin_type, duration_hours, arrival_time, end_time, closed_at"
+
+# Версия схемы в PRAGMA user_version: 1 — время чек-инов в секундах UTC epoch,
+# 2 — время последней геопозиции пользователя тоже в секундах UTC epoch
+SCHEMA_VERSION = 2
+
+# Время в timestamp, arrival_time, end_time и closed_at — целые секунды UTC epoch
+# (services.epoch): сравнения числовые и идут по индексам. {name} — имя таблицы,
+# при миграции таблица собирается под временным именем.
+CHECKINS_TABLE = '''
+    CREATE TABLE IF NOT EXISTS {name} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        spot_id INTEGER NOT NULL,
+        timestamp INTEGER NOT NULL,
+        active BOOLEAN NOT NULL DEFAULT 1,
+        checkin_type INTEGER NOT NULL,
+        duration_hours REAL,
+        arrival_time INTEGER,
+        end_time INTEGER,
+        closed_at INTEGER,
+        FOREIGN KEY(user_id) REFERENCES users(user_id),
+        FOREIGN KEY(spot_id) REFERENCES spots(id)
+    );
+'''
+
+CHECKINS_ARCHIVE_TABLE = '''
+    CREATE TABLE IF NOT EXISTS {name} (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        spot_id INTEGER NOT NULL,
+        timestamp INTEGER NOT NULL,
+        active BOOLEAN NOT NULL DEFAULT 0,
+        checkin_type INTEGER NOT NULL,
+        duration_hours REAL,
+        arrival_time INTEGER,
+        end_time INTEGER,
+        closed_at INTEGER
+    );
+'''
+
+# Докуда обработаны закрытые сессии: (closed_at, id) последней учтённой
+ROLLUP_WATERMARKS_TABLE = '''
+    CREATE TABLE IF NOT EXISTS {name} (
+        name TEXT PRIMARY KEY,
+        closed_at INTEGER NOT NULL,
+        checkin_id INTEGER NOT NULL
+    );
+'''
+
+CHECKINS_ARCHIVE_SCHEMA = f'''
+    {CHECKINS_ARCHIVE_TABLE.format(name="checkins_archive")}
+    CREATE INDEX IF NOT EXISTS idx_checkins_archive_user_timestamp ON checkins_archive(user_id, timestamp);
+    CREATE INDEX IF NOT EXISTS idx_checkins_archive_spot ON checkins_archive(spot_id);
+
+    CREATE VIEW IF NOT EXISTS checkins_all AS
+    SELECT {_CHECKIN_COLUMNS} FROM checkins
+    UNION ALL
+    SELECT {_CHECKIN_COLUMNS} FROM checkins_archive;
+'''
+
+async def _ensure_column(conn, table: str, column: str, definition: str) -> bool:
+    """Добавляет колонку в существующую таблицу, если её ещё нет (ALTER TABLE без IF NOT EXISTS); True — добавлена."""
+    cursor = await conn.execute(f"PRAGMA table_info({table})")
+    if column in {row[1] for row in await cursor.fetchall()}:
+        return False
+    await conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return True
+
+def _epoch_or_none(value, table: str, checkin_id: int):
+    try:
+        return epoch.to_epoch(value)
+    except ValueError:
+        logger.warning(f"⚠️ Некорректное время {value!r} в {table}, чек-ин {checkin_id}: значение сброшено")
+        return None
+
+async def _migrate_to_epoch(conn) -> None:
+    """
+    Схема 0 → 1: время чек-инов из строк ISO (наивных utcnow() и с поясом
+    вперемешку) в целые секунды UTC epoch. SQLite не меняет тип колонки, поэтому
+    таблицы пересобираются: копия с новыми типами, перенос строк с конвертацией
+    и замена — в одной транзакции. Триггеры и индексы удалённых таблиц
+    создаются заново в init_db, агрегаты пользователей пересчитываются.
+    """
+    logger.info("🔄 Миграция времени чек-инов в секунды UTC epoch...")
+    await conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Представление и триггеры других таблиц, ссылающиеся на checkins, мешают
+        # переименованию пересобранной таблицы; init_db создаст их заново
+        await conn.execute("DROP VIEW IF EXISTS checkins_all")
+        cursor = await conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND sql LIKE '%checkins%'")
+        for (trigger,) in await cursor.fetchall():
+            await conn.execute(f"DROP TRIGGER {trigger}")
+        for table, ddl in (("checkins", CHECKINS_TABLE), ("checkins_archive", CHECKINS_ARCHIVE_TABLE)):
+            cursor = await conn.execute(f"PRAGMA table_info({table})")
+            columns = {row[1] for row in await cursor.fetchall()}
+            if not columns:
+                continue
+            # До появления closed_at момент ухода не хранился, берём запланированный конец
+            closed_at = "closed_at" if "closed_at" in columns else \
+                "CASE WHEN active = 0 AND checkin_type = 1 THEN end_time END"
+            cursor = await conn.execute(f'''
+                SELECT id, user_id, spot_id, timestamp, active, checkin_type, duration_hours,
+                       arrival_time, end_time, {closed_at}
+                FROM {table}
+            ''')
+            rows = []
+            for row in await cursor.fetchall():
+                checkin_id = row[0]
+                arrival_time, end_time, closed = (_epoch_or_none(value, table, checkin_id) for value in row[7:10])
+                started = _epoch_or_none(row[3], table, checkin_id) or closed or end_time or 0
+                rows.append((*row[:3], started, *row[4:7], arrival_time, end_time, closed))
+            cursor = await conn.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,))
+            sequence = await cursor.fetchone()
+            await conn.execute(ddl.format(name=f"{table}_epoch"))
+            await conn.executemany(
+                f"INSERT INTO {table}_epoch ({_CHECKIN_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+            )
+            await conn.execute(f"DROP TABLE {table}")
+            await conn.execute(f"ALTER TABLE {table}_epoch RENAME TO {table}")
+            if sequence:
+                # AUTOINCREMENT не должен выдать id удалённых или архивных чек-инов повторно
+                await conn.execute('''
+                    UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?
+                ''', (sequence[0], table))
+            logger.info(f"✅ {table}: перенесено строк — {len(rows)}")
+
+        cursor = await conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'rollup_watermarks'")
+        if await cursor.fetchone():
+            cursor = await conn.execute("SELECT name, closed_at, checkin_id FROM rollup_watermarks")
+            watermarks = [
+                (name, _epoch_or_none(closed, "rollup_watermarks", checkin_id) or 0, checkin_id)
+                for name, closed, checkin_id in await cursor.fetchall()
+            ]
+            await conn.execute("DROP TABLE rollup_watermarks")
+            await conn.execute(ROLLUP_WATERMARKS_TABLE.format(name="rollup_watermarks"))
+            await conn.executemany("INSERT INTO rollup_watermarks (name, closed_at, checkin_id) VALUES (?, ?, ?)", watermarks)
+
+        # Первая и последняя сессия хранились строками: агрегаты пересчитает init_db
+        await conn.execute("DROP TABLE IF EXISTS user_stats")
+        await conn.execute("PRAGMA user_version = 1")
+        await conn.commit()
+    except Exception:
+        await conn.rollback()
+        raise
+
+async def _migrate_location_time(conn) -> None:
+    """
+    Схема 1 → 2: users.location_updated_at из строки ISO в секунды UTC epoch.
+    В колонке TEXT числа хранились бы строками, поэтому колонка заменяется
+    колонкой INTEGER с перенесёнными значениями.
+    """
+    cursor = await conn.execute("PRAGMA table_info(users)")
+    columns = {row[1]: row[2] for row in await cursor.fetchall()}
+    if columns.get("location_updated_at", "INTEGER").upper() == "INTEGER":
+        return
+    await conn.execute("BEGIN IMMEDIATE")
+    try:
+        cursor = await conn.execute("SELECT user_id, location_updated_at FROM users WHERE location_updated_at IS NOT NULL")
+        rows = []
+        for user_id, value in await cursor.fetchall():
+            try:
+                rows.append((epoch.to_epoch(value), user_id))
+            except ValueError:
+                logger.warning(f"⚠️ Некорректное время геопозиции {value!r} пользователя {user_id}: значение сброшено")
+        await conn.execute("ALTER TABLE users DROP COLUMN location_updated_at")
+        await conn.execute("ALTER TABLE users ADD COLUMN location_updated_at INTEGER")
+        await conn.executemany("UPDATE users SET location_updated_at = ? WHERE user_id = ?", rows)
+        await conn.commit()
+        logger.info(f"✅ Время геопозиций переведено в секунды epoch: строк — {len(rows)}")
+    except Exception:
+        await conn.rollback()
+        raise
+
 # Блок 1: Инициализация БД
 async def init_db():
     """Инициализация структуры базы данных"""
     try:
         async with aiosqlite.connect(DB_PATH) as conn:
+            # WAL: читатели не блокируют писателя, что важно при нескольких процессах-воркерах
+            await conn.execute("PRAGMA journal_mode=WAL")
+            cursor = await conn.execute("PRAGMA user_version")
+            version = (await cursor.fetchone())[0]
+            cursor = await conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'checkins'")
+            if version < 1 and await cursor.fetchone():
+                await _migrate_to_epoch(conn)
             await conn.executescript('''
                 CREATE TABLE IF NOT EXISTS users (
                     user_id INTEGER PRIMARY KEY,
@@ -35,50 +442,231 @@ async def init_db():
                     creator_id INTEGER NOT NULL
                 );
 
-                CREATE TABLE IF NOT EXISTS checkins (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                CREATE TABLE IF NOT EXISTS favorite_spots (
                     user_id INTEGER NOT NULL,
                     spot_id INTEGER NOT NULL,
-                    timestamp TEXT NOT NULL,
-                    active BOOLEAN NOT NULL DEFAULT 1,
-                    checkin_type INTEGER NOT NULL,
-                    duration_hours REAL,
-                    arrival_time TEXT,
-                    end_time TEXT,
+                    PRIMARY KEY(user_id, spot_id),
                     FOREIGN KEY(user_id) REFERENCES users(user_id),
                     FOREIGN KEY(spot_id) REFERENCES spots(id)
                 );
 
-                CREATE TABLE IF NOT EXISTS favorite_spots (
+                CREATE TABLE IF NOT EXISTS change_counters (
+                    table_name TEXT PRIMARY KEY,
+                    generation INTEGER NOT NULL DEFAULT 0
+                );
+
+                CREATE TABLE IF NOT EXISTS leases (
+                    name TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                );
+
+                CREATE TABLE IF NOT EXISTS spot_versions (
+                    spot_id INTEGER PRIMARY KEY,
+                    version INTEGER NOT NULL DEFAULT 0
+                );
+            ''')
+            await conn.executescript(CHECKINS_TABLE.format(name="checkins"))
+            cursor = await conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ('user_stats', 'spot_popularity')"
+            )
+            existing = {row[0] for row in await cursor.fetchall()}
+            await conn.executescript('''
+                CREATE TABLE IF NOT EXISTS user_stats (
+                    user_id INTEGER PRIMARY KEY,
+                    checkins INTEGER NOT NULL DEFAULT 0,
+                    total_hours REAL NOT NULL DEFAULT 0,
+                    first_session INTEGER,
+                    last_session INTEGER,
+                    favorite_spot_id INTEGER
+                );
+
+                CREATE TABLE IF NOT EXISTS user_spot_stats (
                     user_id INTEGER NOT NULL,
                     spot_id INTEGER NOT NULL,
-                    PRIMARY KEY(user_id, spot_id),
-                    FOREIGN KEY(user_id) REFERENCES users(user_id),
-                    FOREIGN KEY(spot_id) REFERENCES spots(id)
+                    checkins INTEGER NOT NULL DEFAULT 0,
+                    total_hours REAL NOT NULL DEFAULT 0,
+                    PRIMARY KEY(user_id, spot_id)
+                );
+
+                CREATE TABLE IF NOT EXISTS spot_popularity (
+                    spot_id INTEGER PRIMARY KEY,
+                    checkins INTEGER NOT NULL DEFAULT 0
+                );
+
+                -- Человеко-минуты на споте по часам недели (UTC, понедельник 00:00 — час 0):
+                -- 168 целых uint32 little-endian
+                CREATE TABLE IF NOT EXISTS spot_hourly (
+                    spot_id INTEGER PRIMARY KEY,
+                    minutes BLOB NOT NULL
                 );
             ''')
+            await conn.executescript(ROLLUP_WATERMARKS_TABLE.format(name="rollup_watermarks"))
+            # Последняя известная геопозиция пользователя: порядок спотов в списке выбора
+            await _ensure_column(conn, "users", "last_lat", "REAL")
+            await _ensure_column(conn, "users", "last_lon", "REAL")
+            if version < 2:
+                await _migrate_location_time(conn)
+            await _ensure_column(conn, "users", "location_updated_at", "INTEGER")
+            await conn.executescript(CHECKINS_ARCHIVE_SCHEMA)
+            await conn.executescript(_change_tracking_script())
+            await conn.executescript(SPOT_VERSION_TRIGGERS)
+            await conn.executescript(USER_STATS_TRIGGERS)
+            await conn.executescript(SPOT_POPULARITY_TRIGGERS)
+            # Активных чек-инов немного: частичный индекс для сверки модели занятости
+            await conn.execute("CREATE INDEX IF NOT EXISTS idx_checkins_active ON checkins(spot_id) WHERE active = 1")
+            await conn.execute("CREATE INDEX IF NOT EXISTS idx_checkins_closed_at ON checkins(closed_at, id) WHERE closed_at IS NOT NULL")
+            # Диапазонные выборки планировщика: истёкшие чек-ины и просроченные приезды
+            await conn.execute("CREATE INDEX IF NOT EXISTS idx_checkins_active_end ON checkins(end_time) WHERE active = 1 AND checkin_type = 1")
+            await conn.execute("CREATE INDEX IF NOT EXISTS idx_checkins_active_arrival ON checkins(arrival_time) WHERE active = 1 AND checkin_type = 2")
+            if "user_stats" not in existing:
+                # База создана до появления агрегатов: заполняем их по истории чек-инов
+                await conn.executescript(f"BEGIN; {USER_STATS_REBUILD} COMMIT;")
+                logger.info("📊 Статистика пользователей рассчитана по истории чек-инов")
+            if "spot_popularity" not in existing:
+                await conn.executescript(f"BEGIN; {SPOT_POPULARITY_REBUILD} COMMIT;")
+            await conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
             await conn.commit()
             logger.info("База данных инициализирована")
     except Exception as e:
         logger.error(f"Ошибка инициализации БД: {str(e)}")
         raise
 
+async def get_generation(table: str = ALL_TABLES) -> int:
+    """
+    Возвращает текущее поколение данных таблицы (или всей БД).
+
+    PRAGMA data_version не подходит: каждая функция открывает новое соединение,
+    а data_version сравним только в пределах одного соединения. Счётчик
+    в change_counters читается одной строкой по первичному ключу — O(1)
+    независимо от размера базы.
+    """
+    try:
+        async with aiosqlite.connect(DB_PATH) as conn:
+            cursor = await conn.execute('''
+                SELECT generation FROM change_counters WHERE table_name = ?
+            ''', (table,))
+            row = await cursor.fetchone()
+            return row[0] if row else 0
+    except Exception as e:
+        logger.error(f"Ошибка получения поколения данных: {str(e)}")
+        return 0
+
+async def changed_since(generation: int, table: str = ALL_TABLES) -> tuple:
+    """
+    Проверяет, менялись ли данные после указанного поколения.
+
+    Returns:
+        tuple: (изменились ли данные, текущее поколение)
+    """
+    current = await get_generation(table)
+    return current != generation, current
+
+async def acquire_lease(name: str, owner: str, ttl: float) -> bool:
+    """
+    Захватывает или продлевает аренду (лидерство) на ttl секунд.
+    Аренду можно забрать только у того же владельца или после её истечения.
+
+    Returns:
+        bool: True, если аренда принадлежит owner
+    """
+    now = time.time()
+    try:
+        async with aiosqlite.connect(DB_PATH) as conn:
+            await conn.execute('''
+                INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET
+                    owner = excluded.owner,
+                    expires_at = excluded.expires_at
+                WHERE leases.owner = excluded.owner OR leases.expires_at < ?
+            ''', (name, owner, now + ttl, now))
+            await conn.commit()
+            cursor = await conn.execute('''
+                SELECT owner FROM leases WHERE name = ?
+            ''', (name,))
+            row = await cursor.fetchone()
+            return row is not None and row[0] == owner
+    except Exception as e:
+        logger.error(f"Ошибка захвата аренды {name}: {str(e)}")
+        return False
+
+async def release_lease(name: str, owner: str) -> None:
+    """Освобождает аренду, если она принадлежит owner"""
+    try:
+        async with aiosqlite.connect(DB_PATH) as conn:
+            await conn.execute('''
+                DELETE FROM leases WHERE name = ? AND owner = ?
+            ''', (name, owner))
+            await conn.commit()
+    except Exception as e:
+        logger.error(f"Ошибка освобождения аренды {name}: {str(e)}")
+
 # Блок 2: Работа с пользователями
+# Кеш профилей: get_user вызывается почти в каждом обработчике
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+
+_USER_COLUMNS = "user_id, first_name, last_name, username, is_admin, timezone"
+
+class UserRecord:
+    """Профиль пользователя из кеша."""
+    __slots__ = ("user_id", "first_name", "last_name", "username", "is_admin", "timezone", "timezone_cell", "loaded_at")
+
+    def __init__(self, row: tuple):
+        self.user_id, self.first_name, self.last_name, self.username, is_admin, self.timezone = row
+        self.is_admin = bool(is_admin)
+        # Ячейка сетки поясов, для которой определён timezone (см. timezones.user_timezone_at)
+        self.timezone_cell = None
+        self.loaded_at = time.monotonic()
+
+_user_cache: "OrderedDict[int, UserRecord]" = OrderedDict()
+_admin_ids = set()
+_admin_ids_loaded_at = None
+
+def _cache_user(row: tuple) -> UserRecord:
+    record = UserRecord(row)
+    _user_cache[record.user_id] = record
+    _user_cache.move_to_end(record.user_id)
+    if len(_user_cache) > USER_CACHE_SIZE:
+        _user_cache.popitem(last=False)
+    if record.is_admin:
+        _admin_ids.add(record.user_id)
+    else:
+        _admin_ids.discard(record.user_id)
+    user_cache_size.set(len(_user_cache))
+    return record
+
+def _cached_user(user_id: int):
+    record = _user_cache.get(user_id)
+    if record is None or time.monotonic() - record.loaded_at >= USER_CACHE_TTL:
+        return None
+    _user_cache.move_to_end(user_id)
+    return record
+
 async def add_or_update_user(
     user_id: int,
     first_name: str,
     last_name: str = None,
     username: str = None,
     is_admin: bool = False,
-    timezone: str = "UTC"
+    timezone: str = None
 ) -> None:
-    """Обновление данных пользователя с часовым поясом"""
+    """
+    Создание или обновление пользователя. Для существующего пользователя
+    сохраняются is_admin, created_at и часовой пояс (если новый не передан).
+    """
     try:
         async with aiosqlite.connect(DB_PATH) as conn:
-            await conn.execute('''
-                INSERT OR REPLACE INTO users 
+            cursor = await conn.execute(f'''
+                INSERT INTO users
                 (user_id, first_name, last_name, username, is_admin, created_at, timezone)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
+                VALUES (?, ?, ?, ?, ?, ?, COALESCE(?, 'UTC'))
+                ON CONFLICT(user_id) DO UPDATE SET
+                    first_name = excluded.first_name,
+                    last_name = excluded.last_name,
+                    username = excluded.username,
+                    timezone = COALESCE(?, users.timezone)
+                RETURNING {_USER_COLUMNS}
             ''', (
                 user_id,
                 first_name,
@@ -86,49 +674,172 @@ async def add_or_update_user(
                 username,
                 int(is_admin),
                 datetime.utcnow().isoformat(),
+                timezone,
                 timezone
             ))
+            row = await cursor.fetchone()
             await conn.commit()
+            _cache_user(row)
             logger.info(f"Пользователь {user_id} обновлён")
     except Exception as e:
         logger.error(f"Ошибка обновления пользователя: {str(e)}")
         raise
 
-async def get_user(user_id: int) -> dict:
-    """Получение данных пользователя"""
+async def update_user_timezone(user_id: int, timezone: str) -> None:
+    """Сохраняет часовой пояс пользователя, не затрагивая остальные поля"""
+    try:
+        async with aiosqlite.connect(DB_PATH) as conn:
+            await conn.execute('''
+                UPDATE users SET timezone = ? WHERE user_id = ? AND timezone != ?
+            ''', (timezone, user_id, timezone))
+            await conn.commit()
+        record = _user_cache.get(user_id)
+        if record is not None:
+            record.timezone = timezone
+    except Exception as e:
+        logger.error(f"Ошибка обновления часового пояса: {str(e)}")
+        raise
+
+async def update_user_location(user_id: int, lat: float, lon: float) -> None:
+    """Запоминает последнюю геопозицию, присланную пользователем (время — секунды UTC epoch)"""
+    try:
+        async with aiosqlite.connect(DB_PATH) as conn:
+            await conn.execute('''
+                UPDATE users SET last_lat = ?, last_lon = ?, location_updated_at = ? WHERE user_id = ?
+            ''', (lat, lon, epoch.now(), user_id))
+            await conn.commit()
+    except Exception as e:
+        logger.error(f"Ошибка сохранения геопозиции пользователя: {str(e)}")
+
+async def get_user_location(user_id: int) -> tuple:
+    """Последняя известная геопозиция пользователя (lat, lon, location_updated_at) или None"""
     try:
         async with aiosqlite.connect(DB_PATH) as conn:
             cursor = await conn.execute('''
-                SELECT user_id, first_name, last_name, username, is_admin, timezone
-                FROM users WHERE user_id = ?
+                SELECT last_lat, last_lon, location_updated_at FROM users WHERE user_id = ? AND last_lat IS NOT NULL
+            ''', (user_id,))
+            row = await cursor.fetchone()
+            return tuple(row) if row else None
+    except Exception as e:
+        logger.error(f"Ошибка получения геопозиции пользователя: {str(e)}")
+        return None
+
+async def get_user(user_id: int) -> UserRecord:
+    """Получение данных пользователя (из кеша, если запись свежая)"""
+    record = _cached_user(user_id)
+    if record is not None:
+        user_cache_hits.inc()
+        return record
+    user_cache_misses.inc()
+    try:
+        async with aiosqlite.connect(DB_PATH) as conn:
+            cursor = await conn.execute(f'''
+                SELECT {_USER_COLUMNS} FROM users WHERE user_id = ?
             ''', (user_id,))
             row = await cursor.fetchone()
-            return {
-                "user_id": row[0],
-                "first_name": row[1],
-                "last_name": row[2],
-                "username": row[3],
-                "is_admin": bool(row[4]),
-                "timezone": row[5]
-            } if row else None
+            return _cache_user(row) if row else None
     except Exception as e:
         logger.error(f"Ошибка получения пользователя: {str(e)}")
         return None
 
+async def get_users(user_ids: list) -> dict:
+    """Профили нескольких пользователей {user_id: UserRecord}; недостающие читаются одним запросом"""
+    result = {}
+    missing = []
+    for user_id in user_ids:
+        record = _cached_user(user_id)
+        if record is not None:
+            result[user_id] = record
+        else:
+            missing.append(user_id)
+    user_cache_hits.inc(len(result))
+    if missing:
+        user_cache_misses.inc(len(missing))
+        try:
+            async with aiosqlite.connect(DB_PATH) as conn:
+                placeholders = ",".join("?" * len(missing))
+                cursor = await conn.execute(f'''
+                    SELECT {_USER_COLUMNS} FROM users WHERE user_id IN ({placeholders})
+                ''', missing)
+                for row in await cursor.fetchall():
+                    result[row[0]] = _cache_user(row)
+        except Exception as e:
+            logger.error(f"Ошибка получения пользователей: {str(e)}")
+    return result
+
+async def is_user_admin(user_id: int) -> bool:
+    """
+    Проверка прав администратора по множеству ID в памяти. Множество целиком
+    перечитывается раз в USER_CACHE_TTL, чтобы подхватить права, выданные в БД вручную.
+    """
+    global _admin_ids_loaded_at
+    if _admin_ids_loaded_at is None or time.monotonic() - _admin_ids_loaded_at >= USER_CACHE_TTL:
+        try:
+            async with aiosqlite.connect(DB_PATH) as conn:
+                cursor = await conn.execute('SELECT user_id FROM users WHERE is_admin = 1')
+                admin_ids = {row[0] for row in await cursor.fetchall()}
+            _admin_ids.clear()
+            _admin_ids.update(admin_ids)
+            _admin_ids_loaded_at = time.monotonic()
+        except Exception as e:
+            logger.error(f"Ошибка загрузки администраторов: {str(e)}")
+    return user_id in _admin_ids
+
 # Блок 3: Работа со спотами
-async def get_spots() -> list:
-    """Получение списка всех спотов"""
+async def get_spots() -> SpotColumns:
+    """Весь каталог спотов по столбцам (см. rows.SpotColumns)"""
+    spots = SpotColumns()
     try:
         async with aiosqlite.connect(DB_PATH) as conn:
             cursor = await conn.execute('''
                 SELECT id, name, latitude, longitude FROM spots
             ''')
-            return [{"id": row[0], "name": row[1], "lat": row[2], "lon": row[3]} 
-                    for row in await cursor.fetchall()]
+            async for row in cursor:
+                spots.append(*row)
+            return spots
     except Exception as e:
         logger.error(f"Ошибка получения спотов: {str(e)}")
+        return SpotColumns()
+
+async def get_spots_by_popularity(after: tuple = None, limit: int = 10) -> list:
+    """
+    Страница спотов по убыванию популярности. after — ключ (checkins, spot_id)
+    последнего спота предыдущей страницы; страница читается по индексу от этого ключа.
+    """
+    try:
+        async with aiosqlite.connect(DB_PATH) as conn:
+            conn.row_factory = row_factory(RankedSpot)
+            if after is None:
+                cursor = await conn.execute('''
+                    SELECT s.id, s.name, s.latitude, s.longitude, p.checkins
+                    FROM spot_popularity p JOIN spots s ON s.id = p.spot_id
+                    ORDER BY p.checkins DESC, p.spot_id
+                    LIMIT ?
+                ''', (limit,))
+            else:
+                checkins, spot_id = after
+                cursor = await conn.execute('''
+                    SELECT s.id, s.name, s.latitude, s.longitude, p.checkins
+                    FROM spot_popularity p JOIN spots s ON s.id = p.spot_id
+                    WHERE p.checkins <= ? AND (p.checkins < ? OR p.spot_id > ?)
+                    ORDER BY p.checkins DESC, p.spot_id
+                    LIMIT ?
+                ''', (checkins, checkins, spot_id, limit))
+            return await cursor.fetchall()
+    except Exception as e:
+        logger.error(f"Ошибка получения страницы спотов: {str(e)}")
         return []
 
+async def has_spots() -> bool:
+    """Есть ли в каталоге хотя бы один спот (без чтения всего списка)."""
+    try:
+        async with aiosqlite.connect(DB_PATH) as conn:
+            cursor = await conn.execute('SELECT EXISTS(SELECT 1 FROM spots)')
+            return bool((await cursor.fetchone())[0])
+    except Exception as e:
+        logger.error(f"Ошибка проверки каталога спотов: {str(e)}")
+        return False
+
 async def add_spot(name: str, lat: float, lon: float, creator_id: int) -> int:
     """Добавление нового спота"""
     try:
@@ -138,6 +849,7 @@ async def add_spot(name: str, lat: float, lon: float, creator_id: int) -> int:
                 VALUES (?, ?, ?, ?)
             ''', (name, lat, lon, creator_id))
             await conn.commit()
+            bus.publish(SpotChanged(cursor.lastrowid))
             return cursor.lastrowid
     except Exception as e:
         logger.error(f"Ошибка добавления спота: {str(e)}")
@@ -151,6 +863,7 @@ async def update_spot_name(spot_id: int, new_name: str) -> None:
                 UPDATE spots SET name = ? WHERE id = ?
             ''', (new_name, spot_id))
             await conn.commit()
+        bus.publish(SpotChanged(spot_id))
     except Exception as e:
         logger.error(f"Ошибка обновления спота: {str(e)}")
         raise
@@ -160,28 +873,26 @@ async def delete_spot(spot_id: int) -> None:
     try:
         async with aiosqlite.connect(DB_PATH) as conn:
             await conn.execute('DELETE FROM checkins WHERE spot_id = ?', (spot_id,))
+            await conn.execute('DELETE FROM checkins_archive WHERE spot_id = ?', (spot_id,))
+            await conn.execute('DELETE FROM spot_hourly WHERE spot_id = ?', (spot_id,))
             await conn.execute('DELETE FROM spots WHERE id = ?', (spot_id,))
             await conn.commit()
+        bus.publish(SpotChanged(spot_id, removed=True))
     except Exception as e:
         logger.error(f"Ошибка удаления спота: {str(e)}")
         raise
 
-async def get_spot_by_id(spot_id: int) -> dict:
+async def get_spot_by_id(spot_id: int) -> Spot:
     """Возвращает данные спота по ID"""
     try:
         async with aiosqlite.connect(DB_PATH) as conn:
+            conn.row_factory = row_factory(Spot)
             cursor = await conn.execute('''
                 SELECT id, name, latitude, longitude 
                 FROM spots 
                 WHERE id = ?
             ''', (spot_id,))
-            row = await cursor.fetchone()
-            return {
-                "id": row[0],
-                "name": row[1],
-                "lat": row[2],
-                "lon": row[3]
-            } if row else None
+            return await cursor.fetchone()
     except Exception as e:
         logger.error(f"Ошибка получения спота: {str(e)}")
         return None
@@ -197,6 +908,7 @@ async def update_spot_location(spot_id: int, new_lat: float, new_lon: float) ->
             ''', (new_lat, new_lon, spot_id))
             await conn.commit()
             logger.info(f"Координаты спота {spot_id} обновлены")
+        bus.publish(SpotChanged(spot_id))
     except Exception as e:
         logger.error(f"Ошибка обновления координат: {str(e)}")
         raise
@@ -207,8 +919,7 @@ async def checkin_user(
     spot_id: int,
     checkin_type: int,
     duration_hours: float = None,
-    arrival_time: str = None,
-    bot: Bot = None
+    arrival_time: int = None
 ) -> int:
     """
     Создание записи для чек-ина пользователя.
@@ -218,8 +929,10 @@ async def checkin_user(
         spot_id (int): ID спота
         checkin_type (int): Тип чек-ина (1 или 2)
         duration_hours (float, optional): Длительность в часах
-        arrival_time (str, optional): Время прибытия в формате ISO
-        bot (Bot, optional): Экземпляр бота для уведомлений
+        arrival_time (int, optional): Время прибытия, секунды UTC epoch (строка ISO тоже принимается)
+
+    После коммита публикуется CheckinCreated; уведомления подписчикам спота
+    отправляет обработчик событий, а не вызывающий код.
 
     Returns:
         int: ID созданного чек-ина или None в случае ошибки
@@ -233,9 +946,9 @@ async def checkin_user(
         return None
 
     # Валидация arrival_time, если указано
-    if arrival_time:
+    if arrival_time is not None:
         try:
-            datetime.fromisoformat(arrival_time)
+            arrival_time = epoch.to_epoch(arrival_time)
         except ValueError:
             logger.error(f"Некорректный формат arrival_time: {arrival_time}")
             return None
@@ -243,11 +956,7 @@ async def checkin_user(
     try:
         # Деактивация всех текущих чек-инов пользователя
         await deactivate_all_checkins(user_id)
-        user = await get_user(user_id)
-        tz_name = user.get('timezone', 'UTC')
-        tz = pytz.timezone(tz_name)
-        
-        timestamp = datetime.now(pytz.utc)
+        timestamp = epoch.now()
         end_time = None
 
         # Подключение к базе данных и вставка записи
@@ -262,7 +971,7 @@ async def checkin_user(
             ''', (
                 user_id,
                 spot_id,
-                timestamp.isoformat(),
+                timestamp,
                 0 if checkin_type == 1 else 1,  # Тип 1: неактивен, Тип 2: активен
                 checkin_type,
                 duration_hours,
@@ -271,140 +980,431 @@ async def checkin_user(
             ))
             await conn.commit()
             checkin_id = cursor.lastrowid  # Получаем ID новой записи
-            
-            # Логирование успешного создания чек-ина
-            logger.info(f"Создан чек-ин {checkin_id} для пользователя {user_id} на споте {spot_id}")
 
-            # Отправка уведомлений для активных чек-инов (тип 2)
-            if bot and checkin_type == 2:
-                await notify_favorite_users(
-                    spot_id=spot_id,
-                    checkin_user_id=user_id,
-                    bot=bot,
-                    checkin_type=checkin_type,
-                    arrival_time=arrival_time
-                )
-
-            return checkin_id  # Возвращаем ID чек-ина
+        # Логирование успешного создания чек-ина
+        logger.info(f"Создан чек-ин {checkin_id} для пользователя {user_id} на споте {spot_id}")
+        bus.publish(CheckinCreated(checkin_id, user_id, spot_id, checkin_type, arrival_time))
+        return checkin_id  # Возвращаем ID чек-ина
 
     except Exception as e:
         # Логирование ошибки
         logger.error(f"Ошибка создания чек-ина: {str(e)}")
         return None
 
-async def get_active_checkin(user_id: int) -> dict:
+async def get_active_checkin(user_id: int) -> Checkin:
     """Получение активного чекина"""
     try:
         async with aiosqlite.connect(DB_PATH) as conn:
+            conn.row_factory = row_factory(Checkin)
             cursor = await conn.execute('''
-                SELECT id, spot_id, checkin_type, duration_hours, arrival_time, end_time
+                SELECT id, user_id, spot_id, checkin_type, timestamp, duration_hours, arrival_time, end_time
                 FROM checkins 
                 WHERE user_id = ? AND active = 1
             ''', (user_id,))
-            row = await cursor.fetchone()
-            return {
-                "id": row[0],
-                "spot_id": row[1],
-                "checkin_type": row[2],
-                "duration_hours": row[3],
-                "arrival_time": row[4],
-                "end_time": row[5]
-            } if row else None
+            return await cursor.fetchone()
     except Exception as e:
         logger.error(f"Ошибка получения чекина: {str(e)}")
         return None
 
+async def get_active_checkins(spot_ids: list = None) -> list:
+    """Активные чек-ины всех спотов или только spot_ids: (id, user_id, spot_id, checkin_type, arrival_time)"""
+    async with aiosqlite.connect(DB_PATH) as conn:
+        if spot_ids is None:
+            cursor = await conn.execute('''
+                SELECT id, user_id, spot_id, checkin_type, arrival_time
+                FROM checkins
+                WHERE active = 1
+            ''')
+        else:
+            placeholders = ",".join("?" * len(spot_ids))
+            cursor = await conn.execute(f'''
+                SELECT id, user_id, spot_id, checkin_type, arrival_time
+                FROM checkins
+                WHERE active = 1 AND spot_id IN ({placeholders})
+            ''', list(spot_ids))
+        return await cursor.fetchall()
+
+async def _deactivate_checkin(checkin_id: int, event_type) -> bool:
+    """Снимает активный чек-ин и публикует событие event_type; False — он уже не активен."""
+    async with aiosqlite.connect(DB_PATH) as conn:
+        cursor = await conn.execute('''
+            UPDATE checkins SET active = 0, closed_at = ? WHERE id = ? AND active = 1
+            RETURNING user_id, spot_id, arrival_time
+        ''', (epoch.now(), checkin_id))
+        row = await cursor.fetchone()
+        await conn.commit()
+    if row is None:
+        return False
+    user_id, spot_id, arrival_time = row
+    if event_type is ArrivalOverdue:
+        bus.publish(ArrivalOverdue(checkin_id, user_id, spot_id, arrival_time))
+    else:
+        bus.publish(event_type(checkin_id, user_id, spot_id))
+    return True
+
 async def checkout_user(checkin_id: int) -> None:
-    """Завершение чекина"""
+    """Завершение чекина пользователем"""
     try:
+        await _deactivate_checkin(checkin_id, Left)
+    except Exception as e:
+        logger.error(f"Ошибка завершения чекина: {str(e)}")
+        raise
+
+async def expire_checkin(checkin_id: int) -> bool:
+    """Закрывает чек-ин, время пребывания которого истекло"""
+    try:
+        return await _deactivate_checkin(checkin_id, Expired)
+    except Exception as e:
+        logger.error(f"Ошибка закрытия истёкшего чекина: {str(e)}")
+        raise
+
+async def mark_arrival_overdue(checkin_id: int) -> bool:
+    """Снимает план приезда, время которого прошло без подтверждения"""
+    try:
+        return await _deactivate_checkin(checkin_id, ArrivalOverdue)
+    except Exception as e:
+        logger.error(f"Ошибка снятия просроченного приезда: {str(e)}")
+        raise
+
+async def activate_checkin(checkin_id: int, duration_hours: float) -> None:
+    """Активирует чек-ин «Я на споте» после выбора длительности пребывания"""
+    try:
+        now = epoch.now()
+        end_time = epoch.after_hours(duration_hours, now)
         async with aiosqlite.connect(DB_PATH) as conn:
-            await conn.execute('''
-                UPDATE checkins SET active = 0 WHERE id = ?
-            ''', (checkin_id,))
+            cursor = await conn.execute('''
+                UPDATE checkins SET
+                    active = 1,
+                    end_time = ?,
+                    duration_hours = ?,
+                    timestamp = ?,
+                    closed_at = NULL
+                WHERE id = ?
+                RETURNING user_id, spot_id
+            ''', (end_time, duration_hours, now, checkin_id))
+            row = await cursor.fetchone()
             await conn.commit()
+            logger.info(f"Чек-ин {checkin_id} активирован для типа 1, active=1")
+        if row:
+            bus.publish(Arrived(checkin_id, row[0], row[1], duration_hours, end_time))
     except Exception as e:
-        logger.error(f"Ошибка завершения чекина: {str(e)}")
+        logger.error(f"Ошибка активации чек-ина: {str(e)}")
         raise
 
 async def update_checkin_to_arrived(checkin_id: int, duration_hours: float) -> None:
-    """Обновляет чек-ин при подтверждении прибытия"""
+    """Обновляет чек-ин при подтверждении прибытия: план приезда становится активным чек-ином"""
     try:
+        now = epoch.now()
+        end_time = epoch.after_hours(duration_hours, now)
         async with aiosqlite.connect(DB_PATH) as conn:
-            timestamp = datetime.utcnow()
-            end_time = (timestamp + timedelta(hours=duration_hours)).isoformat()
-            await conn.execute('''
-                UPDATE checkins SET 
+            cursor = await conn.execute('''
+                UPDATE checkins SET
                     checkin_type = 1,
+                    timestamp = ?,
                     duration_hours = ?,
+                    end_time = ?,
                     arrival_time = NULL,
-                    end_time = ?
+                    active = 1,
+                    closed_at = NULL
                 WHERE id = ?
-            ''', (duration_hours, end_time, checkin_id))
+                RETURNING user_id, spot_id
+            ''', (now, duration_hours, end_time, checkin_id))
+            row = await cursor.fetchone()
             await conn.commit()
-            logger.info(f"Чек-ин {checkin_id} обновлён")
+            logger.info(f"Чек-ин {checkin_id} обновлён: checkin_type=1, arrival_time=NULL, active=1")
+        if row:
+            bus.publish(Arrived(checkin_id, row[0], row[1], duration_hours, end_time, from_plan=True))
     except Exception as e:
         logger.error(f"Ошибка обновления: {str(e)}")
         raise
 
+async def get_planned_checkin(checkin_id: int, user_id: int) -> Checkin:
+    """Запись о планируемом приезде (тип 2) пользователя, в том числе уже деактивированная"""
+    try:
+        async with aiosqlite.connect(DB_PATH) as conn:
+            conn.row_factory = row_factory(Checkin)
+            cursor = await conn.execute('''
+                SELECT id, user_id, spot_id, checkin_type FROM checkins
+                WHERE id = ? AND user_id = ? AND checkin_type = 2
+            ''', (checkin_id, user_id))
+            return await cursor.fetchone()
+    except Exception as e:
+        logger.error(f"Ошибка получения планируемого приезда: {str(e)}")
+        return None
+
+async def delete_planned_checkin(checkin_id: int, user_id: int) -> bool:
+    """Удаляет запись о планируемом приезде пользователя; возвращает, была ли она"""
+    try:
+        async with aiosqlite.connect(DB_PATH) as conn:
+            cursor = await conn.execute('''
+                DELETE FROM checkins
+                WHERE id = ? AND user_id = ? AND checkin_type = 2
+                RETURNING spot_id
+            ''', (checkin_id, user_id))
+            row = await cursor.fetchone()
+            await conn.commit()
+        if row:
+            bus.publish(CheckinRemoved(checkin_id, user_id, row[0]))
+        return row is not None
+    except Exception as e:
+        logger.error(f"Ошибка удаления планируемого приезда: {str(e)}")
+        return False
+
+async def delete_unconfirmed_checkin(checkin_id: int) -> bool:
+    """Удаляет временную запись чек-ина, для которой ещё не выбрана длительность"""
+    try:
+        async with aiosqlite.connect(DB_PATH) as conn:
+            cursor = await conn.execute('''
+                DELETE FROM checkins
+                WHERE id = ? AND end_time IS NULL AND active = 0
+                RETURNING user_id, spot_id
+            ''', (checkin_id,))
+            row = await cursor.fetchone()
+            await conn.commit()
+        if row:
+            bus.publish(CheckinRemoved(checkin_id, row[0], row[1]))
+        return row is not None
+    except Exception as e:
+        logger.error(f"Ошибка удаления временного чек-ина: {str(e)}")
+        return False
+
+async def delete_checkin(checkin_id: int) -> None:
+    """Удаляет запись чек-ина"""
+    try:
+        async with aiosqlite.connect(DB_PATH) as conn:
+            cursor = await conn.execute('''
+                DELETE FROM checkins WHERE id = ? RETURNING user_id, spot_id
+            ''', (checkin_id,))
+            row = await cursor.fetchone()
+            await conn.commit()
+        if row:
+            bus.publish(CheckinRemoved(checkin_id, row[0], row[1]))
+    except Exception as e:
+        logger.error(f"Ошибка удаления чек-ина: {str(e)}")
+        raise
+
+async def get_expired_checkins(now: int) -> list:
+    """Активные чек-ины «Я на споте», у которых истекло время пребывания"""
+    try:
+        async with aiosqlite.connect(DB_PATH) as conn:
+            conn.row_factory = row_factory(Checkin)
+            cursor = await conn.execute('''
+                SELECT id, user_id, spot_id, checkin_type
+                FROM checkins
+                WHERE active = 1 AND checkin_type = 1 AND end_time IS NOT NULL AND end_time < ?
+            ''', (now,))
+            return await cursor.fetchall()
+    except Exception as e:
+        logger.error(f"Ошибка получения истёкших чек-инов: {str(e)}")
+        return []
+
+async def get_overdue_arrivals(now: int) -> list:
+    """Активные планы приезда (тип 2), время прибытия которых уже прошло"""
+    try:
+        async with aiosqlite.connect(DB_PATH) as conn:
+            conn.row_factory = row_factory(Checkin)
+            cursor = await conn.execute('''
+                SELECT id, user_id, spot_id, checkin_type, timestamp, duration_hours, arrival_time
+                FROM checkins
+                WHERE checkin_type = 2 AND active = 1 AND arrival_time < ?
+            ''', (now,))
+            return await cursor.fetchall()
+    except Exception as e:
+        logger.error(f"Ошибка получения просроченных приездов: {str(e)}")
+        return []
+
 async def get_checkins_for_user(user_id: int) -> list:
     """Получение всех чек-инов пользователя"""
     try:
         async with aiosqlite.connect(DB_PATH) as conn:
+            conn.row_factory = row_factory(Checkin)
             cursor = await conn.execute('''
-                SELECT id, spot_id, timestamp, checkin_type, duration_hours, arrival_time, end_time
-                FROM checkins 
+                SELECT id, user_id, spot_id, checkin_type, timestamp, duration_hours, arrival_time, end_time
+                FROM checkins_all
                 WHERE user_id = ?
             ''', (user_id,))
-            return [{
-                "id": row[0],
-                "spot_id": row[1],
-                "timestamp": row[2],
-                "checkin_type": row[3],
-                "duration_hours": row[4],
-                "arrival_time": row[5],
-                "end_time": row[6]
-            } for row in await cursor.fetchall()]
+            return await cursor.fetchall()
     except Exception as e:
         logger.error(f"Ошибка получения чек-инов пользователя: {str(e)}")
         return []
 
+async def archive_closed_checkins(before: int, limit: int) -> int:
+    """
+    Переносит до limit неактивных чек-инов, закрытых раньше before, в архив.
+    Каждая пачка — отдельная короткая транзакция; возвращает число перенесённых.
+    """
+    async with aiosqlite.connect(DB_PATH) as conn:
+        await conn.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = await conn.execute('''
+                SELECT id FROM checkins
+                WHERE active = 0 AND COALESCE(closed_at, timestamp) < ?
+                ORDER BY id
+                LIMIT ?
+            ''', (before, limit))
+            ids = [row[0] for row in await cursor.fetchall()]
+            if ids:
+                placeholders = ",".join("?" * len(ids))
+                await conn.execute(f'''
+                    INSERT INTO checkins_archive ({_CHECKIN_COLUMNS})
+                    SELECT {_CHECKIN_COLUMNS} FROM checkins WHERE id IN ({placeholders})
+                ''', ids)
+                await conn.execute(f"DELETE FROM checkins WHERE id IN ({placeholders})", ids)
+            await conn.commit()
+            return len(ids)
+        except Exception:
+            await conn.rollback()
+            raise
+
+async def get_user_stats(user_id: int) -> UserStats:
+    """
+    Статистика для профиля одной строкой: число чек-инов, часы, первая и последняя
+    сессия, любимый спот и спот текущего активного чек-ина.
+    """
+    try:
+        async with aiosqlite.connect(DB_PATH) as conn:
+            cursor = await conn.execute('''
+                SELECT st.checkins, st.total_hours, st.first_session, st.last_session,
+                       st.favorite_spot_id, fav.name,
+                       (SELECT s.name FROM checkins c JOIN spots s ON s.id = c.spot_id
+                        WHERE c.user_id = u.id AND c.active = 1 LIMIT 1)
+                FROM (SELECT ? AS id) u
+                LEFT JOIN user_stats st ON st.user_id = u.id
+                LEFT JOIN spots fav ON fav.id = st.favorite_spot_id
+            ''', (user_id,))
+            checkins, total_hours, *rest = await cursor.fetchone()
+            return UserStats(checkins or 0, total_hours or 0, *rest)
+    except Exception as e:
+        logger.error(f"Ошибка получения статистики пользователя: {str(e)}")
+        return UserStats()
+
+async def rebuild_user_stats() -> int:
+    """Пересчитывает статистику всех пользователей по таблице checkins; возвращает число пользователей."""
+    async with aiosqlite.connect(DB_PATH) as conn:
+        await conn.executescript(f"BEGIN IMMEDIATE; {USER_STATS_REBUILD} COMMIT;")
+        cursor = await conn.execute("SELECT COUNT(*) FROM user_stats")
+        return (await cursor.fetchone())[0]
+
 async def deactivate_all_checkins(user_id: int) -> None:
     """Деактивирует все активные чекины пользователя"""
     try:
         async with aiosqlite.connect(DB_PATH) as conn:
-            await conn.execute('''
+            cursor = await conn.execute('''
                 UPDATE checkins 
-                SET active = 0 
+                SET active = 0, closed_at = ?
                 WHERE user_id = ? AND active = 1
-            ''', (user_id,))
+                RETURNING id, spot_id
+            ''', (epoch.now(), user_id))
+            rows = await cursor.fetchall()
             await conn.commit()
+        for checkin_id, spot_id in rows:
+            bus.publish(Left(checkin_id, user_id, spot_id))
     except Exception as e:
         logger.error(f"Ошибка деактивации чек-инов: {str(e)}")
         raise
 
 
 # Блок 5: Избранные споты
+# Как часто сверять индекс избранного с БД (сек): записи других процессов-воркеров
+FAVORITES_CHECK_INTERVAL = float(os.getenv("FAVORITES_CHECK_INTERVAL", "5"))
+
+favorites_reloads = counter("favorites_index_reloads_total", "Полные перезагрузки индекса избранного из БД")
+favorites_size = gauge("favorites_index_size", "Записей в индексе избранного")
+
+class FavoritesIndex:
+    """
+    Избранное в памяти в обе стороны: пользователь → споты и спот → подписчики.
+
+    Загружается один раз и обновляется записями этого процесса. Записи других
+    процессов видны по счётчику поколения favorite_spots, который сверяется не
+    чаще раза в FAVORITES_CHECK_INTERVAL: свои записи пользователь делает в
+    своём воркере, а рассылка подписчикам может отставать не больше чем на интервал.
+    """
+
+    def __init__(self, check_interval: float = FAVORITES_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self.by_user = {}
+        self.by_spot = {}
+        self.generation = None
+        self.checked_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def _refresh(self) -> None:
+        if self.generation is not None and time.monotonic() - self.checked_at < self.check_interval:
+            return
+        async with self._lock:
+            if self.generation is not None and time.monotonic() - self.checked_at < self.check_interval:
+                return
+            async with aiosqlite.connect(DB_PATH) as conn:
+                generation = await _favorites_generation(conn)
+                if generation != self.generation:
+                    cursor = await conn.execute("SELECT user_id, spot_id FROM favorite_spots")
+                    by_user, by_spot = {}, {}
+                    for user_id, spot_id in await cursor.fetchall():
+                        by_user.setdefault(user_id, set()).add(spot_id)
+                        by_spot.setdefault(spot_id, set()).add(user_id)
+                    self.by_user, self.by_spot = by_user, by_spot
+                    self.generation = generation
+                    favorites_reloads.inc()
+                    favorites_size.set(sum(len(spots) for spots in by_user.values()))
+            self.checked_at = time.monotonic()
+
+    def apply(self, user_id: int, spot_id: int, added: bool, generation: int, changed: int) -> None:
+        """
+        Учитывает запись этого процесса. Если поколение до записи не совпадает
+        с известным индексу, между ними были чужие записи — индекс перечитается.
+        """
+        if self.generation is None:
+            return
+        if added:
+            self.by_user.setdefault(user_id, set()).add(spot_id)
+            self.by_spot.setdefault(spot_id, set()).add(user_id)
+        else:
+            self.by_user.get(user_id, set()).discard(spot_id)
+            self.by_spot.get(spot_id, set()).discard(user_id)
+        if generation - changed == self.generation:
+            self.generation = generation
+        else:
+            self.checked_at = 0.0
+        favorites_size.set(sum(len(spots) for spots in self.by_user.values()))
+
+    async def spots_of(self, user_id: int) -> frozenset:
+        await self._refresh()
+        return frozenset(self.by_user.get(user_id, ()))
+
+    async def followers(self, spot_id: int) -> frozenset:
+        await self._refresh()
+        return frozenset(self.by_spot.get(spot_id, ()))
+
+favorites = FavoritesIndex()
+
+async def _favorites_generation(conn) -> int:
+    cursor = await conn.execute(
+        "SELECT generation FROM change_counters WHERE table_name = 'favorite_spots'"
+    )
+    row = await cursor.fetchone()
+    return row[0] if row else 0
+
 async def add_favorite_spot(user_id: int, spot_id: int) -> None:
     """Добавление спота в избранное"""
     try:
         async with aiosqlite.connect(DB_PATH) as conn:
-            await conn.execute('''
+            cursor = await conn.execute('''
                 INSERT OR IGNORE INTO favorite_spots (user_id, spot_id)
                 VALUES (?, ?)
             ''', (user_id, spot_id))
+            changed = cursor.rowcount
+            generation = await _favorites_generation(conn)
             await conn.commit()
+        favorites.apply(user_id, spot_id, True, generation, changed)
     except Exception as e:
         logger.error(f"Ошибка добавления в избранное: {str(e)}")
         raise
 
 async def get_favorite_spots(user_id: int) -> list:
-    """Получение избранных спотов"""
+    """Получение избранных спотов (из индекса в памяти)"""
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute('''
-                SELECT spot_id FROM favorite_spots WHERE user_id = ?
-            ''', (user_id,))
-            return [row[0] for row in await cursor.fetchall()]
+        return list(await favorites.spots_of(user_id))
     except Exception as e:
         logger.error(f"Ошибка получения избранного: {str(e)}")
         return []
@@ -413,11 +1413,14 @@ async def remove_favorite_spot(user_id: int, spot_id: int) -> None:
     """Удаление из избранного"""
     try:
         async with aiosqlite.connect(DB_PATH) as conn:
-            await conn.execute('''
+            cursor = await conn.execute('''
                 DELETE FROM favorite_spots 
                 WHERE user_id = ? AND spot_id = ?
             ''', (user_id, spot_id))
+            changed = cursor.rowcount
+            generation = await _favorites_generation(conn)
             await conn.commit()
+        favorites.apply(user_id, spot_id, False, generation, changed)
     except Exception as e:
         logger.error(f"Ошибка удаления из избранного: {str(e)}")
         raise
@@ -427,17 +1430,17 @@ async def notify_favorite_users(
     checkin_user_id: int, 
     bot: Bot,
     checkin_type: int,  # Добавляем тип чекина
-    arrival_time: str = None  # Добавляем время прибытия
+    arrival_time: int = None  # Время прибытия, секунды UTC epoch
 ) -> None:
     """Отправляет уведомления в зависимости от типа чекина."""
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute('''
-                SELECT user_id FROM favorite_spots WHERE spot_id = ?
-            ''', (spot_id,))
-            users = [row[0] for row in await cursor.fetchall()]
+        users = [user_id for user_id in await favorites.followers(spot_id) if user_id != checkin_user_id]
+        if not users:
+            return
 
-        checkin_user = await get_user(checkin_user_id)
+        # Профили автора и всех получателей загружаются одним запросом
+        profiles = await get_users(users + [checkin_user_id])
+        checkin_user = profiles.get(checkin_user_id)
         spot = await get_spot_by_id(spot_id)
 
         for user_id in users:
@@ -446,14 +1449,13 @@ async def notify_favorite_users(
             
             # Формируем текст уведомления
             if checkin_type == 1:
-                text = f"🤙 Пользователь {checkin_user['first_name']} отметился на вашем избранном споте: {spot['name']}!"
+                text = f"🤙 Пользователь {checkin_user.first_name} отметился на вашем избранном споте: {spot.name}!"
             elif checkin_type == 2 and arrival_time:
                 # Конвертируем время в локальный часовой пояс получателя
-                user = await get_user(user_id)
-                tz = pytz.timezone(user['timezone'])
-                utc_time = datetime.fromisoformat(arrival_time)
-                local_time = utc_time.astimezone(tz).strftime("%H:%M %d.%m.%Y")
-                text = f"⏱ Пользователь {checkin_user['first_name']} планирует приехать на спот {spot['name']} в {local_time}!"
+                user = profiles.get(user_id)
+                tz = get_tz(user.timezone if user else "UTC")
+                local_time = epoch.to_datetime(arrival_time, tz).strftime("%H:%M %d.%m.%Y")
+                text = f"⏱ Пользователь {checkin_user.first_name} планирует приехать на спот {spot.name} в {local_time}!"
             else:
                 continue
 
@@ -479,7 +1481,7 @@ async def get_checkins_for_spot(spot_id: int) -> tuple:
                 AND c.checkin_type = 1 
                 AND c.active = 1
             ''', (spot_id,))
-            active_users = [{"first_name": row[0]} for row in await cursor.fetchall()]
+            active_users = [Visitor(row[0]) for row in await cursor.fetchall()]
 
             # Планирующие прибытие
             cursor = await conn.execute('''
@@ -490,12 +1492,114 @@ async def get_checkins_for_spot(spot_id: int) -> tuple:
                 AND c.checkin_type = 2 
                 AND c.active = 1
             ''', (spot_id,))
-            arriving = [{"first_name": row[0], "arrival_time": row[1]} for row in await cursor.fetchall()]
+            arriving = [Visitor(*row) for row in await cursor.fetchall()]
 
             return len(active_users), active_users, arriving
     except Exception as e:
         logger.error(f"Ошибка получения статистики: {str(e)}")
         return 0, [], []
     
+async def get_all_spot_versions() -> dict:
+    """Версии данных всех спотов, по которым были чек-ины: {spot_id: version}"""
+    async with aiosqlite.connect(DB_PATH) as conn:
+        cursor = await conn.execute('SELECT spot_id, version FROM spot_versions')
+        return dict(await cursor.fetchall())
+
+# Блок 7: Почасовая занятость спотов
+def _unpack_hours(blob: bytes) -> array:
+    hours = array("I", blob)
+    if sys.byteorder == "big":
+        hours.byteswap()
+    return hours
+
+def _pack_hours(hours: array) -> bytes:
+    if sys.byteorder == "big":
+        hours = array("I", hours)
+        hours.byteswap()
+    return hours.tobytes()
+
+async def get_rollup_watermark(name: str) -> tuple:
+    """Водяной знак агрегата: (closed_at, id) последней учтённой сессии; (0, 0) — ещё не считали"""
+    async with aiosqlite.connect(DB_PATH) as conn:
+        cursor = await conn.execute('''
+            SELECT closed_at, checkin_id FROM rollup_watermarks WHERE name = ?
+        ''', (name,))
+        row = await cursor.fetchone()
+        return tuple(row) if row else (0, 0)
+
+async def get_closed_sessions(after: tuple, until: int, limit: int) -> list:
+    """
+    Закрытые сессии «Я на споте» после водяного знака after=(closed_at, id) и не
+    позже until, по порядку закрытия: (id, spot_id, timestamp, end_time, closed_at).
+    """
+    closed_at, checkin_id = after
+    async with aiosqlite.connect(DB_PATH) as conn:
+        cursor = await conn.execute('''
+            SELECT id, spot_id, timestamp, end_time, closed_at
+            FROM checkins
+            WHERE closed_at IS NOT NULL
+            AND (closed_at > ? OR (closed_at = ? AND id > ?))
+            AND closed_at <= ?
+            AND active = 0 AND checkin_type = 1 AND end_time IS NOT NULL
+            ORDER BY closed_at, id
+            LIMIT ?
+        ''', (closed_at, closed_at, checkin_id, until, limit))
+        return await cursor.fetchall()
+
+async def save_hourly_rollup(name: str, previous: tuple, watermark: tuple, deltas: dict) -> bool:
+    """
+    Прибавляет минуты {spot_id: [168 чисел]} к агрегатам спотов и
+    сдвигает водяной знак в одной транзакции. Если знак уже не previous (пачку
+    учёл другой процесс), ничего не меняет и возвращает False.
+    """
+    async with aiosqlite.connect(DB_PATH) as conn:
+        await conn.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = await conn.execute('''
+                SELECT closed_at, checkin_id FROM rollup_watermarks WHERE name = ?
+            ''', (name,))
+            row = await cursor.fetchone()
+            if (tuple(row) if row else (0, 0)) != tuple(previous):
+                await conn.rollback()
+                return False
+            for spot_id, minutes in deltas.items():
+                cursor = await conn.execute('''
+                    SELECT minutes FROM spot_hourly WHERE spot_id = ?
+                ''', (spot_id,))
+                row = await cursor.fetchone()
+                hours = _unpack_hours(row[0]) if row else array("I", bytes(4 * len(minutes)))
+                for hour, value in enumerate(minutes):
+                    hours[hour] += value
+                # Удалённые споты пропускаются
+                await conn.execute('''
+                    INSERT INTO spot_hourly (spot_id, minutes)
+                    SELECT id, ? FROM spots WHERE id = ?
+                    ON CONFLICT(spot_id) DO UPDATE SET minutes = excluded.minutes
+                ''', (_pack_hours(hours), spot_id))
+            await conn.execute('''
+                INSERT INTO rollup_watermarks (name, closed_at, checkin_id) VALUES (?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET closed_at = excluded.closed_at, checkin_id = excluded.checkin_id
+            ''', (name, *watermark))
+            await conn.commit()
+            return True
+        except Exception:
+            await conn.rollback()
+            raise
+
+async def get_spot_hourly(spot_ids: list) -> dict:
+    """Почасовые агрегаты спотов {spot_id: array}; споты без истории не попадают в результат"""
+    if not spot_ids:
+        return {}
+    try:
+        async with aiosqlite.connect(DB_PATH) as conn:
+            placeholders = ",".join("?" * len(spot_ids))
+            cursor = await conn.execute(f'''
+                SELECT spot_id, minutes FROM spot_hourly WHERE spot_id IN ({placeholders})
+            ''', list(spot_ids))
+            return {spot_id: _unpack_hours(blob) for spot_id, blob in await cursor.fetchall()}
+    except Exception as e:
+        logger.error(f"Ошибка получения почасовой занятости: {str(e)}")
+        return {}
+
 # Инициализация базы данных (вызывается при старте бота)
 # Вызов перенесён в bot.py, так как это асинхронная функция
\ No newline at end of file
@@ -0,0 +1,51 @@
+from typing import Tuple
+
+from aiogram import Bot, Dispatcher
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from middlewares import BotMiddleware, UserLockMiddleware, ThrottlingMiddleware, CallbackAnswerMiddleware, LocationMiddleware
+from handlers.start import start_router
+from handlers.checkin import checkin_router
+from handlers.profile import profile_router
+from handlers.spots import spots_router
+from handlers.weather import weather_router
+
+# (rate, burst) для экранов «споты рядом» и «погода рядом»: не чаще раза в 10 секунд
+HEAVY_SCREEN_LIMIT = (1 / 10, 2)
+
+
+def build_dispatcher(token: str) -> Tuple[Bot, Dispatcher]:
+    """
+    Создаёт Bot и Dispatcher с middleware и роутерами. Роутеры — объекты модулей
+    handlers и подключаются только к одному диспетчеру, поэтому вызывается один
+    раз на процесс: в bot.main() или в процессе-воркере (workers.worker_main).
+    """
+    bot = Bot(token=token)
+    dp = Dispatcher(bot=bot, storage=MemoryStorage())
+    # Callback подтверждается сразу (до ожидания очереди пользователя), а не в конце обработчика
+    callback_answers = CallbackAnswerMiddleware()
+    bot.session.middleware(callback_answers.request_middleware)
+    dp.update.outer_middleware(callback_answers)
+    # Обновления обрабатываются параллельно (задачи polling/вебхука), но для одного пользователя — по очереди
+    dp.update.outer_middleware(UserLockMiddleware())
+    # Каждая присланная геопозиция сохраняется как последняя известная
+    dp.message.outer_middleware(LocationMiddleware())
+    dp.message.middleware(BotMiddleware(bot))
+    dp.callback_query.middleware(BotMiddleware(bot))
+
+    # Ограничения частоты для тяжёлых экранов: каждый их показ — обход каталога
+    # спотов, запросы занятости и до 10 запросов погоды. Экран строится и по новой
+    # геолокации, и по кнопке с сохранённой, поэтому лимит у обоих действий один
+    spots_router.callback_query.middleware(ThrottlingMiddleware("spots_callbacks", limits={"nearby_spots": HEAVY_SCREEN_LIMIT}))
+    spots_router.message.middleware(ThrottlingMiddleware("spots_messages", limits={"location": HEAVY_SCREEN_LIMIT}))
+    weather_router.callback_query.middleware(ThrottlingMiddleware("weather_callbacks", limits={"weather_nearby_spots": HEAVY_SCREEN_LIMIT}))
+    weather_router.message.middleware(ThrottlingMiddleware("weather_messages", limits={"location": HEAVY_SCREEN_LIMIT}))
+    checkin_router.callback_query.middleware(ThrottlingMiddleware("checkin_callbacks", rate=1, burst=5))
+
+    # Подключаем роутеры
+    dp.include_router(start_router)
+    dp.include_router(checkin_router)
+    dp.include_router(profile_router)
+    dp.include_router(spots_router)
+    dp.include_router(weather_router)
+    return bot, dp
@@ -1,21 +1,29 @@
 import logging
-import aiosqlite
-import pytz
-from datetime import datetime, timedelta, timezone
+import math
+import os
+from typing import Optional
 
 from aiogram import Bot, Router, types, F
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from database import DB_PATH, get_spots, add_spot, checkin_user, get_active_checkin, get_spot_by_id, update_checkin_to_arrived, update_spot_name, update_spot_location, delete_spot, checkout_user, get_user, add_or_update_user
+from database import add_spot, checkin_user, get_active_checkin, get_spot_by_id, update_checkin_to_arrived, update_spot_name, update_spot_location, delete_spot, checkout_user, get_user, add_or_update_user
 from keyboards import get_main_keyboard  # Импортируем динамическую клавиатуру
-from database import deactivate_all_checkins, checkin_user, get_user, notify_favorite_users
+from database import deactivate_all_checkins, checkin_user, get_user
+from database import activate_checkin, get_planned_checkin, delete_planned_checkin, delete_unconfirmed_checkin, is_user_admin
+from database import get_spots_by_popularity
+from services import epoch
+from services.geo import location_store, spot_index
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 checkin_router = Router()
 
+# Сколько спотов на одной странице списка выбора спота
+SPOT_PAGE_SIZE = int(os.getenv("SPOT_PAGE_SIZE", "8"))
+
 # Определение состояний для FSM
 class CheckinState(StatesGroup):
     choosing_spot = State()
@@ -31,26 +39,59 @@ class CheckinState(StatesGroup):
 
 # Блок 1: Вспомогательные функции
 async def is_admin(user_id: int) -> bool:
-    """Проверяет, является ли пользователь админом."""
-    user = await get_user(user_id)  # Добавляем await
-    if user:
-        result = user["is_admin"]
-        logging.info(f"Проверка: пользователь {user_id} является админом? {result}")
-        return result
-    return False
-
-def create_spot_keyboard(spots: list, is_admin: bool) -> InlineKeyboardMarkup:
-    """Создаёт клавиатуру со списком спотов, с дополнительными кнопками для админа."""
+    """Проверяет, является ли пользователь админом (по множеству ID в памяти)."""
+    return await is_user_admin(user_id)
+
+def _parse_cursor(cursor: str, kind: str) -> tuple:
+    """Ключ страницы из callback_data вида "<kind>:<число>:<id>"; None — с начала списка."""
+    if not cursor or not cursor.startswith(kind + ":"):
+        return None
+    try:
+        value, spot_id = cursor[len(kind) + 1:].split(":")
+        return int(value), int(spot_id)
+    except ValueError:
+        return None
+
+async def create_spot_keyboard(user_id: int, cursor: str = None) -> Optional[InlineKeyboardMarkup]:
+    """
+    Страница списка спотов с дополнительными кнопками для админа.
+
+    Если известна последняя геопозиция пользователя, споты идут по расстоянию
+    (сеточный индекс), иначе — по популярности (индекс в БД). cursor — ключ
+    последнего спота предыдущей страницы, поэтому размер клавиатуры и стоимость
+    запроса не зависят от размера каталога. None — спотов нет совсем.
+    """
+    location = await location_store.get(user_id, max_age=math.inf)
+    if location:
+        await spot_index.refresh()
+        page = spot_index.page(*location, after=_parse_cursor(cursor, "d"), limit=SPOT_PAGE_SIZE + 1)
+        entries = [(spot, f"{spot.name} · {distance:.1f} км") for key, spot, distance in page]
+        next_cursor = "d:%d:%d" % page[SPOT_PAGE_SIZE - 1][0] if len(page) > SPOT_PAGE_SIZE else None
+    else:
+        page = await get_spots_by_popularity(_parse_cursor(cursor, "p"), SPOT_PAGE_SIZE + 1)
+        entries = [(spot, spot.name) for spot in page]
+        next_cursor = f"p:{page[SPOT_PAGE_SIZE - 1].popularity}:{page[SPOT_PAGE_SIZE - 1].id}" if len(page) > SPOT_PAGE_SIZE else None
+    if not entries and not cursor:
+        return None
+
+    admin = await is_admin(user_id)
     keyboard = []
-    for spot in spots:
-        spot_buttons = [InlineKeyboardButton(text=spot["name"], callback_data=f"spot_{spot['id']}")]
-        if is_admin:
-            spot_buttons.append(InlineKeyboardButton(text="✏️", callback_data=f"edit_spot_{spot['id']}"))
-            spot_buttons.append(InlineKeyboardButton(text="🗑️", callback_data=f"delete_spot_{spot['id']}"))
+    for spot, title in entries[:SPOT_PAGE_SIZE]:
+        spot_buttons = [InlineKeyboardButton(text=title, callback_data=f"spot_{spot.id}")]
+        if admin:
+            spot_buttons.append(InlineKeyboardButton(text="✏️", callback_data=f"edit_spot_{spot.id}"))
+            spot_buttons.append(InlineKeyboardButton(text="🗑️", callback_data=f"delete_spot_{spot.id}"))
         keyboard.append(spot_buttons)
+    navigation = []
+    if cursor:
+        navigation.append(InlineKeyboardButton(text="⏮ В начало", callback_data="spots_page"))
+    if next_cursor:
+        navigation.append(InlineKeyboardButton(text="Ещё ▶️", callback_data=f"spots_page:{next_cursor}"))
+    if navigation:
+        keyboard.append(navigation)
     # Добавляем кнопки "Добавить спот" и "Назад в меню"
     keyboard.append([InlineKeyboardButton(text="➕ Добавить новый спот", callback_data="add_spot")])
-    keyboard.append([InlineKeyboardButton(text="⬅️ Назад в меню", callback_data="back_to_menu")])  # Новая кнопка
+    keyboard.append([InlineKeyboardButton(text="⬅️ Назад в меню", callback_data="back_to_menu")])
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 def create_checkin_type_keyboard() -> InlineKeyboardMarkup:
@@ -107,10 +148,9 @@ async def process_checkin(callback: types.CallbackQuery, state: FSMContext):
         )
     
     logging.info(f"Пользователь {user_id} нажал на Чек-ин (callback)")
-    spots = await get_spots() or []  # Добавляем await
+    keyboard = await create_spot_keyboard(user_id)
 
-    if spots:
-        keyboard = create_spot_keyboard(spots, await is_admin(user_id))  # Добавляем await для is_admin
+    if keyboard:
         await callback.message.answer("Выберите спот:", reply_markup=keyboard)
         await state.set_state(CheckinState.choosing_spot)
     else:
@@ -124,6 +164,22 @@ async def process_checkin(callback: types.CallbackQuery, state: FSMContext):
         await state.set_state(CheckinState.adding_spot)
     await callback.answer()
 
+@checkin_router.callback_query(F.data.startswith("spots_page"))
+async def spot_list_page(callback: types.CallbackQuery, state: FSMContext):
+    """Листание списка спотов: меняется только клавиатура того же сообщения."""
+    cursor = callback.data.partition(":")[2] or None
+    keyboard = await create_spot_keyboard(callback.from_user.id, cursor)
+    if keyboard is None:
+        await callback.answer("❌ Споты не найдены.", show_alert=True)
+        return
+    try:
+        await callback.message.edit_reply_markup(reply_markup=keyboard)
+    except TelegramBadRequest as e:
+        # Клавиатура не изменилась (повторное нажатие) — ничего страшного
+        logger.warning(f"⚠️ Не удалось обновить список спотов: {e}")
+    await state.set_state(CheckinState.choosing_spot)
+    await callback.answer()
+
 @checkin_router.callback_query(F.data.startswith("spot_"))
 async def select_checkin_type(callback: types.CallbackQuery, state: FSMContext):
     """Пользователь выбрал спот, показываем карту и запрашиваем тип действия в одном сообщении."""
@@ -137,11 +193,11 @@ async def select_checkin_type(callback: types.CallbackQuery, state: FSMContext):
     await state.set_state(CheckinState.selecting_checkin_type)
 
     # Отправляем карту спота
-    await callback.message.answer_location(latitude=spot["lat"], longitude=spot["lon"])
+    await callback.message.answer_location(latitude=spot.lat, longitude=spot.lon)
 
     # Отправляем сообщение о выборе спота с клавиатурой
     keyboard = create_checkin_type_keyboard()
-    await callback.message.answer(f"Вы выбрали спот: {spot['name']}\nВыберите действие:", reply_markup=keyboard)
+    await callback.message.answer(f"Вы выбрали спот: {spot.name}\nВыберите действие:", reply_markup=keyboard)
 
     await state.update_data(spot_id=spot_id)
     await state.set_state(CheckinState.selecting_checkin_type)
@@ -160,7 +216,7 @@ async def checkin_type_1(callback: types.CallbackQuery, state: FSMContext, bot:
         return
     
     try:
-        checkin_id = await checkin_user(user_id, spot_id, checkin_type=1, bot=bot)
+        checkin_id = await checkin_user(user_id, spot_id, checkin_type=1)
         if not checkin_id:
             raise ValueError("Checkin ID not returned")
             
@@ -205,31 +261,10 @@ async def process_duration(callback: types.CallbackQuery, state: FSMContext, bot
     duration_hours = int(callback.data.split("_")[1])
     
     try:
-        now = datetime.now(pytz.utc)
-        end_time = (now + timedelta(hours=duration_hours)).isoformat()
-        
-        async with aiosqlite.connect(DB_PATH) as conn:
-            await conn.execute('''
-                UPDATE checkins 
-                SET 
-                    active = 1,
-                    end_time = ?,
-                    duration_hours = ?,
-                    timestamp = ?
-                WHERE id = ?
-            ''', (end_time, duration_hours, now.isoformat(), checkin_id))
-            await conn.commit()
-            logger.info(f"Чек-ин {checkin_id} активирован для типа 1, active=1")
+        # Подписчики спота получат уведомление по событию Arrived
+        await activate_checkin(checkin_id, duration_hours)
 
         spot = await get_spot_by_id(data["spot_id"])
-        if bot:
-            await notify_favorite_users(
-                spot_id=spot["id"],
-                checkin_user_id=user_id,
-                bot=bot,
-                checkin_type=1,
-                arrival_time=None
-            )
 
         keyboard = InlineKeyboardMarkup(
             inline_keyboard=[
@@ -238,7 +273,7 @@ async def process_duration(callback: types.CallbackQuery, state: FSMContext, bot
             ]
         )
         await callback.message.edit_text(
-            f"\u2705 Вы отметились на споте '{spot['name']}'! 🌊",
+            f"\u2705 Вы отметились на споте '{spot.name}'! 🌊",
             reply_markup=keyboard
         )
 
@@ -253,20 +288,18 @@ async def process_duration(callback: types.CallbackQuery, state: FSMContext, bot
 async def process_arrival_time(callback: types.CallbackQuery, state: FSMContext, bot: Bot):
     """Обрабатываем время прибытия и выполняем чек-ин."""
     arrival_str = callback.data.split("_")[1]
-    now = datetime.now(timezone.utc)  # Aware-объект в UTC
-    
-    arrival_time = (now + timedelta(hours=int(arrival_str))).isoformat()
+    arrival_time = epoch.after_hours(int(arrival_str))
 
     data = await state.get_data()
     spot_id = data["spot_id"]
     user_id = callback.from_user.id
 
     # Выполняем чек-ин с типом "Планирую приехать"
-    await checkin_user(user_id, spot_id, checkin_type=2, arrival_time=arrival_time, bot=bot)
+    await checkin_user(user_id, spot_id, checkin_type=2, arrival_time=arrival_time)
 
     # Получаем информацию о споте для отображения на карте
     spot = await get_spot_by_id(spot_id)
-    await callback.message.edit_text(f"\u2705 Вы запланировали приезд на спот '{spot['name']}'! 🌊")
+    await callback.message.edit_text(f"\u2705 Вы запланировали приезд на спот '{spot.name}'! 🌊")
     
     # Клавиатура для подтверждения прибытия
     keyboard = InlineKeyboardMarkup(
@@ -286,7 +319,7 @@ async def confirm_arrival(callback: types.CallbackQuery, state: FSMContext):
     active_checkin = await get_active_checkin(user_id)
     logger.info(f"Пользователь {user_id} нажал 'Я приехал!'. Активный чек-ин: {active_checkin}")
 
-    if not active_checkin or active_checkin["checkin_type"] != 2:
+    if not active_checkin or active_checkin.checkin_type != 2:
         await callback.message.edit_text("❌ Нет активного планирования приезда.")
         keyboard = InlineKeyboardMarkup(
             inline_keyboard=[
@@ -298,7 +331,7 @@ async def confirm_arrival(callback: types.CallbackQuery, state: FSMContext):
         await callback.answer()
         return
 
-    await state.update_data(checkin_id=active_checkin["id"], spot_id=active_checkin["spot_id"])
+    await state.update_data(checkin_id=active_checkin.id, spot_id=active_checkin.spot_id)
     await state.set_state(CheckinState.setting_duration)
     logger.info(f"Установлено состояние CheckinState.setting_duration для пользователя {user_id}, данные: {await state.get_data()}")
 
@@ -325,40 +358,16 @@ async def process_arrival_duration(callback: types.CallbackQuery, state: FSMCont
         await callback.answer()
         return
 
-    now = datetime.now(pytz.utc)
-    end_time = now + timedelta(hours=duration_hours)
-    logger.info(f"Параметры обновления чек-ина {checkin_id}: timestamp={now.isoformat()}, end_time={end_time.isoformat()}")
-
-    async with aiosqlite.connect(DB_PATH) as conn:
-        try:
-            await conn.execute('''
-                UPDATE checkins 
-                SET 
-                    checkin_type = 1,
-                    timestamp = ?,
-                    duration_hours = ?,
-                    end_time = ?,
-                    arrival_time = NULL,
-                    active = 1
-                WHERE id = ?
-            ''', (now.isoformat(), duration_hours, end_time.isoformat(), checkin_id))
-            await conn.commit()
-            logger.info(f"Чек-ин {checkin_id} успешно обновлен: checkin_type=1, arrival_time=NULL, active=1")
-        except Exception as e:
-            logger.error(f"Ошибка при обновлении чек-ина {checkin_id}: {str(e)}")
-            await callback.message.edit_text("❌ Ошибка при обновлении чек-ина.")
-            await state.clear()
-            await callback.answer()
-            return
+    try:
+        await update_checkin_to_arrived(checkin_id, duration_hours)
+    except Exception as e:
+        logger.error(f"Ошибка при обновлении чек-ина {checkin_id}: {str(e)}")
+        await callback.message.edit_text("❌ Ошибка при обновлении чек-ина.")
+        await state.clear()
+        await callback.answer()
+        return
 
     spot = await get_spot_by_id(spot_id)
-    await notify_favorite_users(
-        spot_id=spot_id,
-        checkin_user_id=callback.from_user.id,
-        bot=bot,
-        checkin_type=1,
-        arrival_time=None
-    )
 
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
@@ -367,7 +376,7 @@ async def process_arrival_duration(callback: types.CallbackQuery, state: FSMCont
         ]
     )
     await callback.message.edit_text(
-        f"\u2705 Вы прибыли и отметились на споте '{spot['name']}'! 🌊",
+        f"\u2705 Вы прибыли и отметились на споте '{spot.name}'! 🌊",
         reply_markup=keyboard
     )
 
@@ -384,27 +393,12 @@ async def cancel_checkin(callback: types.CallbackQuery, state: FSMContext):
 
     # Удаляем запись, если она существует и end_time не задан
     if checkin_id:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.cursor()
-            # Проверяем, есть ли запись без end_time
-            await cursor.execute("""
-                SELECT id FROM checkins 
-                WHERE 
-                    id = ? 
-                    AND end_time IS NULL 
-                    AND active = 0
-            """, (checkin_id,))
-            result = await cursor.fetchone()
-            
-            if result:
-                await cursor.execute("DELETE FROM checkins WHERE id = ?", (checkin_id,))
-                await conn.commit()
-                logger.info(f"Удалена временная запись чекина {checkin_id} для пользователя {user_id}")
+        if await delete_unconfirmed_checkin(checkin_id):
+            logger.info(f"Удалена временная запись чекина {checkin_id} для пользователя {user_id}")
 
     # Возвращаемся к выбору спота
-    spots = await get_spots() or []
-    if spots:
-        keyboard = create_spot_keyboard(spots, await is_admin(user_id))
+    keyboard = await create_spot_keyboard(user_id)
+    if keyboard:
         await callback.message.edit_text("Выберите спот:", reply_markup=keyboard)
         await state.set_state(CheckinState.choosing_spot)
     else:
@@ -428,15 +422,14 @@ async def plan_to_arrive(callback: types.CallbackQuery, state: FSMContext):
     
     if not spot_id:
         await callback.message.answer("❌ Спот не выбран. Пожалуйста, выберите спот сначала.")
-        spots = await get_spots() or []
-        keyboard = create_spot_keyboard(spots, await is_admin(callback.from_user.id))
+        keyboard = await create_spot_keyboard(callback.from_user.id)
         await callback.message.answer("Выберите спот:", reply_markup=keyboard)
         await state.set_state(CheckinState.choosing_spot)
         await callback.answer()
         return
 
     spot = await get_spot_by_id(spot_id)
-    await callback.message.edit_text(f"Вы выбрали спот: {spot['name']}\nКогда вы планируете приехать?")
+    await callback.message.edit_text(f"Вы выбрали спот: {spot.name}\nКогда вы планируете приехать?")
     keyboard = create_arrival_time_keyboard()
     await callback.message.answer("Выберите время прибытия:", reply_markup=keyboard)
     await state.set_state(CheckinState.setting_arrival_time)
@@ -449,24 +442,16 @@ async def handle_late_arrival(callback: types.CallbackQuery, state: FSMContext):
     checkin_id = int(callback.data.split("_")[3])  # Извлекаем checkin_id из callback_data
     logger.info(f"Обработка late_arrival_confirm для пользователя {user_id}, checkin_id={checkin_id}")
     
-    async with aiosqlite.connect(DB_PATH) as conn:
-        cursor = await conn.cursor()
-        await cursor.execute("""
-            SELECT id, spot_id 
-            FROM checkins 
-            WHERE id = ? AND user_id = ? AND checkin_type = 2
-        """, (checkin_id, user_id))
-        result = await cursor.fetchone()
-        
-        if not result:
-            logger.warning(f"Не найдена запись чек-ина с id={checkin_id} для пользователя {user_id}")
-            await callback.message.edit_text("❌ Не удалось найти данные о вашем прибытии. Возможно, запись устарела.")
-            await state.clear()
-            await callback.answer()
-            return
-        
-        checkin_id, spot_id = result
-        logger.info(f"Найден чек-ин {checkin_id} для пользователя {user_id} на споте {spot_id}")
+    planned = await get_planned_checkin(checkin_id, user_id)
+    if not planned:
+        logger.warning(f"Не найдена запись чек-ина с id={checkin_id} для пользователя {user_id}")
+        await callback.message.edit_text("❌ Не удалось найти данные о вашем прибытии. Возможно, запись устарела.")
+        await state.clear()
+        await callback.answer()
+        return
+
+    checkin_id, spot_id = planned.id, planned.spot_id
+    logger.info(f"Найден чек-ин {checkin_id} для пользователя {user_id} на споте {spot_id}")
     
     # Сохраняем данные в состояние
     await state.update_data(checkin_id=checkin_id, spot_id=spot_id)
@@ -492,16 +477,15 @@ async def edit_spot(callback: types.CallbackQuery, state: FSMContext):
         return
 
     spot_id = int(callback.data.split("_")[2])
-    spots = await get_spots()  # Добавляем await
-    spot = next((s for s in spots if s["id"] == spot_id), None)
+    spot = await get_spot_by_id(spot_id)
     if not spot:
         await callback.message.answer("❌ Спот не найден.")
         await state.clear()
         return
 
     await state.update_data(spot_id=spot_id)
-    await callback.message.answer(f"Текущая геолокация спота '{spot['name']}':")
-    await callback.message.answer_location(latitude=spot["lat"], longitude=spot["lon"])
+    await callback.message.answer(f"Текущая геолокация спота '{spot.name}':")
+    await callback.message.answer_location(latitude=spot.lat, longitude=spot.lon)
     
     keyboard = ReplyKeyboardMarkup(
         keyboard=[[KeyboardButton(text="📍 Отправить новую геолокацию", request_location=True)]],
@@ -607,9 +591,8 @@ async def delete_spot_handler(callback: types.CallbackQuery, state: FSMContext):
 async def cancel_delete_spot(callback: types.CallbackQuery, state: FSMContext):
     """Отмена удаления спота."""
     user_id = callback.from_user.id
-    spots = await get_spots() or []  # Добавляем await
-    if spots:
-        keyboard = create_spot_keyboard(spots, await is_admin(user_id))  # Добавляем await для is_admin
+    keyboard = await create_spot_keyboard(user_id)
+    if keyboard:
         await callback.message.edit_text("Выберите спот для чекаина:", reply_markup=keyboard)
         await state.set_state(CheckinState.choosing_spot)
     else:
@@ -630,21 +613,10 @@ async def cancel_late_arrival(callback: types.CallbackQuery, state: FSMContext):
     checkin_id = int(callback.data.split("_")[3])  # Извлекаем checkin_id из callback_data
     logger.info(f"Обработка cancel_late_arrival для пользователя {user_id}, checkin_id={checkin_id}")
     
-    async with aiosqlite.connect(DB_PATH) as conn:
-        cursor = await conn.cursor()
-        await cursor.execute("""
-            SELECT id 
-            FROM checkins 
-            WHERE id = ? AND user_id = ? AND checkin_type = 2
-        """, (checkin_id, user_id))
-        result = await cursor.fetchone()
-        
-        if result:
-            await cursor.execute("DELETE FROM checkins WHERE id = ?", (checkin_id,))
-            await conn.commit()
-            logger.info(f"Чек-ин {checkin_id} удалён для пользователя {user_id}")
-        else:
-            logger.warning(f"Не найдена запись чек-ина с id={checkin_id} для пользователя {user_id}")
+    if await delete_planned_checkin(checkin_id, user_id):
+        logger.info(f"Чек-ин {checkin_id} удалён для пользователя {user_id}")
+    else:
+        logger.warning(f"Не найдена запись чек-ина с id={checkin_id} для пользователя {user_id}")
     
     await callback.message.edit_text("❌ Вы отменили прибытие на спот.")
     keyboard = InlineKeyboardMarkup(
@@ -739,12 +711,12 @@ async def handle_new_spot_checkin(callback: types.CallbackQuery, state: FSMConte
         
     # Показываем карту спота
     spot = await get_spot_by_id(spot_id)
-    await callback.message.answer_location(latitude=spot["lat"], longitude=spot["lon"])
+    await callback.message.answer_location(latitude=spot.lat, longitude=spot.lon)
     
     # Запускаем стандартный процесс выбора типа чекина
     keyboard = create_checkin_type_keyboard()
     await callback.message.answer(
-        f"Вы создали спот: {spot['name']}\nВыберите действие:", 
+        f"Вы создали спот: {spot.name}\nВыберите действие:", 
         reply_markup=keyboard
     )
     await state.set_state(CheckinState.selecting_checkin_type)
@@ -785,9 +757,9 @@ async def process_uncheckin(callback: types.CallbackQuery, state: FSMContext):
         return
 
     # Разчекиниваем пользователя
-    await checkout_user(active_checkin["id"])  # Добавляем await
-    spot = await get_spot_by_id(active_checkin["spot_id"])  # Добавляем await
-    await callback.message.edit_text(f"\u2705 Вы покинули спот '{spot['name']}'! 🚪")
+    await checkout_user(active_checkin.id)  # Добавляем await
+    spot = await get_spot_by_id(active_checkin.spot_id)  # Добавляем await
+    await callback.message.edit_text(f"\u2705 Вы покинули спот '{spot.name}'! 🚪")
     
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
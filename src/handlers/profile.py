@@ -1,64 +1,101 @@
 import logging
+import os
 from datetime import datetime, timedelta
+from typing import Optional
 
 from aiogram import Router, types, F
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from database import get_user, get_active_checkin, get_spots, get_checkins_for_user, get_favorite_spots, add_favorite_spot, remove_favorite_spot, get_spot_by_id
+from database import get_user, get_user_stats, get_spots_by_popularity, add_favorite_spot, remove_favorite_spot, favorites
 from keyboards import get_main_keyboard
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 profile_router = Router()
 
+# Сколько спотов на одной странице управления избранным
+FAVORITES_PAGE_SIZE = int(os.getenv("FAVORITES_PAGE_SIZE", "8"))
+ADD_SUFFIX = " (добавить в избранное)"
+REMOVE_SUFFIX = " (удалить из избранного)"
+
 # Определение состояний для FSM
 class ProfileState(StatesGroup):
     managing_favorites = State()
 
 # Блок 1: Вспомогательные функции
-async def create_favorite_spots_keyboard(user_id: int, spots: list) -> InlineKeyboardMarkup:
-    """Создаёт клавиатуру со списком спотов для управления избранным."""
-    keyboard = []
-    favorite_spots = await get_favorite_spots(user_id)
-    favorite_spot_ids = set(favorite_spots)  # Исправлено: работаем с списком int
-
-    for spot in spots:
-        spot_id = spot["id"]
-        if spot_id in favorite_spot_ids:
-            button_text = f"{spot['name']} (удалить из избранного)"
-            callback_data = f"remove_favorite_{spot_id}"
-        else:
-            button_text = f"{spot['name']} (добавить в избранное)"
-            callback_data = f"add_favorite_{spot_id}"
-        keyboard.append([InlineKeyboardButton(text=button_text, callback_data=callback_data)])
+def favorite_button(spot_id: int, name: str, is_favorite: bool) -> InlineKeyboardButton:
+    """Кнопка спота в списке избранного: добавить или удалить."""
+    if is_favorite:
+        return InlineKeyboardButton(text=f"{name}{REMOVE_SUFFIX}", callback_data=f"remove_favorite_{spot_id}")
+    return InlineKeyboardButton(text=f"{name}{ADD_SUFFIX}", callback_data=f"add_favorite_{spot_id}")
+
+async def create_favorite_spots_keyboard(user_id: int, cursor: str = None) -> Optional[InlineKeyboardMarkup]:
+    """
+    Страница списка спотов для управления избранным (по популярности, по ключу
+    последнего спота предыдущей страницы). None — в базе нет спотов.
+    """
+    after = None
+    if cursor:
+        try:
+            popularity, spot_id = cursor.split(":")
+            after = (int(popularity), int(spot_id))
+        except ValueError:
+            after = None
+    page = await get_spots_by_popularity(after, FAVORITES_PAGE_SIZE + 1)
+    if not page and not cursor:
+        return None
+
+    favorite_spot_ids = await favorites.spots_of(user_id)
+    keyboard = [
+        [favorite_button(spot.id, spot.name, spot.id in favorite_spot_ids)]
+        for spot in page[:FAVORITES_PAGE_SIZE]
+    ]
+    navigation = []
+    if cursor:
+        navigation.append(InlineKeyboardButton(text="⏮ В начало", callback_data="favorites_page"))
+    if len(page) > FAVORITES_PAGE_SIZE:
+        last = page[FAVORITES_PAGE_SIZE - 1]
+        navigation.append(InlineKeyboardButton(text="Ещё ▶️", callback_data=f"favorites_page:{last.popularity}:{last.id}"))
+    if navigation:
+        keyboard.append(navigation)
     keyboard.append([InlineKeyboardButton(text="⬅️ Назад в профиль", callback_data="back_to_profile")])
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
-# Блок 2: Обработчики профиля (остальные функции без изменений)
-@profile_router.callback_query(F.data == "profile")
-async def show_profile(callback: types.CallbackQuery, state: FSMContext):
-    user_id = callback.from_user.id
-    user = await get_user(user_id)
-    if not user:
-        await callback.message.answer("❌ Пользователь не найден. Попробуйте перезапустить бота с помощью /start.")
-        await callback.answer()
-        return
-
-    checkins = await get_checkins_for_user(user_id)
-    total_time_hours = sum(checkin["duration_hours"] or 0 for checkin in checkins)
+def patch_favorite_button(markup: InlineKeyboardMarkup, spot_id: int, is_favorite: bool) -> Optional[InlineKeyboardMarkup]:
+    """Копия клавиатуры, в которой заменена только кнопка спота; None — кнопки нет."""
+    targets = {f"add_favorite_{spot_id}", f"remove_favorite_{spot_id}"}
+    rows = []
+    found = False
+    for row in markup.inline_keyboard:
+        new_row = []
+        for button in row:
+            if button.callback_data in targets:
+                name = button.text.removesuffix(ADD_SUFFIX).removesuffix(REMOVE_SUFFIX)
+                button = favorite_button(spot_id, name, is_favorite)
+                found = True
+            new_row.append(button)
+        rows.append(new_row)
+    return InlineKeyboardMarkup(inline_keyboard=rows) if found else None
+
+async def build_profile(user) -> tuple:
+    """Текст и клавиатура профиля; статистика читается одной строкой из user_stats."""
+    stats = await get_user_stats(user.user_id)
 
-    active_checkin = await get_active_checkin(user_id)
     active_spot_text = "Нет активного чек-ина."
-    if active_checkin:
-        spot = await get_spot_by_id(active_checkin["spot_id"])
-        active_spot_text = f"Вы сейчас на споте: {spot['name']}"
+    if stats.active_spot_name:
+        active_spot_text = f"Вы сейчас на споте: {stats.active_spot_name}"
+    favorite_spot_text = ""
+    if stats.favorite_spot_name:
+        favorite_spot_text = f"Любимый спот: {stats.favorite_spot_name}\n"
 
     profile_text = (
-        f"👤 Профиль пользователя {user['first_name']}:\n\n"
+        f"👤 Профиль пользователя {user.first_name}:\n\n"
         f"📊 Статистика:\n"
-        f"Всего чек-инов: {len(checkins)}\n"
-        f"Общее время на спотах: {total_time_hours:.1f} часов\n\n"
+        f"Всего чек-инов: {stats.checkins}\n"
+        f"Общее время на спотах: {stats.total_hours:.1f} часов\n"
+        f"{favorite_spot_text}\n"
         f"📍 Текущий спот:\n{active_spot_text}\n\n"
         f"⭐ Управление избранными спотами:"
     )
@@ -69,15 +106,28 @@ async def show_profile(callback: types.CallbackQuery, state: FSMContext):
             [InlineKeyboardButton(text="⬅️ Назад в меню", callback_data="back_to_menu")]
         ]
     )
+    return profile_text, keyboard
+
+# Блок 2: Обработчики профиля (остальные функции без изменений)
+@profile_router.callback_query(F.data == "profile")
+async def show_profile(callback: types.CallbackQuery, state: FSMContext):
+    user_id = callback.from_user.id
+    user = await get_user(user_id)
+    if not user:
+        await callback.message.answer("❌ Пользователь не найден. Попробуйте перезапустить бота с помощью /start.")
+        await callback.answer()
+        return
+
+    profile_text, keyboard = await build_profile(user)
     await callback.message.edit_text(profile_text, reply_markup=keyboard)
     await callback.answer()
 
 @profile_router.callback_query(F.data == "manage_favorites")
 async def manage_favorite_spots(callback: types.CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
-    spots = await get_spots() or []
+    keyboard = await create_favorite_spots_keyboard(user_id)
 
-    if not spots:
+    if keyboard is None:
         await callback.message.edit_text("❌ В базе нет спотов для добавления в избранное.")
         keyboard = InlineKeyboardMarkup(
             inline_keyboard=[
@@ -89,11 +139,39 @@ async def manage_favorite_spots(callback: types.CallbackQuery, state: FSMContext
         await callback.answer()
         return
 
-    keyboard = await create_favorite_spots_keyboard(user_id, spots)
     await callback.message.edit_text("Выберите спот для управления избранным:", reply_markup=keyboard)
     await state.set_state(ProfileState.managing_favorites)
     await callback.answer()
 
+@profile_router.callback_query(F.data.startswith("favorites_page"))
+async def favorite_spots_page(callback: types.CallbackQuery, state: FSMContext):
+    """Листание списка избранного: меняется только клавиатура того же сообщения."""
+    cursor = callback.data.partition(":")[2] or None
+    keyboard = await create_favorite_spots_keyboard(callback.from_user.id, cursor)
+    if keyboard is None:
+        await callback.answer("❌ В базе нет спотов.", show_alert=True)
+        return
+    await _edit_favorites_markup(callback, keyboard)
+    await state.set_state(ProfileState.managing_favorites)
+    await callback.answer()
+
+async def _edit_favorites_markup(callback: types.CallbackQuery, keyboard: InlineKeyboardMarkup) -> None:
+    try:
+        await callback.message.edit_reply_markup(reply_markup=keyboard)
+    except TelegramBadRequest as e:
+        # Клавиатура не изменилась (повторное нажатие) — ничего страшного
+        logging.warning(f"⚠️ Не удалось обновить список избранного: {e}")
+
+async def _toggle_favorite(callback: types.CallbackQuery, spot_id: int, is_favorite: bool) -> None:
+    """Меняет одну кнопку спота в текущей клавиатуре, не перечитывая список спотов."""
+    keyboard = None
+    if callback.message.reply_markup:
+        keyboard = patch_favorite_button(callback.message.reply_markup, spot_id, is_favorite)
+    if keyboard is None:
+        keyboard = await create_favorite_spots_keyboard(callback.from_user.id)
+    if keyboard is not None:
+        await _edit_favorites_markup(callback, keyboard)
+
 @profile_router.callback_query(F.data.startswith("add_favorite_"))
 async def add_favorite_spot_handler(callback: types.CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
@@ -106,10 +184,8 @@ async def add_favorite_spot_handler(callback: types.CallbackQuery, state: FSMCon
         await callback.answer("❌ Не удалось добавить в избранное")
         return
 
-    spots = await get_spots() or []
-    keyboard = await create_favorite_spots_keyboard(user_id, spots)
-    await callback.message.edit_text("Спот добавлен в избранное! Выберите другой спот или вернитесь в профиль:", reply_markup=keyboard)
-    await callback.answer()
+    await _toggle_favorite(callback, spot_id, True)
+    await callback.answer("⭐ Спот добавлен в избранное!")
 
 @profile_router.callback_query(F.data.startswith("remove_favorite_"))
 async def remove_favorite_spot_handler(callback: types.CallbackQuery, state: FSMContext):
@@ -123,51 +199,20 @@ async def remove_favorite_spot_handler(callback: types.CallbackQuery, state: FSM
         await callback.answer("❌ Не удалось удалить из избранного")
         return
 
-    spots = await get_spots() or []
-    keyboard = await create_favorite_spots_keyboard(user_id, spots)
-    await callback.message.edit_text("Спот удалён из избранного! Выберите другой спот или вернитесь в профиль:", reply_markup=keyboard)
-    await callback.answer()
+    await _toggle_favorite(callback, spot_id, False)
+    await callback.answer("Спот удалён из избранного")
 
 @profile_router.callback_query(F.data == "back_to_profile")
 async def back_to_profile(callback: types.CallbackQuery, state: FSMContext):
     """Возвращает пользователя в профиль из управления избранным."""
     user_id = callback.from_user.id
-    user = await get_user(user_id)  # Добавляем await
+    user = await get_user(user_id)
     if not user:
         await callback.message.answer("❌ Пользователь не найден. Попробуйте перезапустить бота с помощью /start.")
         await callback.answer()
         return
 
-    # Получаем статистику чек-инов
-    checkins = await get_checkins_for_user(user_id)  # Добавляем await
-    total_time_hours = 0
-    for checkin in checkins:
-        if checkin["duration_hours"]:
-            total_time_hours += checkin["duration_hours"]
-
-    # Получаем текущий активный спот
-    active_checkin = await get_active_checkin(user_id)  # Добавляем await
-    active_spot_text = "Нет активного чек-ина."
-    if active_checkin:
-        spot = await get_spot_by_id(active_checkin["spot_id"])  # Добавляем await
-        active_spot_text = f"Вы сейчас на споте: {spot['name']}"
-
-    # Формируем текст профиля
-    profile_text = (
-        f"👤 Профиль пользователя {user['first_name']}:\n\n"
-        f"📊 Статистика:\n"
-        f"Всего чек-инов: {len(checkins)}\n"
-        f"Общее время на спотах: {total_time_hours:.1f} часов\n\n"
-        f"📍 Текущий спот:\n{active_spot_text}\n\n"
-        f"⭐ Управление избранными спотами:"
-    )
-
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="⭐ Управлять избранными спотами", callback_data="manage_favorites")],
-            [InlineKeyboardButton(text="⬅️ Назад в меню", callback_data="back_to_menu")]
-        ]
-    )
+    profile_text, keyboard = await build_profile(user)
     await callback.message.edit_text(profile_text, reply_markup=keyboard)
     await state.clear()
     await callback.answer()
@@ -177,6 +222,6 @@ async def back_to_menu(callback: types.CallbackQuery, state: FSMContext):
     """Возвращает пользователя в главное меню."""
     user_id = callback.from_user.id
     await callback.message.delete()
-    await callback.message.answer("Вы вернулись в главное меню.", reply_markup=get_main_keyboard(user_id))
+    await callback.message.answer("Вы вернулись в главное меню.", reply_markup=await get_main_keyboard(user_id))
     await state.clear()
     await callback.answer()
\ No newline at end of file
@@ -1,15 +1,19 @@
 import logging
 import math
 from datetime import datetime, timedelta
-from timezonefinder import TimezoneFinder
 import pytz
 
 from aiogram import Router, types, F, Bot
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from database import get_spots, get_spot_by_id, get_active_checkin, get_checkins_for_spot, checkin_user, get_user, add_or_update_user
-from services.weather import get_open_meteo_forecast as get_windy_forecast, wind_direction_to_text
+from database import get_spots, get_spot_by_id, get_active_checkin, checkin_user, get_user, add_or_update_user
+from cards import cards
+from screens import render_spots
+from services import epoch
+from services.geo import location_store
+from services.occupancy import occupancy
+from services.timezones import get_tz, user_timezone_at
 
 logging.basicConfig(level=logging.INFO)
 spots_router = Router()
@@ -37,11 +41,16 @@ def create_arrival_time_keyboard() -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text="⬅️ Отмена", callback_data="cancel_checkin")]
     ])
 
-tf = TimezoneFinder()
-
-@spots_router.callback_query(F.data == "nearby_spots")
+@spots_router.callback_query(F.data.in_({"nearby_spots", "nearby_spots_new_location"}))
 async def request_location_for_nearby_spots(callback: types.CallbackQuery, state: FSMContext):
-    """Запрашиваем геолокацию для поиска ближайших спотов."""
+    """Показываем споты рядом с недавней геолокацией или запрашиваем её."""
+    location = await location_store.get(callback.from_user.id)
+    if location and callback.data == "nearby_spots":
+        await callback.message.edit_text("📍 Ищу активные споты рядом с вашей последней геолокацией...")
+        await show_active_spots(callback.message, state, callback.from_user, *location)
+        await callback.answer()
+        return
+
     keyboard = ReplyKeyboardMarkup(
         keyboard=[[KeyboardButton(text="📍 Отправить геолокацию", request_location=True)]],
         resize_keyboard=True,
@@ -54,24 +63,26 @@ async def request_location_for_nearby_spots(callback: types.CallbackQuery, state
 
 @spots_router.message(NearbySpotsState.waiting_for_location, F.location)
 async def process_location_for_nearby_spots(message: types.Message, state: FSMContext):
-    """Обрабатываем геолокацию и показываем до 5 спотов с активными чек-инами."""
-    user_id = message.from_user.id
-    user_lat = message.location.latitude
-    user_lon = message.location.longitude
-
-    timezone_name = tf.timezone_at(lat=user_lat, lng=user_lon) or "UTC"
-    user_timezone = pytz.timezone(timezone_name)
+    """Обрабатываем геолокацию (её уже сохранил LocationMiddleware) и показываем активные споты."""
+    await show_active_spots(message, state, message.from_user, message.location.latitude, message.location.longitude)
 
+async def show_active_spots(message: types.Message, state: FSMContext, from_user: types.User, user_lat: float, user_lon: float):
+    """Показываем до 5 ближайших спотов с активными чек-инами."""
+    user_id = from_user.id
+    # Пояс из профиля, пока пользователь в той же ячейке сетки; новый сохраняется в профиле
     user = await get_user(user_id)
-    await add_or_update_user(
-        user_id=user_id,
-        first_name=message.from_user.first_name,
-        last_name=message.from_user.last_name,
-        username=message.from_user.username,
-        timezone=timezone_name
-    )
+    timezone_name = await user_timezone_at(user, user_lat, user_lon)
+    user_timezone = get_tz(timezone_name)
+    if not user:
+        await add_or_update_user(
+            user_id=user_id,
+            first_name=from_user.first_name,
+            last_name=from_user.last_name,
+            username=from_user.username,
+            timezone=timezone_name
+        )
 
-    spots = await get_spots() or []
+    spots = await get_spots()
     if not spots:
         await message.answer("❌ Похоже, в базе нет спотов.", reply_markup=ReplyKeyboardRemove())
         keyboard = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="⬅️ Назад в меню", callback_data="back_to_menu")]])
@@ -79,12 +90,15 @@ async def process_location_for_nearby_spots(message: types.Message, state: FSMCo
         await state.clear()
         return
 
+    # Активные споты и их карточки берутся из модели занятости в памяти
+    active_ids = await occupancy.active_spot_ids()
+    spot_cards = await cards.get_many([spot_id for spot_id in spots.ids if spot_id in active_ids])
     active_spots = []
-    for spot in spots:
-        active_count, active_users, arriving_users = await get_checkins_for_spot(spot["id"])
-        if active_count > 0 or len(arriving_users) > 0:
-            distance = haversine_distance(user_lat, user_lon, spot["lat"], spot["lon"])
-            active_spots.append((spot, distance))
+    for i, spot_id in enumerate(spots.ids):
+        card = spot_cards.get(spot_id)
+        if card is not None and card.active:
+            distance = haversine_distance(user_lat, user_lon, spots.lats[i], spots.lons[i])
+            active_spots.append((spots[i], distance, card))
 
     nearest_active_spots = sorted(active_spots, key=lambda x: x[1])[:5]
 
@@ -103,54 +117,22 @@ async def process_location_for_nearby_spots(message: types.Message, state: FSMCo
         await state.clear()
         return
 
-    response = "🔍 **Активные споты:**\n\n"
-    for spot, distance in nearest_active_spots:
-        active_count, active_users, arriving_users = await get_checkins_for_spot(spot["id"])
-        on_spot_names = ", ".join(user["first_name"] for user in active_users) if active_users else "никого"
-
-        arriving_info = "нет"
-        if arriving_users:
-            arriving_info_list = []
-            for user in arriving_users:
-                arrival_time_str = user["arrival_time"]
-                if "T" not in arrival_time_str:
-                    arrival_time_str = f"{datetime.utcnow().date()}T{arrival_time_str}+00:00"
-                utc_time = datetime.fromisoformat(arrival_time_str.replace("Z", "+00:00"))
-                local_time = utc_time.replace(tzinfo=pytz.utc).astimezone(user_timezone)
-                arriving_info_list.append(f"{user['first_name']} ({local_time.strftime('%H:%M')})")
-            arriving_info = ", ".join(arriving_info_list)
-
-        wind_data = await get_windy_forecast(spot["lat"], spot["lon"])
-        wind_info = "🌬 *Ветер:* Данные недоступны."
-        temp_info = "🌡 *Температура:* Данные недоступны."
-        if wind_data:
-            wind_speed = wind_data["speed"]
-            wind_direction = wind_data["direction"]
-            wind_gusts = wind_data.get("gusts")  # Добавляем получение порывов
-            direction_text = wind_direction_to_text(wind_direction)
-            wind_info = f"🌬 *Ветер:* {wind_speed:.1f} м/с, {direction_text} ({wind_direction:.0f}°)"
-            if wind_gusts is not None:
-                wind_info += f", порывы до {wind_gusts:.1f} м/с"  # Добавляем порывы в вывод
-            if "water_temperature" in wind_data and wind_data["water_temperature"] is not None:
-                temp_info = f"🌡 *Вода:* {wind_data['water_temperature']:.1f} °C"
-
-        response += (
-            f"🏄‍♂️ **{spot['name']}**\n"
-            f"📍 *Расстояние:* {distance:.2f} км\n"
-            f"{wind_info}\n"
-            f"{temp_info}\n"
-            f"👥 *На месте:* {active_count} чел. ({on_spot_names})\n"
-            f"⏳ *Приедут:* {len(arriving_users)} чел. ({arriving_info})\n\n"
-        )
-
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
-            [InlineKeyboardButton(text=f"🏄‍♂️ Собираюсь на {spot['name']}", callback_data=f"plan_to_arrive_{spot['id']}")]
-            for spot, distance in nearest_active_spots
-        ] + [[InlineKeyboardButton(text="⬅️ Назад в меню", callback_data="back_to_menu")]]
+            [InlineKeyboardButton(text=f"🏄‍♂️ Собираюсь на {spot.name}", callback_data=f"plan_to_arrive_{spot.id}")]
+            for spot, distance, card in nearest_active_spots
+        ] + [
+            [InlineKeyboardButton(text="📍 Обновить геолокацию", callback_data="nearby_spots_new_location")],
+            [InlineKeyboardButton(text="⬅️ Назад в меню", callback_data="back_to_menu")]
+        ]
     )
 
-    await message.answer(response, parse_mode="Markdown", reply_markup=ReplyKeyboardRemove())
+    if message.location:
+        # Кнопку «Отправить геолокацию» убираем отдельным сообщением: список ниже
+        # правится по мере прихода погоды, а сообщения с reply-клавиатурой не правятся
+        await message.answer("📍 Геолокация получена.", reply_markup=ReplyKeyboardRemove())
+    # Занятость из БД показываем сразу, погода дорисовывается по мере ответа сервиса
+    await render_spots(message, "🔍 **Активные споты:**\n\n", nearest_active_spots, user_timezone)
     await message.answer("Выберите действие:", reply_markup=keyboard)
     await state.clear()
 
@@ -176,7 +158,7 @@ async def plan_to_arrive(callback: types.CallbackQuery, state: FSMContext):
         return
 
     await state.update_data(spot_id=spot_id)
-    await callback.message.edit_text(f"Вы выбрали спот: {spot['name']}\nКогда вы планируете приехать?")
+    await callback.message.edit_text(f"Вы выбрали спот: {spot.name}\nКогда вы планируете приехать?")
     keyboard = create_arrival_time_keyboard()
     await callback.message.answer("Выберите время прибытия:", reply_markup=keyboard)
     await state.set_state(NearbySpotsState.setting_arrival_time)
@@ -189,7 +171,7 @@ async def process_arrival_time(callback: types.CallbackQuery, state: FSMContext,
     now = datetime.utcnow().replace(tzinfo=pytz.utc)
 
     if arrival_str in ["1", "2", "3"]:
-        arrival_time = (now + timedelta(hours=int(arrival_str))).isoformat()
+        arrival_time = epoch.after_hours(int(arrival_str))
     else:
         try:
             target_hour, target_minute = map(int, arrival_str.split(":"))
@@ -207,16 +189,16 @@ async def process_arrival_time(callback: types.CallbackQuery, state: FSMContext,
         ).replace(tzinfo=pytz.utc)
         if target_time < now:
             target_time += timedelta(days=1)
-        arrival_time = target_time.isoformat()
+        arrival_time = epoch.to_epoch(target_time)
 
     data = await state.get_data()
     spot_id = data["spot_id"]
     user_id = callback.from_user.id
 
-    # Удаляем параметр bot=bot из вызова функции checkin_user
+    # Подписчиков спота уведомит обработчик события CheckinCreated
     await checkin_user(user_id, spot_id, checkin_type=2, arrival_time=arrival_time)
     spot = await get_spot_by_id(spot_id)
-    await callback.message.edit_text(f"✅ Вы запланировали приезд на спот '{spot['name']}'! 🌊")
+    await callback.message.edit_text(f"✅ Вы запланировали приезд на спот '{spot.name}'! 🌊")
 
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
@@ -1,15 +1,16 @@
 import logging
 import math
-from datetime import datetime, timedelta
-from timezonefinder import TimezoneFinder
-import pytz
 
 from aiogram import Router, types, F
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from database import get_spots, get_spot_by_id, get_checkins_for_spot, checkin_user
-from services.weather import get_open_meteo_forecast as get_windy_forecast, wind_direction_to_text
+from database import get_spots, get_spot_by_id, checkin_user, get_user
+from cards import cards
+from screens import render_spots
+from services import epoch
+from services.geo import location_store
+from services.timezones import get_tz, user_timezone_at
 
 logging.basicConfig(level=logging.INFO)
 weather_router = Router()
@@ -40,12 +41,16 @@ def create_arrival_time_keyboard() -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text="⬅️ Отмена", callback_data="cancel_checkin")]
     ])
 
-# Инициализация TimezoneFinder
-tf = TimezoneFinder()
-
-@weather_router.callback_query(F.data == "weather_nearby_spots")
+@weather_router.callback_query(F.data.in_({"weather_nearby_spots", "weather_nearby_spots_new_location"}))
 async def request_location_for_weather_spots(callback: types.CallbackQuery, state: FSMContext):
-    """Запрашиваем геолокацию для поиска ближайших спотов."""
+    """Показываем погоду рядом с недавней геолокацией или запрашиваем её."""
+    location = await location_store.get(callback.from_user.id)
+    if location and callback.data == "weather_nearby_spots":
+        await callback.message.edit_text("📍 Показываю споты рядом с вашей последней геолокацией...")
+        await show_weather_spots(callback.message, state, callback.from_user.id, *location)
+        await callback.answer()
+        return
+
     keyboard = ReplyKeyboardMarkup(
         keyboard=[[KeyboardButton(text="📍 Отправить геолокацию", request_location=True)]],
         resize_keyboard=True,
@@ -58,14 +63,16 @@ async def request_location_for_weather_spots(callback: types.CallbackQuery, stat
 
 @weather_router.message(WeatherSpotsState.waiting_for_location, F.location)
 async def process_location_for_weather_spots(message: types.Message, state: FSMContext):
-    """Обрабатываем геолокацию и показываем 5 ближайших спотов с погодой."""
-    user_lat = message.location.latitude
-    user_lon = message.location.longitude
+    """Обрабатываем геолокацию (её уже сохранил LocationMiddleware) и показываем ближайшие споты."""
+    await show_weather_spots(message, state, message.from_user.id, message.location.latitude, message.location.longitude)
 
-    timezone_name = tf.timezone_at(lat=user_lat, lng=user_lon) or "UTC"
-    user_timezone = pytz.timezone(timezone_name)
+async def show_weather_spots(message: types.Message, state: FSMContext, user_id: int, user_lat: float, user_lon: float):
+    """Показываем 5 ближайших спотов с погодой."""
+    # Пояс из профиля, пока пользователь в той же ячейке сетки; новый сохраняется в профиле
+    timezone_name = await user_timezone_at(await get_user(user_id), user_lat, user_lon)
+    user_timezone = get_tz(timezone_name)
 
-    spots = await get_spots() or []
+    spots = await get_spots()
     if not spots:
         await message.answer("❌ Похоже, в базе нет спотов.", reply_markup=ReplyKeyboardRemove())
         keyboard = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="⬅️ Назад в меню", callback_data="back_to_menu")]])
@@ -73,57 +80,29 @@ async def process_location_for_weather_spots(message: types.Message, state: FSMC
         await state.clear()
         return
 
-    distances = [(spot, haversine_distance(user_lat, user_lon, spot["lat"], spot["lon"])) for spot in spots]
-    nearest_spots = sorted(distances, key=lambda x: x[1])[:5]
-
-    response = "🌤️ **Ближайшие споты:**\n\n"
-    for spot, distance in nearest_spots:
-        on_spot_count, on_spot_users, arriving_users = await get_checkins_for_spot(spot["id"])
-        on_spot_names = ", ".join(user["first_name"] for user in on_spot_users) if on_spot_users else "никого"
-
-        arriving_info = "нет"
-        if arriving_users:
-            arriving_info_list = []
-            for user in arriving_users:
-                arrival_time_str = user["arrival_time"]
-                if "T" not in arrival_time_str:
-                    arrival_time_str = f"{datetime.utcnow().date()}T{arrival_time_str}+00:00"
-                utc_time = datetime.fromisoformat(arrival_time_str.replace("Z", "+00:00"))
-                local_time = utc_time.replace(tzinfo=pytz.utc).astimezone(user_timezone)
-                arriving_info_list.append(f"{user['first_name']} ({local_time.strftime('%H:%M')})")
-            arriving_info = ", ".join(arriving_info_list)
-
-        wind_data = await get_windy_forecast(spot["lat"], spot["lon"])
-        wind_info = "🌬 *Ветер:* Данные недоступны."
-        water_info = "🌡 *Вода:* Данные недоступны."
-        if wind_data:
-            wind_speed = wind_data["speed"]
-            wind_direction = wind_data["direction"]
-            wind_gusts = wind_data.get("gusts")
-            direction_text = wind_direction_to_text(wind_direction)
-            wind_info = f"🌬 *Ветер:* {wind_speed:.1f} м/с, {direction_text} ({wind_direction:.0f}°)"
-            if wind_gusts is not None:
-                wind_info += f", порывы до {wind_gusts:.1f} м/с"
-            if "water_temperature" in wind_data and wind_data["water_temperature"] is not None:
-                water_info = f"🌡 *Вода:* {wind_data['water_temperature']:.1f} °C"
-
-        response += (
-            f"🏄‍♂️ **{spot['name']}**\n"
-            f"📍 *Расстояние:* {distance:.2f} км\n"
-            f"{wind_info}\n"
-            f"{water_info}\n"
-            f"👥 *На месте:* {on_spot_count} чел. ({on_spot_names})\n"
-            f"⏳ *Приедут:* {len(arriving_users)} чел. ({arriving_info})\n\n"
-        )
+    # Расстояния считаются по столбцам каталога; строки Spot нужны только пяти ближайшим
+    distances = [(i, haversine_distance(user_lat, user_lon, lat, lon)) for i, (lat, lon) in enumerate(zip(spots.lats, spots.lons))]
+    nearest_spots = [(spots[i], distance) for i, distance in sorted(distances, key=lambda x: x[1])[:5]]
+
+    spot_cards = await cards.get_many([spot.id for spot, distance in nearest_spots])
+    entries = [(spot, distance, spot_cards[spot.id]) for spot, distance in nearest_spots]
 
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
-            [InlineKeyboardButton(text=f"🏄‍♂️ Собираюсь на {spot['name']}", callback_data=f"weather_plan_to_arrive_{spot['id']}")]
+            [InlineKeyboardButton(text=f"🏄‍♂️ Собираюсь на {spot.name}", callback_data=f"weather_plan_to_arrive_{spot.id}")]
             for spot, distance in nearest_spots
-        ] + [[InlineKeyboardButton(text="⬅️ Назад в меню", callback_data="back_to_menu")]]
+        ] + [
+            [InlineKeyboardButton(text="📍 Обновить геолокацию", callback_data="weather_nearby_spots_new_location")],
+            [InlineKeyboardButton(text="⬅️ Назад в меню", callback_data="back_to_menu")]
+        ]
     )
 
-    await message.answer(response, parse_mode="Markdown", reply_markup=ReplyKeyboardRemove())
+    if message.location:
+        # Кнопку «Отправить геолокацию» убираем отдельным сообщением: список ниже
+        # правится по мере прихода погоды, а сообщения с reply-клавиатурой не правятся
+        await message.answer("📍 Геолокация получена.", reply_markup=ReplyKeyboardRemove())
+    # Занятость из БД показываем сразу, погода дорисовывается по мере ответа сервиса
+    await render_spots(message, "🌤️ **Ближайшие споты:**\n\n", entries, user_timezone)
     await message.answer("Выберите действие:", reply_markup=keyboard)
     await state.clear()
 
@@ -149,7 +128,7 @@ async def weather_plan_to_arrive(callback: types.CallbackQuery, state: FSMContex
         return
 
     await state.update_data(spot_id=spot_id)
-    await callback.message.edit_text(f"Вы выбрали спот: {spot['name']}\nКогда вы планируете приехать?")
+    await callback.message.edit_text(f"Вы выбрали спот: {spot.name}\nКогда вы планируете приехать?")
     keyboard = create_arrival_time_keyboard()
     await callback.message.answer("Выберите время прибытия:", reply_markup=keyboard)
     await state.set_state(WeatherSpotsState.setting_arrival_time)
@@ -159,10 +138,8 @@ async def weather_plan_to_arrive(callback: types.CallbackQuery, state: FSMContex
 async def weather_process_arrival_time(callback: types.CallbackQuery, state: FSMContext):
     """Обрабатываем время прибытия и регистрируем чек-ин в weather_router."""
     arrival_str = callback.data.split("_")[1]
-    now = datetime.utcnow().replace(tzinfo=pytz.utc)
-
     if arrival_str in ["1", "2", "3"]:
-        arrival_time = (now + timedelta(hours=int(arrival_str))).isoformat()
+        arrival_time = epoch.after_hours(int(arrival_str))
     else:
         await callback.answer("❌ Некорректный формат времени.")
         return
@@ -173,7 +150,7 @@ async def weather_process_arrival_time(callback: types.CallbackQuery, state: FSM
 
     await checkin_user(user_id, spot_id, checkin_type=2, arrival_time=arrival_time)
     spot = await get_spot_by_id(spot_id)
-    await callback.message.edit_text(f"✅ Вы запланировали приезд на спот '{spot['name']}'! 🌊")
+    await callback.message.edit_text(f"✅ Вы запланировали приезд на спот '{spot.name}'! 🌊")
 
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
@@ -1,28 +1,147 @@
+import asyncio
+import logging
+import math
+import os
+import time
+from collections import OrderedDict
+
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from database import get_active_checkin, get_spots
+from database import get_active_checkin, has_spots, get_generation
+from services.events import bus, CheckinEvent, SpotChanged
+from services.metrics import counter
 
-async def get_main_keyboard(user_id: int) -> InlineKeyboardMarkup:
-    """Генерирует динамическую клавиатуру в зависимости от состояния пользователя."""
+logger = logging.getLogger(__name__)
+
+# Сколько состояний меню пользователей держим в памяти
+MENU_CACHE_SIZE = int(os.getenv("MENU_CACHE_SIZE", "10000"))
+# Как часто проверять изменения каталога спотов, сделанные другими процессами (сек)
+MENU_WATCH_INTERVAL = float(os.getenv("MENU_WATCH_INTERVAL", "5"))
+
+menu_hits = counter("menu_cache_hits_total", "Главное меню построено без обращения к БД")
+menu_misses = counter("menu_cache_misses_total", "Главное меню потребовало чтения состояния из БД")
+
+
+class MenuState:
+    """Тип активного чек-ина пользователя (None — нет) и момент, до которого он заведомо верен."""
+    __slots__ = ("checkin_type", "valid_until")
+
+    def __init__(self, checkin_type, valid_until: float):
+        self.checkin_type = checkin_type
+        self.valid_until = valid_until
+
+
+# user_id -> MenuState
+_menu_states: "OrderedDict[int, MenuState]" = OrderedDict()
+# Есть ли в каталоге споты; None — неизвестно
+_catalog_non_empty = None
+# (тип чек-ина, есть ли споты) -> готовая клавиатура
+_markups = {}
+_watch_task = None
+
+
+def _state_from_checkin(active_checkin) -> MenuState:
+    """
+    Состояние меню по активному чек-ину. Планировщик меняет его только по времени:
+    чек-ин на споте истекает после end_time, план приезда — после arrival_time,
+    поэтому до этого момента состояние можно не перечитывать (даже если задачи
+    планировщика выполняет другой процесс).
+    """
+    if not active_checkin:
+        return MenuState(None, math.inf)
+    checkin_type = active_checkin.checkin_type
+    deadline = active_checkin.end_time if checkin_type == 1 else active_checkin.arrival_time
+    return MenuState(checkin_type, math.inf if deadline is None else deadline)
+
+
+def _on_checkin(event: CheckinEvent) -> None:
+    """Чек-ин пользователя изменился в этом процессе: его состояние меню перечитается."""
+    _menu_states.pop(event.user_id, None)
+
+
+def _on_spot(event: SpotChanged) -> None:
+    global _catalog_non_empty
+    _catalog_non_empty = None
+    if event.removed:
+        # Удаление спота удаляет и чек-ины на нём
+        _menu_states.clear()
+
+
+bus.subscribe(CheckinEvent, _on_checkin)
+bus.subscribe(SpotChanged, _on_spot)
+
+
+def _build_markup(checkin_type, catalog_non_empty: bool) -> InlineKeyboardMarkup:
     # Базовые кнопки, которые всегда видны
     buttons = [
         [InlineKeyboardButton(text="📍 Отметиться на споте", callback_data="checkin")],
         [InlineKeyboardButton(text="👤 Профиль", callback_data="profile")]
     ]
 
-    # Проверяем, есть ли активный чек-ин
-    active_checkin = await get_active_checkin(user_id)
-    if active_checkin:
-        if active_checkin["checkin_type"] == 1:
-            # Если пользователь уже на споте
-            buttons.append([InlineKeyboardButton(text="🚪 Покинуть спот", callback_data="uncheckin")])
-        elif active_checkin["checkin_type"] == 2:
-            # Если пользователь запланировал приезд
-            buttons.append([InlineKeyboardButton(text="✅ Я приехал", callback_data="confirm_arrival")])
-
-    # Проверяем, есть ли споты в базе, и добавляем кнопки
-    spots = await get_spots()
-    if spots:
+    if checkin_type == 1:
+        # Если пользователь уже на споте
+        buttons.append([InlineKeyboardButton(text="🚪 Покинуть спот", callback_data="uncheckin")])
+    elif checkin_type == 2:
+        # Если пользователь запланировал приезд
+        buttons.append([InlineKeyboardButton(text="✅ Я приехал", callback_data="confirm_arrival")])
+
+    # Если в базе есть споты, добавляем кнопки поиска
+    if catalog_non_empty:
         buttons.append([InlineKeyboardButton(text="🔍 Кто на спотах", callback_data="nearby_spots")])
         buttons.append([InlineKeyboardButton(text="🌤️ Ближайшие споты", callback_data="weather_nearby_spots")])
 
-    return InlineKeyboardMarkup(inline_keyboard=buttons)
\ No newline at end of file
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+async def get_main_keyboard(user_id: int) -> InlineKeyboardMarkup:
+    """
+    Генерирует динамическую клавиатуру в зависимости от состояния пользователя.
+
+    Состояние пользователя и признак непустого каталога кешируются, а сама
+    клавиатура строится один раз на каждое сочетание, поэтому повторный
+    возврат в меню не обращается к БД.
+    """
+    global _catalog_non_empty
+    state = _menu_states.get(user_id)
+    if state is not None and time.time() < state.valid_until:
+        _menu_states.move_to_end(user_id)
+        menu_hits.inc()
+    else:
+        menu_misses.inc()
+        state = _state_from_checkin(await get_active_checkin(user_id))
+        _menu_states[user_id] = state
+        if len(_menu_states) > MENU_CACHE_SIZE:
+            _menu_states.popitem(last=False)
+
+    if _catalog_non_empty is None:
+        _catalog_non_empty = await has_spots()
+
+    key = (state.checkin_type, _catalog_non_empty)
+    markup = _markups.get(key)
+    if markup is None:
+        markup = _markups[key] = _build_markup(*key)
+    return markup
+
+
+async def watch_catalog(interval: float = MENU_WATCH_INTERVAL) -> None:
+    """
+    Следит за поколением таблицы spots: при нескольких воркерах каталог могут
+    менять другие процессы (админ добавил или удалил спот вместе с чек-инами).
+    """
+    global _catalog_non_empty
+    spots_generation = await get_generation("spots")
+    while True:
+        await asyncio.sleep(interval)
+        current = await get_generation("spots")
+        if current != spots_generation:
+            spots_generation = current
+            _catalog_non_empty = None
+            # Удаление спота удаляет и чек-ины на нём
+            _menu_states.clear()
+            logger.info("🔄 Каталог спотов изменился, кеш главного меню сброшен")
+
+
+def start_menu_watcher() -> asyncio.Task:
+    """Запускает фоновую проверку каталога в текущем цикле событий."""
+    global _watch_task
+    _watch_task = asyncio.create_task(watch_catalog())
+    return _watch_task
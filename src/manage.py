@@ -0,0 +1,36 @@
+import argparse
+import asyncio
+import logging
+
+from database import DB_PATH, init_db, rebuild_user_stats
+from services.backup import BACKUP_DIR, restore_backup
+
+logging.basicConfig(level=logging.INFO)
+
+
+def main():
+    """Служебные команды бота: python src/manage.py <команда>."""
+    parser = argparse.ArgumentParser(description="Служебные команды бота")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    restore = commands.add_parser("restore-backup", help="Восстановить БД из инкрементальных бэкапов")
+    restore.add_argument("target", nargs="?", default=DB_PATH, help="Куда записать восстановленную БД")
+    restore.add_argument("--backup-dir", default=BACKUP_DIR, help="Каталог с бэкапами")
+
+    commands.add_parser("rebuild-stats", help="Пересчитать статистику пользователей по истории чек-инов")
+
+    args = parser.parse_args()
+    if args.command == "restore-backup":
+        restore_backup(args.target, args.backup_dir)
+    elif args.command == "rebuild-stats":
+        asyncio.run(_rebuild_stats())
+
+
+async def _rebuild_stats():
+    await init_db()
+    users = await rebuild_user_stats()
+    logging.info(f"📊 Статистика пересчитана для {users} пользователей")
+
+
+if __name__ == "__main__":
+    main()
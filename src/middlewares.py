@@ -1,6 +1,29 @@
+import asyncio
+import logging
+import os
+import re
+import time
+
 from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.methods import AnswerCallbackQuery, Response
 from aiogram.types import CallbackQuery, Message
 
+from services.geo import location_store
+from services.metrics import counter, gauge, histogram
+
+logger = logging.getLogger(__name__)
+
+# Через сколько секунд callback подтверждается автоматически, если обработчик не ответил сам
+CALLBACK_ANSWER_BUDGET = float(os.getenv("CALLBACK_ANSWER_BUDGET", "0.25"))
+
+callback_answer_latency = histogram("callback_answer_seconds", "Время от получения callback до ответа Telegram")
+callback_auto_answered = counter("callback_auto_answered_total", "Callback, подтверждённые автоматически по истечении бюджета")
+callback_late_answers = counter("callback_late_answers_total", "Ответы обработчиков с текстом после автоподтверждения (отправлены сообщением)")
+
+user_lock_wait = histogram("user_lock_wait_seconds", "Ожидание обработки предыдущих обновлений того же пользователя")
+user_locks_active = gauge("user_locks_active", "Пользователи, у которых сейчас обрабатываются обновления")
+
 class BotMiddleware(BaseMiddleware):
     """Middleware для передачи объекта bot в обработчики."""
     def __init__(self, bot):
@@ -9,4 +32,254 @@ class BotMiddleware(BaseMiddleware):
 
     async def __call__(self, handler, event, data):
         data["bot"] = self.bot
-        return await handler(event, data)
\ No newline at end of file
+        return await handler(event, data)
+
+class LocationMiddleware(BaseMiddleware):
+    """
+    Запоминает геопозицию из любого сообщения до обработчиков, чтобы экраны
+    «рядом со мной» и список спотов могли обойтись без повторного запроса.
+    Регистрируется как outer-middleware сообщений.
+    """
+    def __init__(self, store=None):
+        super().__init__()
+        self.store = store or location_store
+
+    async def __call__(self, handler, event, data):
+        if isinstance(event, Message) and event.location and event.from_user:
+            await self.store.remember(event.from_user.id, event.location.latitude, event.location.longitude)
+        return await handler(event, data)
+
+class UserLockMiddleware(BaseMiddleware):
+    """
+    Обрабатывает обновления одного пользователя строго по очереди, а разных
+    пользователей — параллельно. Защищает цепочки «прочитать FSM → обновить БД»
+    (например, двойное нажатие на кнопку длительности) от гонок.
+    Регистрируется как outer-middleware на уровне update.
+    """
+    def __init__(self):
+        super().__init__()
+        # user_id -> [блокировка, число ожидающих и выполняющихся обновлений]
+        self._locks = {}
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+
+        entry = self._locks.get(user.id)
+        if entry is None:
+            # asyncio.Lock выдаёт блокировку в порядке очереди, поэтому порядок обновлений сохраняется
+            entry = self._locks[user.id] = [asyncio.Lock(), 0]
+            user_locks_active.inc()
+        entry[1] += 1
+        started = time.perf_counter()
+        try:
+            async with entry[0]:
+                user_lock_wait.observe(time.perf_counter() - started)
+                return await handler(event, data)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[user.id]
+                user_locks_active.dec()
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Ограничивает частоту действий пользователя корзинами токенов (на пользователя и действие)
+    и отбрасывает повторные нажатия той же кнопки в течение dedup_window секунд.
+    Подключается к роутеру: router.callback_query.middleware(...) / router.message.middleware(...).
+
+    Args:
+        name: Имя для метрик (обычно имя роутера)
+        rate: Пополнение токенов в секунду по умолчанию
+        burst: Ёмкость корзины по умолчанию
+        limits: Переопределения {действие: (rate, burst)}
+        dedup_window: Окно, в котором одинаковый callback_data считается повтором
+    """
+    # Сколько вызовов между очистками заполненных корзин
+    CLEANUP_EVERY = 1000
+
+    def __init__(
+        self,
+        name: str,
+        rate: float = 0.5,
+        burst: int = 3,
+        limits: dict = None,
+        dedup_window: float = 1.5,
+        notice: str = "⏳ Слишком часто. Подождите немного и попробуйте снова."
+    ):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.limits = limits or {}
+        self.dedup_window = dedup_window
+        self.notice = notice
+        # (user_id, действие) -> [токены, время последнего пополнения]
+        self._buckets = {}
+        # user_id -> (callback_data, время нажатия)
+        self._last_callback = {}
+        self._calls = 0
+        self.dropped = counter(f"throttle_{name}_dropped_total", f"Действия, отброшенные лимитом частоты ({name})")
+        self.duplicates = counter(f"throttle_{name}_duplicates_total", f"Повторные нажатия, отброшенные ({name})")
+
+    @staticmethod
+    def action_for(event) -> str:
+        """
+        Действие для лимита: префикс callback_data до «:» без числовых ID или тип
+        сообщения. Курсоры страниц (spots_page:p:12:34) не создают отдельных корзин.
+        """
+        if isinstance(event, CallbackQuery):
+            return re.sub(r"_?\d+$", "", (event.data or "").split(":", 1)[0])
+        if isinstance(event, Message):
+            return event.content_type
+        return type(event).__name__
+
+    def _allow(self, key, action: str, now: float) -> bool:
+        rate, burst = self.limits.get(action, (self.rate, self.burst))
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            self._buckets[key] = [burst - 1, now]
+            return True
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return True
+        return False
+
+    def _cleanup(self, now: float) -> None:
+        """Удаляет корзины, которые уже полностью восстановились, и старые нажатия."""
+        for key, (tokens, updated) in list(self._buckets.items()):
+            rate, burst = self.limits.get(key[1], (self.rate, self.burst))
+            if tokens + (now - updated) * rate >= burst:
+                del self._buckets[key]
+        for user_id, (_, pressed) in list(self._last_callback.items()):
+            if now - pressed > self.dedup_window:
+                del self._last_callback[user_id]
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+
+        now = time.monotonic()
+        self._calls += 1
+        if self._calls % self.CLEANUP_EVERY == 0:
+            self._cleanup(now)
+
+        if isinstance(event, CallbackQuery):
+            last = self._last_callback.get(user.id)
+            # Окно считается от принятого нажатия: повторы его не продлевают
+            if last and last[0] == event.data and now - last[1] < self.dedup_window:
+                self.duplicates.inc()
+                # Повторное нажатие: только гасим «часики» на кнопке
+                await event.answer()
+                return None
+
+        action = self.action_for(event)
+        if not self._allow((user.id, action), action, now):
+            self.dropped.inc()
+            # Для callback — всплывающее уведомление, для сообщения — ответ в чат
+            await event.answer(self.notice)
+            return None
+        if isinstance(event, CallbackQuery):
+            self._last_callback[user.id] = (event.data, now)
+        return await handler(event, data)
+
+class _CallbackState:
+    __slots__ = ("received", "answered", "answering", "chat_id")
+
+    def __init__(self, received: float, chat_id):
+        self.received = received
+        # Telegram принял ответ на callback
+        self.answered = False
+        # Запрос ответа, который отправляется сейчас (asyncio.Future), иначе None
+        self.answering = None
+        self.chat_id = chat_id
+
+class _AnswerCallbackInterceptor(BaseRequestMiddleware):
+    """
+    Middleware сессии бота: пропускает только первый ответ на каждый callback.
+    Пока ответ отправляется, следующие ждут его результата; callback считается
+    подтверждённым только после успешного запроса, и ответ, завершившийся
+    ошибкой, не мешает отправить следующий.
+    """
+    def __init__(self, owner: "CallbackAnswerMiddleware"):
+        self.owner = owner
+
+    async def __call__(self, make_request, bot, method):
+        if not isinstance(method, AnswerCallbackQuery):
+            return await make_request(bot, method)
+        state = self.owner.pending.get(method.callback_query_id)
+        if state is None:
+            return await make_request(bot, method)
+        while state.answering is not None:
+            await asyncio.shield(state.answering)
+        if state.answered:
+            # Callback уже подтверждён: всплывающее уведомление показать нельзя,
+            # поэтому текст ответа доставляем обычным сообщением
+            if method.text and state.chat_id is not None:
+                callback_late_answers.inc()
+                await bot.send_message(chat_id=state.chat_id, text=method.text)
+            return Response(ok=True, result=True)
+        state.answering = asyncio.get_running_loop().create_future()
+        try:
+            response = await make_request(bot, method)
+            state.answered = True
+            callback_answer_latency.observe(time.perf_counter() - state.received)
+            return response
+        finally:
+            state.answering.set_result(None)
+            state.answering = None
+
+class CallbackAnswerMiddleware(BaseMiddleware):
+    """
+    Подтверждает callback-запросы, не дожидаясь конца обработчика: если обработчик
+    не вызвал callback.answer() за budget секунд, ответ отправляется автоматически,
+    и клиент Telegram перестаёт показывать «часики». Ранние ответы обработчиков
+    (в том числе show_alert) проходят как обычно, повторные — гасятся.
+
+    Подключение:
+        dp.update.outer_middleware(middleware)
+        bot.session.middleware(middleware.request_middleware)
+    """
+    def __init__(self, budget: float = CALLBACK_ANSWER_BUDGET):
+        super().__init__()
+        self.budget = budget
+        # callback_query_id -> _CallbackState для обрабатываемых сейчас запросов
+        self.pending = {}
+        self.request_middleware = _AnswerCallbackInterceptor(self)
+
+    async def _answer(self, query_id: str, bot) -> None:
+        state = self.pending.get(query_id)
+        if state is None or state.answered:
+            return
+        try:
+            await bot(AnswerCallbackQuery(callback_query_id=query_id))
+        except Exception as e:
+            logger.warning(f"Не удалось подтвердить callback {query_id}: {e}")
+
+    async def _answer_after_budget(self, query_id: str, bot) -> None:
+        await asyncio.sleep(self.budget)
+        state = self.pending.get(query_id)
+        if state is not None and not state.answered:
+            callback_auto_answered.inc()
+            # Обработчик может завершиться во время запроса: отмена таймера не должна его оборвать
+            await asyncio.shield(self._answer(query_id, bot))
+
+    async def __call__(self, handler, event, data):
+        query = getattr(event, "callback_query", None)
+        bot = data.get("bot")
+        if query is None or bot is None:
+            return await handler(event, data)
+
+        chat_id = query.message.chat.id if query.message else None
+        self.pending[query.id] = _CallbackState(time.perf_counter(), chat_id)
+        timer = asyncio.create_task(self._answer_after_budget(query.id, bot))
+        try:
+            return await handler(event, data)
+        finally:
+            timer.cancel()
+            # Обработчик мог вообще не ответить — подтверждаем, чтобы убрать «часики»
+            await self._answer(query.id, bot)
+            del self.pending[query.id]
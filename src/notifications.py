@@ -0,0 +1,68 @@
+import logging
+
+import pytz
+from aiogram import Bot
+
+from database import get_spot_by_id, get_user, notify_favorite_users
+from services import epoch
+from services.events import bus, CheckinCreated, Arrived, Expired, ArrivalOverdue
+from services.timezones import get_tz
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+_bot = None
+
+
+async def _notify_followers(event) -> None:
+    """Подписчики спота узнают о плане приезда и о том, что кто-то уже на споте."""
+    if isinstance(event, CheckinCreated):
+        if event.checkin_type != 2 or not event.arrival_time:
+            # Чек-ин «Я на споте» ещё ждёт выбора длительности: уведомим по Arrived
+            return
+        await notify_favorite_users(event.spot_id, event.user_id, _bot, checkin_type=2, arrival_time=event.arrival_time)
+    else:
+        await notify_favorite_users(event.spot_id, event.user_id, _bot, checkin_type=1)
+
+
+async def _notify_expired(event: Expired) -> None:
+    spot = await get_spot_by_id(event.spot_id)
+    if not spot:
+        return
+    await _bot.send_message(
+        chat_id=event.user_id,
+        text=f"⏰ Время вашего пребывания на споте '{spot.name}' истекло. Вы автоматически покинули спот."
+    )
+    logger.info(f"✅ Уведомление о разчекине отправлено пользователю {event.user_id}")
+
+
+async def _prompt_overdue_arrival(event: ArrivalOverdue) -> None:
+    """Просит подтвердить прибытие, когда время планируемого приезда прошло."""
+    from handlers.checkin import create_arrival_confirmation_keyboard
+
+    spot = await get_spot_by_id(event.spot_id)
+    if not spot:
+        return
+    user = await get_user(event.user_id)
+    user_tz = user.timezone if user and user.timezone else "Europe/Moscow"
+    try:
+        formatted_time = epoch.to_datetime(event.arrival_time, get_tz(user_tz)).strftime("%H:%M")
+    except pytz.exceptions.UnknownTimeZoneError:
+        logger.error(f"Некорректный часовой пояс для пользователя {event.user_id}: {user_tz}")
+        formatted_time = f"{epoch.to_datetime(event.arrival_time).strftime('%H:%M')} (UTC)"
+    await _bot.send_message(
+        chat_id=event.user_id,
+        text=f"⏳ Вы планировали прибыть на спот '{spot.name}' к {formatted_time}. Подтвердите прибытие:",
+        reply_markup=create_arrival_confirmation_keyboard(event.checkin_id)
+    )
+    logger.info(f"Уведомление отправлено пользователю {event.user_id} для чек-ина {event.checkin_id}, спот '{spot.name}'")
+
+
+def setup_notifications(bot: Bot) -> None:
+    """Подписывает отправку сообщений на события чек-инов этого процесса."""
+    global _bot
+    if _bot is None:
+        bus.subscribe_async((CheckinCreated, Arrived), _notify_followers)
+        bus.subscribe_async(Expired, _notify_expired)
+        bus.subscribe_async(ArrivalOverdue, _prompt_overdue_arrival)
+    _bot = bot
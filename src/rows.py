@@ -0,0 +1,100 @@
+from array import array
+from dataclasses import dataclass
+from typing import Optional
+
+# Строки, которые возвращают функции database.py. Классы со __slots__ занимают
+# меньше памяти, чем словари, и создаются прямо фабрикой строк соединения
+# (row_factory), поэтому поля объявлены в порядке столбцов SELECT.
+
+
+@dataclass(frozen=True, slots=True)
+class Spot:
+    id: int
+    name: str
+    lat: float
+    lon: float
+
+
+@dataclass(frozen=True, slots=True)
+class RankedSpot(Spot):
+    """Спот страницы «по популярности»: popularity — число чек-инов (ключ страницы)."""
+    popularity: int
+
+
+@dataclass(frozen=True, slots=True)
+class Checkin:
+    """Чек-ин; время — секунды UTC epoch. Запрос может выбрать только первые столбцы."""
+    id: int
+    user_id: int
+    spot_id: int
+    checkin_type: int
+    timestamp: Optional[int] = None
+    duration_hours: Optional[float] = None
+    arrival_time: Optional[int] = None
+    end_time: Optional[int] = None
+
+
+@dataclass(frozen=True, slots=True)
+class Visitor:
+    """Пользователь на карточке спота; arrival_time есть только у планирующих приезд."""
+    first_name: str
+    arrival_time: Optional[int] = None
+
+
+@dataclass(frozen=True, slots=True)
+class UserStats:
+    checkins: int = 0
+    total_hours: float = 0
+    first_session: Optional[int] = None
+    last_session: Optional[int] = None
+    favorite_spot_id: Optional[int] = None
+    favorite_spot_name: Optional[str] = None
+    active_spot_name: Optional[str] = None
+
+
+def row_factory(cls):
+    """row_factory для aiosqlite, собирающая строки результата в cls."""
+    return lambda cursor, row: cls(*row)
+
+
+class SpotColumns:
+    """
+    Весь каталог спотов по столбцам: id и координаты в массивах array, названия
+    в списке. Расстояния считаются прямо по массивам, а строки Spot создаются
+    только для спотов, которые попадут в ответ (catalog[i], catalog.get(spot_id)).
+    """
+    __slots__ = ("ids", "names", "lats", "lons", "_positions")
+
+    def __init__(self):
+        self.ids = array("q")
+        self.names = []
+        self.lats = array("d")
+        self.lons = array("d")
+        self._positions = None
+
+    def append(self, spot_id: int, name: str, lat: float, lon: float) -> None:
+        self.ids.append(spot_id)
+        self.names.append(name)
+        self.lats.append(lat)
+        self.lons.append(lon)
+        self._positions = None
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __getitem__(self, i: int) -> Spot:
+        return Spot(self.ids[i], self.names[i], self.lats[i], self.lons[i])
+
+    def __iter__(self):
+        for i in range(len(self.ids)):
+            yield self[i]
+
+    def position(self, spot_id: int) -> Optional[int]:
+        """Номер спота в столбцах или None."""
+        if self._positions is None:
+            self._positions = {spot_id: i for i, spot_id in enumerate(self.ids)}
+        return self._positions.get(spot_id)
+
+    def get(self, spot_id: int) -> Optional[Spot]:
+        i = self.position(spot_id)
+        return None if i is None else self[i]
@@ -1,15 +1,20 @@
-from aiogram import Bot
+import asyncio
+import functools
 import logging
+import socket
+import time
+import uuid
+from apscheduler.jobstores.base import ConflictingIdError
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from datetime import datetime
-import aiosqlite
-import subprocess
 import os
-import hashlib
-import pytz
 from dotenv import load_dotenv  # Импортируем для работы с .env
-from database import get_spot_by_id
-from handlers.checkin import create_arrival_confirmation_keyboard
+from database import get_spot_by_id, changed_since, acquire_lease, release_lease
+from database import get_expired_checkins, get_overdue_arrivals, expire_checkin, mark_arrival_overdue, delete_checkin
+from database import archive_closed_checkins, get_rollup_watermark
+from services.backup import BACKUP_DIR, create_backup, publish_backup, get_backup_generation
+from services import epoch, offload
+from services.rollups import HOURLY_ROLLUP, run_hourly_rollup
 
 # Загружаем переменные из файла .env
 load_dotenv()
@@ -30,199 +35,227 @@ GITHUB_USERNAME = "ndvkerch"  # Замени на своё имя пользов
 REPO_NAME = "tgbot"  # Замени на название репозитория
 REPO_URL = f"https://{GITHUB_TOKEN}@github.com/{GITHUB_USERNAME}/{REPO_NAME}.git"
 
-scheduler = AsyncIOScheduler()
+# Задачи хранятся в отдельной SQLite-базе: расписание переживает перезапуск
+SCHEDULER_DB_PATH = os.getenv("SCHEDULER_DB_PATH", "data/scheduler.db")
 
-# Храним хэш файла для проверки изменений
-last_db_hash = None
+# Закрытые чек-ины старше стольких дней переносятся в архив
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+# Чек-инов за одну транзакцию переноса и пауза между пачками (сек), чтобы не держать запись
+ARCHIVE_BATCH = int(os.getenv("ARCHIVE_BATCH", "500"))
+ARCHIVE_PAUSE = float(os.getenv("ARCHIVE_PAUSE", "0.1"))
 
-def get_file_hash(file_path: str) -> str:
-    """Вычисляет хэш файла для проверки изменений."""
-    hasher = hashlib.sha256()
-    with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hasher.update(chunk)
-    return hasher.hexdigest()
+# Аренда лидерства: задачи выполняет только процесс, владеющий арендой
+LEASE_NAME = "scheduler"
+LEASE_TTL = float(os.getenv("SCHEDULER_LEASE_TTL", "60"))
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
 
-async def check_expired_checkins(bot=None):
+scheduler = AsyncIOScheduler(
+    jobstores={"default": SQLAlchemyJobStore(url=f"sqlite:///{SCHEDULER_DB_PATH}")},
+    job_defaults={
+        "coalesce": True,  # пропущенные запуски схлопываются в один
+        "max_instances": 1
+    }
+)
+
+# До какого момента (time.time()) аренда гарантированно наша
+_lease_valid_until = 0.0
+_leadership_task = None
+
+# Поколение данных последнего бэкапа; None — ещё не читали манифест
+last_backup_generation = None
+
+def is_leader() -> bool:
+    """Владеет ли текущий процесс арендой планировщика (с запасом на задержки)."""
+    return time.time() < _lease_valid_until - LEASE_TTL / 6
+
+def leader_only(job):
+    """Пропускает запуск задачи, если процесс не лидер (защита от дублей при смене лидера)."""
+    @functools.wraps(job)
+    async def wrapper(*args, **kwargs):
+        if not is_leader():
+            logger.info(f"Пропуск {job.__name__}: процесс не является лидером планировщика")
+            return
+        return await job(*args, **kwargs)
+    return wrapper
+
+@leader_only
+async def check_expired_checkins():
     logger.info("Запуск check_expired_checkins")
-    """Проверяет истёкшие чек-ины для пользователей, которые уже на споте (checkin_type=1)."""
+    """
+    Закрывает истёкшие чек-ины для пользователей, которые уже на споте (checkin_type=1).
+    Уведомление пользователю отправляет подписчик события Expired.
+    """
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.cursor()
-            current_time = datetime.utcnow().isoformat()
-            # Добавляем условие checkin_type=1
-            await cursor.execute("""
-                SELECT id, user_id, spot_id
-                FROM checkins
-                WHERE active = 1 AND checkin_type = 1 AND end_time IS NOT NULL AND end_time < ?
-            """, (current_time,))
-            expired_checkins = await cursor.fetchall()
-            
-            for checkin in expired_checkins:
-                checkin_id, user_id, spot_id = checkin
-                # Разчекиниваем пользователя
-                await cursor.execute("UPDATE checkins SET active = 0 WHERE id = ?", (checkin_id,))
+        current_time = epoch.now()
+        for checkin in await get_expired_checkins(current_time):
+            checkin_id, user_id, spot_id = checkin.id, checkin.user_id, checkin.spot_id
+            if await expire_checkin(checkin_id):
                 logging.info(f"✅ Автоматический разчекин: пользователь {user_id} на споте {spot_id} (checkin_id={checkin_id})")
-                
-                # Отправляем уведомление пользователю
-                if bot:
-                    try:
-                        await cursor.execute("SELECT name FROM spots WHERE id = ?", (spot_id,))
-                        spot_name = (await cursor.fetchone())[0]
-                        await bot.send_message(
-                            chat_id=user_id,
-                            text=f"⏰ Время вашего пребывания на споте '{spot_name}' истекло. Вы автоматически покинули спот."
-                        )
-                        logging.info(f"✅ Уведомление о разчекине отправлено пользователю {user_id}")
-                    except Exception as e:
-                        logging.error(f"❌ Ошибка при отправке уведомления пользователю {user_id}: {e}")
-            await conn.commit()
     except Exception as e:
         logging.error(f"❌ Ошибка при проверке истёкших чек-инов: {e}")
 
-async def push_database_to_github():
-    """Проверяет изменения в базе данных и отправляет их в GitHub."""
-    global last_db_hash
+@leader_only
+async def backup_database():
+    """Создаёт инкрементальный бэкап базы данных и отправляет его в GitHub."""
+    global last_backup_generation
     try:
         # Проверяем, существует ли файл базы данных
         if not os.path.exists(DB_PATH):
             logging.error(f"❌ Файл базы данных {DB_PATH} не найден.")
             return
 
-        # Вычисляем текущий хэш файла
-        current_hash = get_file_hash(DB_PATH)
+        # Проверяем счётчик поколений вместо чтения всего файла
+        if last_backup_generation is None:
+            last_backup_generation = await offload.run_blocking(get_backup_generation)
+        changed, generation = await changed_since(last_backup_generation)
+        if not changed:
+            logging.info("ℹ️ База данных не изменилась, пропускаем бэкап.")
+            return
 
-        # Если хэш не изменился, пропускаем
-        if last_db_hash == current_hash:
-            logging.info("ℹ️ База данных не изменилась, пропускаем коммит.")
+        # Снимок делается в рабочем потоке через online backup API
+        backup_name = await create_backup(DB_PATH)
+        last_backup_generation = generation
+        if not backup_name:
+            logging.info("ℹ️ Страницы базы данных не изменились, пропускаем коммит.")
             return
 
-        # Обновляем последний хэш
-        last_db_hash = current_hash
+        # Контрольная сумма файла бэкапа считается в пуле потоков
+        checksum = await offload.hash_file(os.path.join(BACKUP_DIR, backup_name))
+        logging.info(f"✅ Бэкап {backup_name}, sha256 {checksum}")
 
-        # Выполняем Git-команды
+        # Git-команды выполняются асинхронно и не блокируют обработчики
         try:
-            # Настраиваем URL репозитория с токеном
-            subprocess.run(["git", "remote", "set-url", "origin", REPO_URL], check=True)
-            logging.info("✅ URL репозитория настроен с использованием токена.")
-
-            # Добавляем файл в индекс
-            subprocess.run(["git", "add", DB_PATH], check=True)
-            logging.info(f"✅ Файл {DB_PATH} добавлен в индекс Git.")
-
-            # Проверяем, есть ли изменения для коммита
-            status = subprocess.run(["git", "status", "--porcelain"], capture_output=True, text=True)
-            if not status.stdout:
-                logging.info("ℹ️ Нет изменений для коммита.")
-                return
-
-            # Коммитим изменения
-            commit_message = f"Автоматическое обновление базы данных: {datetime.utcnow().isoformat()}"
-            subprocess.run(["git", "commit", "-m", commit_message], check=True)
-            logging.info(f"✅ Создан коммит: {commit_message}")
-
-            # Пушим изменения в репозиторий
-            subprocess.run(["git", "pull", "--rebase", "origin", "main"], check=True)
-            subprocess.run(["git", "push", "origin", "main"], check=True)
-            logging.info("✅ Изменения успешно отправлены в GitHub.")
-
-        except subprocess.CalledProcessError as e:
-            logging.error(f"❌ Ошибка при выполнении Git-команды: {e}")
+            await publish_backup(REPO_URL, "main", details=f"{backup_name} sha256:{checksum}")
         except Exception as e:
-            logging.error(f"❌ Неизвестная ошибка при работе с Git: {e}")
+            logging.error(f"❌ Ошибка при выполнении Git-команды: {e}")
 
     except Exception as e:
-        logging.error(f"❌ Ошибка при отправке базы данных в GitHub: {e}")
+        logging.error(f"❌ Ошибка при создании бэкапа базы данных: {e}")
 
-async def check_pending_arrivals(bot: Bot):
+@leader_only
+async def check_pending_arrivals():
     logger.info("Запуск check_pending_arrivals")
-    """Проверка активных неподтверждённых записей о прибытии (checkin_type=2, active=1)."""
+    """
+    Снимает активные неподтверждённые записи о прибытии (checkin_type=2, active=1),
+    время которых прошло. Просьбу подтвердить прибытие отправляет подписчик
+    события ArrivalOverdue.
+    """
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.cursor()
-            current_time = datetime.utcnow().isoformat()
-            
-            # Ищем активные просроченные записи типа 2
-            await cursor.execute("""
-                SELECT id, user_id, spot_id, arrival_time 
-                FROM checkins 
-                WHERE checkin_type = 2 
-                AND active = 1 
-                AND arrival_time < ?
-            """, (current_time,))
-            
-            expired_arrivals = await cursor.fetchall()
-            if not expired_arrivals:
-                logger.info("Нет активных просроченных записей о прибытии, требующих уведомления.")
-                return
-            
-            for checkin_id, user_id, spot_id, arrival_time in expired_arrivals:
-                try:
-                    # Получаем информацию о споте
-                    spot = await get_spot_by_id(spot_id)
-                    if not spot:
-                        logger.warning(f"Спот с ID {spot_id} не найден для чек-ина {checkin_id}")
-                        await cursor.execute("DELETE FROM checkins WHERE id = ?", (checkin_id,))
-                        await conn.commit()
-                        continue
-                    
-                    # Получаем часовой пояс пользователя
-                    await cursor.execute("SELECT timezone FROM users WHERE user_id = ?", (user_id,))
-                    user_tz_result = await cursor.fetchone()
-                    user_tz = user_tz_result[0] if user_tz_result and user_tz_result[0] else "Europe/Moscow"
-                    local_tz = pytz.timezone(user_tz)
-                    
-                    # Преобразуем arrival_time в локальное время пользователя
-                    arrival_dt = datetime.fromisoformat(arrival_time.replace("Z", "+00:00"))
-                    arrival_local = arrival_dt.replace(tzinfo=pytz.utc).astimezone(local_tz)
-                    formatted_time = arrival_local.strftime("%H:%M")
-                    
-                    # Отправляем уведомление с checkin_id в клавиатуре
-                    await bot.send_message(
-                        chat_id=user_id,
-                        text=f"⏳ Вы планировали прибыть на спот '{spot['name']}' к {formatted_time}. Подтвердите прибытие:",
-                        reply_markup=create_arrival_confirmation_keyboard(checkin_id)
-                    )
-                    logger.info(f"Уведомление отправлено пользователю {user_id} для чек-ина {checkin_id}, спот '{spot['name']}'")
-                    
-                    # Деактивируем запись после отправки уведомления
-                    await cursor.execute("""
-                        UPDATE checkins 
-                        SET active = 0 
-                        WHERE id = ?
-                    """, (checkin_id,))
+        current_time = epoch.now()
+
+        # Ищем активные просроченные записи типа 2
+        expired_arrivals = await get_overdue_arrivals(current_time)
+        if not expired_arrivals:
+            logger.info("Нет активных просроченных записей о прибытии, требующих уведомления.")
+            return
+
+        for arrival in expired_arrivals:
+            checkin_id, spot_id = arrival.id, arrival.spot_id
+            try:
+                if not await get_spot_by_id(spot_id):
+                    logger.warning(f"Спот с ID {spot_id} не найден для чек-ина {checkin_id}")
+                    await delete_checkin(checkin_id)
+                    continue
+                if await mark_arrival_overdue(checkin_id):
                     logger.info(f"Чек-ин {checkin_id} деактивирован (active=0)")
-                    
-                except pytz.exceptions.UnknownTimeZoneError as tz_error:
-                    logger.error(f"Некорректный часовой пояс для пользователя {user_id}: {user_tz}, ошибка: {str(tz_error)}")
-                    formatted_time = datetime.fromisoformat(arrival_time.replace("Z", "+00:00")).strftime("%H:%M")
-                    await bot.send_message(
-                        chat_id=user_id,
-                        text=f"⏳ Вы планировали прибыть на спот '{spot['name']}' к {formatted_time} (UTC). Подтвердите прибытие:",
-                        reply_markup=create_arrival_confirmation_keyboard(checkin_id)
-                    )
-                    await cursor.execute("""
-                        UPDATE checkins 
-                        SET active = 0 
-                        WHERE id = ?
-                    """, (checkin_id,))
-                    logger.info(f"Чек-ин {checkin_id} деактивирован после ошибки часового пояса")
-                except Exception as e:
-                    logger.error(f"Ошибка отправки уведомления для чек-ина {checkin_id}, пользователь {user_id}: {str(e)}")
-                
-                await conn.commit()
+            except Exception as e:
+                logger.error(f"Ошибка обработки просроченного приезда {checkin_id}: {str(e)}")
     except Exception as e:
         logger.error(f"Ошибка в check_pending_arrivals: {str(e)}")
 
-def start_scheduler(bot=None):
-    """Запускает планировщик задач."""
+@leader_only
+async def rollup_hourly_occupancy():
+    """Учитывает закрытые сессии в почасовой занятости спотов (подсказки «обычно людно»)."""
+    try:
+        processed = await run_hourly_rollup()
+        if processed:
+            logging.info(f"📈 В почасовую занятость добавлено сессий: {processed}")
+    except Exception as e:
+        logging.error(f"❌ Ошибка агрегации почасовой занятости: {e}")
+
+@leader_only
+async def archive_checkins():
+    """Переносит старые закрытые чек-ины в архив небольшими пачками."""
+    try:
+        before = epoch.now() - int(ARCHIVE_AFTER_DAYS * epoch.DAY)
+        # Сессии, ещё не учтённые в почасовой занятости, остаются в горячей таблице
+        before = min(before, (await get_rollup_watermark(HOURLY_ROLLUP))[0])
+        moved = 0
+        while True:
+            count = await archive_closed_checkins(before, ARCHIVE_BATCH)
+            moved += count
+            if count < ARCHIVE_BATCH:
+                break
+            await asyncio.sleep(ARCHIVE_PAUSE)
+        if moved:
+            logging.info(f"🗄 В архив перенесено чек-инов: {moved}")
+    except Exception as e:
+        logging.error(f"❌ Ошибка архивации чек-инов: {e}")
+
+def _ensure_job(func, seconds: int, jitter: int) -> None:
+    """
+    Добавляет интервальную задачу, если её ещё нет в хранилище. Существующая задача
+    сохраняет своё время следующего запуска; при смене интервала она перепланируется.
+    """
+    job_id = func.__name__
+    job = scheduler.get_job(job_id)
+    if job is None:
+        try:
+            scheduler.add_job(
+                func, "interval", seconds=seconds, jitter=jitter, id=job_id,
+                misfire_grace_time=seconds, coalesce=True, max_instances=1
+            )
+        except ConflictingIdError:
+            # Задачу одновременно добавил другой процесс
+            pass
+    elif job.trigger.interval.total_seconds() != seconds:
+        scheduler.reschedule_job(job_id, trigger="interval", seconds=seconds, jitter=jitter)
+
+async def _maintain_leadership() -> None:
+    """Периодически продлевает аренду; лидер выполняет задачи, остальные стоят на паузе."""
+    global _lease_valid_until
+    try:
+        while True:
+            started = time.time()
+            if await acquire_lease(LEASE_NAME, INSTANCE_ID, LEASE_TTL):
+                if not is_leader():
+                    logging.info(f"✅ Процесс {INSTANCE_ID} стал лидером планировщика.")
+                _lease_valid_until = started + LEASE_TTL
+                scheduler.resume()
+            else:
+                if is_leader():
+                    logging.warning(f"Процесс {INSTANCE_ID} потерял лидерство планировщика.")
+                _lease_valid_until = 0.0
+                scheduler.pause()
+            await asyncio.sleep(LEASE_TTL / 3)
+    except asyncio.CancelledError:
+        scheduler.pause()
+        _lease_valid_until = 0.0
+        await release_lease(LEASE_NAME, INSTANCE_ID)
+        raise
+
+def start_scheduler():
+    """
+    Запускает планировщик задач. Сообщения пользователям по результатам задач
+    отправляют подписчики событий (notifications.setup_notifications).
+    """
+    global _leadership_task
+    # Стартуем на паузе: задачи начнут выполняться, когда процесс получит аренду
+    scheduler.start(paused=True)
+
     # Проверяем истёкшие чек-ины каждые 5 минут
-    scheduler.add_job(check_expired_checkins, "interval", seconds=300, args=[bot])
-    
-    # Отправляем базу данных в GitHub каждые 15 минут
-    scheduler.add_job(push_database_to_github, "interval", seconds=900)
-    
-    scheduler.add_job(check_pending_arrivals, "interval", seconds=600, args=[bot])
-    
-    scheduler.start()
-    logging.info("✅ Планировщик задач запущен.")
\ No newline at end of file
+    _ensure_job(check_expired_checkins, seconds=300, jitter=10)
+
+    # Делаем бэкап базы данных и отправляем его в GitHub каждые 15 минут
+    _ensure_job(backup_database, seconds=900, jitter=30)
+
+    _ensure_job(check_pending_arrivals, seconds=600, jitter=10)
+
+    # Почасовая занятость спотов: только сессии, закрытые после водяного знака
+    _ensure_job(rollup_hourly_occupancy, seconds=900, jitter=30)
+
+    # Архивация закрытых чек-инов раз в час
+    _ensure_job(archive_checkins, seconds=3600, jitter=60)
+
+    _leadership_task = asyncio.get_running_loop().create_task(_maintain_leadership())
+    logging.info("✅ Планировщик задач запущен.")
@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import os
+
+from aiogram import types
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramRetryAfter
+
+from cards import PENDING, render_card
+from services.metrics import counter, histogram
+from services.weather import get_open_meteo_forecast
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Минимальный интервал между правками одного сообщения (сек): Telegram ограничивает частоту правок
+SCREEN_EDIT_INTERVAL = float(os.getenv("SCREEN_EDIT_INTERVAL", "1.0"))
+# Сколько ждём прогнозы (сек); после этого недостающие данные помечаются как недоступные
+SCREEN_FORECAST_DEADLINE = float(os.getenv("SCREEN_FORECAST_DEADLINE", "8.0"))
+# Сколько раз пробуем окончательную правку, если Telegram отказал (лимит, сеть)
+SCREEN_FINAL_ATTEMPTS = int(os.getenv("SCREEN_FINAL_ATTEMPTS", "3"))
+
+first_content = histogram("screen_first_content_seconds", "Время до отправки первого содержимого экрана спотов")
+fully_rendered = histogram("screen_complete_seconds", "Время до окончательной версии экрана спотов")
+screen_edits = counter("screen_edits_total", "Правки сообщений при постепенной отрисовке экранов")
+forecast_timeouts = counter("screen_forecast_timeouts_total", "Прогнозы, не успевшие к дедлайну экрана")
+
+# Ссылки на фоновые задачи дорисовки, чтобы их не собрал сборщик мусора
+_background = set()
+
+
+async def render_spots(message: types.Message, title: str, entries: list, user_timezone) -> types.Message:
+    """
+    Постепенно отрисовывает список спотов.
+
+    entries — список (spot, distance, card), где card — SpotCard из кеша
+    карточек. Список с заглушками погоды отправляется сразу, а
+    прогнозы запрашиваются в фоновой задаче: обработчик (и очередь обновлений
+    пользователя) не ждёт погодный сервис. Сообщение отправляется без
+    reply-клавиатуры: Telegram не даёт править сообщения с ней, поэтому убирать
+    клавиатуру нужно отдельным сообщением до вызова.
+    """
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    forecasts = [PENDING] * len(entries)
+    sent = await message.answer(_build(title, entries, forecasts, user_timezone), parse_mode="Markdown")
+    first_content.observe(loop.time() - started)
+
+    task = asyncio.create_task(_fill_forecasts(sent, title, entries, forecasts, user_timezone, started))
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    return sent
+
+
+def _build(title: str, entries: list, forecasts: list, user_timezone) -> str:
+    return title + "".join(
+        render_card(spot, distance, card, forecasts[index], user_timezone)
+        for index, (spot, distance, card) in enumerate(entries)
+    )
+
+
+async def _fill_forecasts(sent: types.Message, title: str, entries: list, forecasts: list, user_timezone, started: float) -> None:
+    """
+    Запрашивает прогнозы параллельно и правит сообщение по мере их прихода,
+    не чаще раза в SCREEN_EDIT_INTERVAL. Прогнозы, не пришедшие за
+    SCREEN_FORECAST_DEADLINE, показываются как недоступные.
+    """
+    loop = asyncio.get_running_loop()
+    # Раньше этого момента Telegram просил не править (TelegramRetryAfter)
+    retry_at = 0.0
+
+    async def edit() -> bool:
+        nonlocal retry_at
+        screen_edits.inc()
+        try:
+            await sent.edit_text(_build(title, entries, forecasts, user_timezone), parse_mode="Markdown")
+            return True
+        except TelegramRetryAfter as e:
+            retry_at = loop.time() + e.retry_after
+            logger.warning(f"⚠️ Правка экрана спотов отложена на {e.retry_after} с")
+        except TelegramBadRequest as e:
+            if "message is not modified" in str(e):
+                return True
+            logger.warning(f"⚠️ Не удалось обновить экран спотов: {e}")
+        except TelegramAPIError as e:
+            logger.warning(f"⚠️ Не удалось обновить экран спотов: {e}")
+        return False
+
+    def edit_allowed_at() -> float:
+        return max(last_edit + SCREEN_EDIT_INTERVAL, retry_at)
+
+    tasks = {
+        asyncio.create_task(get_open_meteo_forecast(spot.lat, spot.lon)): index
+        for index, (spot, distance, card) in enumerate(entries)
+    }
+    deadline = started + SCREEN_FORECAST_DEADLINE
+    last_edit = loop.time()
+    dirty = False
+    try:
+        while tasks:
+            now = loop.time()
+            if now >= deadline:
+                break
+            timeout = deadline - now
+            if dirty:
+                # Есть неотправленные изменения: просыпаемся к моменту, когда правка разрешена
+                timeout = min(timeout, max(edit_allowed_at() - now, 0))
+            done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                index = tasks.pop(task)
+                forecasts[index] = None if task.exception() else task.result()
+                dirty = True
+            # Последнюю правку делаем после цикла, чтобы не править сообщение дважды подряд
+            if dirty and tasks and loop.time() >= edit_allowed_at():
+                if await edit():
+                    dirty = False
+                last_edit = loop.time()
+    finally:
+        for task, index in tasks.items():
+            task.cancel()
+            forecasts[index] = None
+        if tasks:
+            forecast_timeouts.inc(len(tasks))
+
+        # Окончательная версия без заглушек «загружается» отправляется всегда;
+        # при отказе Telegram правка повторяется после паузы
+        for _ in range(SCREEN_FINAL_ATTEMPTS):
+            wait = edit_allowed_at() - loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if await edit():
+                break
+            last_edit = loop.time()
+        fully_rendered.observe(loop.time() - started)
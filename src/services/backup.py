@@ -0,0 +1,278 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import struct
+from datetime import datetime
+from typing import Optional
+
+from services import offload
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+BACKUP_DIR = os.getenv("BACKUP_DIR", "data/backups")
+MANIFEST_NAME = "manifest.json"
+SNAPSHOT_NAME = ".snapshot.db"
+# Хэши страниц последнего снимка: нужны только для следующей дельты, поэтому лежат
+# рядом с бэкапами, но не коммитятся (в манифесте — только их контрольная сумма)
+PAGE_HASHES_NAME = ".page_hashes"
+PAGE_HASH_SIZE = 8
+# Каждые N инкрементов снимается полная копия, чтобы цепочка дельт не росла бесконечно
+FULL_EVERY = int(os.getenv("BACKUP_FULL_EVERY", "48"))
+# Сколько страниц копировать за один шаг online backup API (между шагами БД доступна писателям)
+BACKUP_STEP_PAGES = 256
+
+DELTA_MAGIC = b"TGBDELTA1"
+
+# Не даём двум бэкапам выполняться одновременно
+_backup_lock = asyncio.Lock()
+
+
+# Блок 1: Снимок и вычисление изменённых страниц (выполняется в рабочем потоке)
+def _take_snapshot(db_path: str, snapshot_path: str) -> None:
+    """Делает согласованную копию БД через SQLite online backup API."""
+    src = sqlite3.connect(db_path)
+    dst = sqlite3.connect(snapshot_path)
+    try:
+        src.backup(dst, pages=BACKUP_STEP_PAGES, sleep=0.005)
+    finally:
+        dst.close()
+        src.close()
+
+
+def _page_hashes(snapshot_path: str, page_size: int) -> bytes:
+    """Возвращает короткие хэши всех страниц снимка подряд, по PAGE_HASH_SIZE байт."""
+    hashes = bytearray()
+    with open(snapshot_path, "rb") as f:
+        for page in iter(lambda: f.read(page_size), b""):
+            hashes += hashlib.blake2b(page, digest_size=PAGE_HASH_SIZE).digest()
+    return bytes(hashes)
+
+
+def _hashes_digest(hashes: bytes) -> str:
+    return hashlib.blake2b(hashes, digest_size=16).hexdigest()
+
+
+def _read_page_hashes(backup_dir: str, manifest: dict) -> Optional[bytes]:
+    """
+    Хэши страниц, с которыми сравнивается новый снимок. None, если их нет или
+    они не от последнего бэкапа цепочки (например, каталог склонирован
+    с другой машины) — тогда снимается полная копия.
+    """
+    path = os.path.join(backup_dir, PAGE_HASHES_NAME)
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            hashes = f.read()
+    elif "page_hashes" in manifest:
+        # Манифест старого формата хранил хэши списком
+        return b"".join(bytes.fromhex(page_hash) for page_hash in manifest["page_hashes"])
+    else:
+        return None
+    if manifest.get("page_hashes_digest") != _hashes_digest(hashes):
+        return None
+    return hashes
+
+
+def _write_page_hashes(backup_dir: str, hashes: bytes) -> None:
+    path = os.path.join(backup_dir, PAGE_HASHES_NAME)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(hashes)
+    os.replace(tmp_path, path)
+
+
+def _snapshot_generation(conn: sqlite3.Connection) -> Optional[int]:
+    """Читает счётчик поколений из снимка (None для баз без change_counters)."""
+    try:
+        row = conn.execute("SELECT generation FROM change_counters WHERE table_name = '*'").fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return row[0] if row else None
+
+
+def _read_manifest(backup_dir: str) -> dict:
+    path = os.path.join(backup_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _write_manifest(backup_dir: str, manifest: dict) -> None:
+    path = os.path.join(backup_dir, MANIFEST_NAME)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+
+def _write_full(snapshot_path: str, target_path: str) -> None:
+    with open(snapshot_path, "rb") as src, gzip.open(target_path, "wb") as dst:
+        for chunk in iter(lambda: src.read(1024 * 1024), b""):
+            dst.write(chunk)
+
+
+def _write_delta(snapshot_path: str, target_path: str, page_size: int, page_count: int, pages: list) -> None:
+    """Записывает изменённые страницы: заголовок + (номер страницы, содержимое)."""
+    with open(snapshot_path, "rb") as src, gzip.open(target_path, "wb") as dst:
+        dst.write(DELTA_MAGIC)
+        dst.write(struct.pack(">III", page_size, page_count, len(pages)))
+        for page_no in pages:
+            src.seek(page_no * page_size)
+            dst.write(struct.pack(">I", page_no))
+            dst.write(src.read(page_size))
+
+
+def _prune(backup_dir: str, keep: set) -> None:
+    """Удаляет файлы бэкапов, не входящие в текущую и предыдущую цепочки."""
+    for name in os.listdir(backup_dir):
+        if name.endswith(".gz") and name not in keep:
+            os.remove(os.path.join(backup_dir, name))
+            logger.info(f"Удалён устаревший бэкап {name}")
+
+
+def run_backup(db_path: str, backup_dir: str = BACKUP_DIR) -> Optional[str]:
+    """
+    Синхронная часть бэкапа: снимок, сравнение страниц с прошлым запуском и запись
+    полного или инкрементального файла.
+
+    Returns:
+        str: Имя созданного файла или None, если данные не изменились
+    """
+    os.makedirs(backup_dir, exist_ok=True)
+    snapshot_path = os.path.join(backup_dir, SNAPSHOT_NAME)
+    _take_snapshot(db_path, snapshot_path)
+    try:
+        conn = sqlite3.connect(snapshot_path)
+        try:
+            page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+            generation = _snapshot_generation(conn)
+        finally:
+            conn.close()
+
+        hashes = _page_hashes(snapshot_path, page_size)
+        manifest = _read_manifest(backup_dir)
+        old_hashes = _read_page_hashes(backup_dir, manifest)
+        chain = manifest.get("chain", [])
+        seq = manifest.get("seq", 0) + 1
+        stamp = f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}-{seq:06d}"
+
+        need_full = (
+            not chain
+            or old_hashes is None
+            or manifest.get("page_size") != page_size
+            or len(chain) > FULL_EVERY
+        )
+        if need_full:
+            name = f"full-{stamp}.db.gz"
+            _write_full(snapshot_path, os.path.join(backup_dir, name))
+            manifest["previous_chain"] = chain
+            chain = [name]
+        else:
+            if hashes == old_hashes:
+                if manifest.get("generation") != generation:
+                    manifest["generation"] = generation
+                    _write_manifest(backup_dir, manifest)
+                return None
+            changed = [
+                page_no for page_no, offset in enumerate(range(0, len(hashes), PAGE_HASH_SIZE))
+                if hashes[offset:offset + PAGE_HASH_SIZE] != old_hashes[offset:offset + PAGE_HASH_SIZE]
+            ]
+            name = f"delta-{stamp}.pages.gz"
+            _write_delta(snapshot_path, os.path.join(backup_dir, name), page_size, len(hashes) // PAGE_HASH_SIZE, changed)
+            chain.append(name)
+
+        _write_page_hashes(backup_dir, hashes)
+        manifest.pop("page_hashes", None)
+        manifest.update({
+            "seq": seq,
+            "generation": generation,
+            "chain": chain,
+            "page_size": page_size,
+            "page_hashes_digest": _hashes_digest(hashes),
+            "updated_at": datetime.utcnow().isoformat()
+        })
+        _write_manifest(backup_dir, manifest)
+        _prune(backup_dir, set(chain) | set(manifest.get("previous_chain", [])))
+        return name
+    finally:
+        if os.path.exists(snapshot_path):
+            os.remove(snapshot_path)
+
+
+def restore_backup(target_path: str, backup_dir: str = BACKUP_DIR) -> None:
+    """Восстанавливает БД из полного снимка и последующих дельт текущей цепочки."""
+    manifest = _read_manifest(backup_dir)
+    chain = manifest.get("chain")
+    if not chain:
+        raise FileNotFoundError(f"В {backup_dir} нет бэкапов для восстановления")
+
+    with gzip.open(os.path.join(backup_dir, chain[0]), "rb") as src, open(target_path, "wb") as dst:
+        for chunk in iter(lambda: src.read(1024 * 1024), b""):
+            dst.write(chunk)
+
+    with open(target_path, "r+b") as dst:
+        for name in chain[1:]:
+            with gzip.open(os.path.join(backup_dir, name), "rb") as src:
+                if src.read(len(DELTA_MAGIC)) != DELTA_MAGIC:
+                    raise ValueError(f"Повреждённый файл дельты: {name}")
+                page_size, page_count, changed = struct.unpack(">III", src.read(12))
+                for _ in range(changed):
+                    (page_no,) = struct.unpack(">I", src.read(4))
+                    dst.seek(page_no * page_size)
+                    dst.write(src.read(page_size))
+                dst.truncate(page_count * page_size)
+    logger.info(f"База данных восстановлена в {target_path} из {len(chain)} файлов")
+
+
+def get_backup_generation(backup_dir: str = BACKUP_DIR) -> Optional[int]:
+    """Поколение данных, попавшее в последний бэкап (см. database.get_generation)."""
+    return _read_manifest(backup_dir).get("generation")
+
+
+# Блок 2: Асинхронный интерфейс для планировщика
+async def create_backup(db_path: str, backup_dir: str = BACKUP_DIR) -> Optional[str]:
+    """Запускает бэкап в рабочем потоке, не блокируя цикл событий."""
+    async with _backup_lock:
+        name = await offload.run_blocking(run_backup, db_path, backup_dir)
+        if name:
+            logger.info(f"✅ Создан бэкап {name}")
+        return name
+
+
+async def _run_git(*args: str) -> str:
+    """Выполняет git-команду асинхронно и возвращает stdout."""
+    process = await asyncio.create_subprocess_exec(
+        "git", *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError(f"git {args[0]} завершился с кодом {process.returncode}: {stderr.decode().strip()}")
+    return stdout.decode()
+
+
+async def publish_backup(repo_url: str, branch: str = "main", backup_dir: str = BACKUP_DIR, details: str = "") -> bool:
+    """Коммитит каталог бэкапов (без локальных хэшей страниц) и отправляет его в удалённый репозиторий."""
+    await _run_git("remote", "set-url", "origin", repo_url)
+    await _run_git("add", "-A", "--", backup_dir, f":(exclude){os.path.join(backup_dir, PAGE_HASHES_NAME)}")
+
+    # git diff --cached --quiet возвращает 1, если в индексе есть изменения
+    process = await asyncio.create_subprocess_exec("git", "diff", "--cached", "--quiet", "--", backup_dir)
+    if await process.wait() == 0:
+        logger.info("ℹ️ Нет изменений бэкапа для коммита.")
+        return False
+
+    commit_message = f"Автоматический бэкап базы данных: {datetime.utcnow().isoformat()}"
+    if details:
+        commit_message += f"\n\n{details}"
+    await _run_git("commit", "-m", commit_message, "--", backup_dir)
+    await _run_git("pull", "--rebase", "--autostash", "origin", branch)
+    await _run_git("push", "origin", branch)
+    logger.info(f"✅ Бэкап отправлен в GitHub: {commit_message}")
+    return True
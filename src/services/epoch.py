@@ -0,0 +1,55 @@
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+import pytz
+
+# Время в checkins (timestamp, arrival_time, end_time, closed_at) хранится целыми
+# секундами UTC epoch: сравнения в SQL — числовые и идут по индексам, а горячим
+# путям не нужно разбирать строки. Строки ISO остаются только на границе:
+# при миграции старых данных и при выводе пользователю.
+
+HOUR = 3600
+DAY = 24 * HOUR
+WEEK = 7 * DAY
+
+
+def now() -> int:
+    """Текущий момент, секунды UTC epoch."""
+    return int(time.time())
+
+
+def to_epoch(value) -> Optional[int]:
+    """
+    Секунды UTC epoch из int/float, datetime или строки ISO (как писали старые
+    версии бота). Время без пояса считается UTC; строка только со временем
+    («21:47») относится к текущим суткам UTC. None остаётся None.
+    """
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, datetime):
+        moment = value
+    else:
+        text = str(value).strip()
+        if text.lstrip("-").isdigit():
+            return int(text)
+        if "T" not in text and " " not in text and ":" in text:
+            text = f"{datetime.utcnow().date()}T{text}"
+        moment = datetime.fromisoformat(text.replace("Z", "+00:00"))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=pytz.utc)
+    return int(moment.timestamp())
+
+
+def to_datetime(value: Optional[int], tz=pytz.utc) -> Optional[datetime]:
+    """Момент epoch в поясе tz (по умолчанию UTC)."""
+    if value is None:
+        return None
+    return datetime.fromtimestamp(value, tz)
+
+
+def after_hours(hours: float, start: Optional[int] = None) -> int:
+    """Момент через hours часов после start (по умолчанию — сейчас)."""
+    return (now() if start is None else start) + int(timedelta(hours=hours).total_seconds())
@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+from services.metrics import counter, gauge
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Сколько событий может ждать один асинхронный подписчик; лишние отбрасываются
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", "1000"))
+
+events_published = counter("events_published_total", "Опубликованные события чек-инов и каталога")
+events_dropped = counter("events_dropped_total", "События, не поместившиеся в очередь подписчика")
+events_failed = counter("events_failed_total", "Ошибки обработчиков событий")
+events_pending = gauge("events_pending", "События в очередях асинхронных подписчиков")
+
+
+# Блок 1: События
+@dataclass(frozen=True, slots=True)
+class CheckinEvent:
+    """Изменение чек-ина пользователя; публикуется слоем БД после коммита. Время — секунды UTC epoch."""
+    checkin_id: int
+    user_id: int
+    spot_id: int
+
+
+@dataclass(frozen=True, slots=True)
+class CheckinCreated(CheckinEvent):
+    """Создан чек-ин: тип 1 ждёт выбора длительности, тип 2 — план приезда."""
+    checkin_type: int
+    arrival_time: Optional[int] = None
+
+
+@dataclass(frozen=True, slots=True)
+class Arrived(CheckinEvent):
+    """Пользователь на споте: выбрал длительность сразу или подтвердил приезд по плану."""
+    duration_hours: float
+    end_time: int
+    from_plan: bool = False
+
+
+@dataclass(frozen=True, slots=True)
+class Left(CheckinEvent):
+    """Пользователь покинул спот сам или его чек-ин заменён новым."""
+
+
+@dataclass(frozen=True, slots=True)
+class Expired(CheckinEvent):
+    """Истекло время пребывания на споте, чек-ин закрыт планировщиком."""
+
+
+@dataclass(frozen=True, slots=True)
+class ArrivalOverdue(CheckinEvent):
+    """Время планируемого приезда прошло, план снят планировщиком до подтверждения."""
+    arrival_time: int
+
+
+@dataclass(frozen=True, slots=True)
+class CheckinRemoved(CheckinEvent):
+    """Запись чек-ина удалена (отмена до подтверждения, отказ от приезда)."""
+
+
+@dataclass(frozen=True, slots=True)
+class SpotChanged:
+    """Изменён каталог спотов; removed — спот удалён вместе с его чек-инами."""
+    spot_id: int
+    removed: bool = False
+
+
+# Блок 2: Шина
+class _AsyncSubscriber:
+    __slots__ = ("name", "handler", "types", "queue", "task")
+
+    def __init__(self, name: str, handler, types: tuple, maxsize: int):
+        self.name = name
+        self.handler = handler
+        self.types = types
+        self.queue = asyncio.Queue(maxsize)
+        self.task = None
+
+
+class EventBus:
+    """
+    Шина событий процесса.
+
+    Синхронные подписчики (кеши в памяти) вызываются прямо в publish, поэтому
+    следующий запрос уже видит сброшенный кеш. Асинхронные подписчики
+    (уведомления) получают события через собственную ограниченную очередь и
+    выполняются в фоновой задаче: записывающий код их не ждёт, а медленный
+    подписчик не задерживает остальных. Подписка на базовый класс получает все
+    его подклассы.
+    """
+
+    def __init__(self, queue_size: int = EVENT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._sync = []
+        self._async = []
+
+    def subscribe(self, types, handler) -> None:
+        """Синхронный обработчик handler(event) для событий указанных типов."""
+        self._sync.append((types if isinstance(types, tuple) else (types,), handler))
+
+    def subscribe_async(self, types, handler, name: str = None) -> None:
+        """Асинхронный обработчик await handler(event) со своей очередью."""
+        types = types if isinstance(types, tuple) else (types,)
+        self._async.append(_AsyncSubscriber(name or handler.__name__, handler, types, self.queue_size))
+
+    def publish(self, event) -> None:
+        events_published.inc()
+        for types, handler in self._sync:
+            if isinstance(event, types):
+                try:
+                    handler(event)
+                except Exception as e:
+                    events_failed.inc()
+                    logger.error(f"❌ Ошибка обработчика {handler.__name__} для {type(event).__name__}: {e}")
+        for subscriber in self._async:
+            if not isinstance(event, subscriber.types):
+                continue
+            if subscriber.task is None:
+                subscriber.task = asyncio.get_running_loop().create_task(self._run(subscriber))
+            try:
+                subscriber.queue.put_nowait(event)
+                events_pending.inc()
+            except asyncio.QueueFull:
+                events_dropped.inc()
+                logger.warning(f"⚠️ Очередь подписчика {subscriber.name} переполнена, {type(event).__name__} отброшено")
+
+    async def _run(self, subscriber: _AsyncSubscriber) -> None:
+        while True:
+            event = await subscriber.queue.get()
+            events_pending.dec()
+            try:
+                await subscriber.handler(event)
+            except Exception as e:
+                events_failed.inc()
+                logger.error(f"❌ Ошибка подписчика {subscriber.name} для {type(event).__name__}: {e}")
+            finally:
+                subscriber.queue.task_done()
+
+    async def join(self) -> None:
+        """Ждёт, пока асинхронные подписчики обработают уже опубликованные события."""
+        for subscriber in self._async:
+            await subscriber.queue.join()
+
+
+bus = EventBus()
@@ -1,14 +1,96 @@
+import asyncio
 import logging
-from datetime import datetime, timedelta
-from aiogram.types import Message, ReplyKeyboardRemove
+import math
+import os
+import time
+from collections import OrderedDict
+from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton
 from aiogram import Bot
 from typing import Dict, Tuple, Optional
 
+from rows import SpotColumns
+from services.metrics import counter, gauge
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Кеш для хранения геоданных пользователей: {user_id: (lat, lon, timestamp)}
-geo_cache: Dict[int, Tuple[float, float, datetime]] = {}
+# Сколько последних геопозиций пользователей держим в памяти
+LOCATION_CACHE_SIZE = int(os.getenv("LOCATION_CACHE_SIZE", "10000"))
+# Сколько секунд геопозиция считается актуальной для экранов «рядом со мной»
+LOCATION_TTL = float(os.getenv("LOCATION_TTL", "600"))
+
+location_hits = counter("location_cache_hits_total", "Геопозиции пользователей, взятые из памяти")
+location_misses = counter("location_cache_misses_total", "Геопозиции пользователей, прочитанные из БД")
+location_size = gauge("location_cache_size", "Геопозиций пользователей в памяти")
+
+
+class LocationEntry:
+    """Последняя геопозиция пользователя; updated_at — time.time() (0 — геопозиции нет)."""
+    __slots__ = ("lat", "lon", "updated_at")
+
+    def __init__(self, lat: Optional[float], lon: Optional[float], updated_at: float):
+        self.lat = lat
+        self.lon = lon
+        self.updated_at = updated_at
+
+
+class LocationStore:
+    """
+    Последние известные геопозиции пользователей: LRU в памяти ограниченного
+    размера поверх колонок users.last_lat/last_lon. Заполняется из каждого
+    сообщения с геопозицией (LocationMiddleware); при промахе запись читается
+    из БД один раз, отсутствие геопозиции тоже запоминается.
+    """
+
+    def __init__(self, size: int = LOCATION_CACHE_SIZE, ttl: float = LOCATION_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._entries: "OrderedDict[int, LocationEntry]" = OrderedDict()
+
+    def _put(self, user_id: int, entry: LocationEntry) -> None:
+        self._entries[user_id] = entry
+        self._entries.move_to_end(user_id)
+        if len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+        location_size.set(len(self._entries))
+
+    async def remember(self, user_id: int, lat: float, lon: float) -> None:
+        """Запоминает свежую геопозицию в памяти и в БД."""
+        from database import update_user_location
+
+        self._put(user_id, LocationEntry(lat, lon, time.time()))
+        await update_user_location(user_id, lat, lon)
+
+    async def get(self, user_id: int, max_age: float = None) -> Optional[Tuple[float, float]]:
+        """
+        Геопозиция (lat, lon) не старше max_age секунд (по умолчанию ttl);
+        max_age=math.inf — любая последняя известная. None — нет подходящей.
+        """
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            self._entries.move_to_end(user_id)
+            location_hits.inc()
+        else:
+            from database import get_user_location
+
+            location_misses.inc()
+            stored = await get_user_location(user_id)
+            if stored:
+                lat, lon, updated_at = stored
+                entry = LocationEntry(lat, lon, updated_at or 0.0)
+            else:
+                entry = LocationEntry(None, None, 0.0)
+            self._put(user_id, entry)
+
+        if entry.lat is None:
+            return None
+        if time.time() - entry.updated_at > (self.ttl if max_age is None else max_age):
+            return None
+        return entry.lat, entry.lon
+
+
+location_store = LocationStore()
+
 
 class GeoService:
     def __init__(self, bot: Bot):
@@ -17,17 +99,15 @@ class GeoService:
     async def get_user_location(
         self, 
         message: Message, 
-        cache_timeout: int = 600  # 10 минут
+        cache_timeout: int = LOCATION_TTL
     ) -> Optional[Tuple[float, float]]:
-        """Запрашивает геолокацию с кешированием."""
+        """Возвращает недавнюю геолокацию пользователя или запрашивает новую."""
         user_id = message.from_user.id
 
-        # Проверка кеша
-        if user_id in geo_cache:
-            lat, lon, timestamp = geo_cache[user_id]
-            if (datetime.now() - timestamp).total_seconds() < cache_timeout:
-                logger.info(f"Используются кешированные координаты для {user_id}")
-                return (lat, lon)
+        location = await location_store.get(user_id, max_age=cache_timeout)
+        if location:
+            logger.info(f"Используются сохранённые координаты для {user_id}")
+            return location
 
         # Запрос новой геолокации
         keyboard = ReplyKeyboardMarkup(
@@ -38,10 +118,9 @@ class GeoService:
         await message.answer("Пожалуйста, отправьте вашу геолокацию:", reply_markup=keyboard)
         return None
 
-    def update_cache(self, user_id: int, lat: float, lon: float) -> None:
-        """Обновляет кеш геоданных."""
-        geo_cache[user_id] = (lat, lon, datetime.now())
-        logger.info(f"Кеш обновлен для пользователя {user_id}")
+    async def update_cache(self, user_id: int, lat: float, lon: float) -> None:
+        """Обновляет сохранённую геолокацию."""
+        await location_store.remember(user_id, lat, lon)
 
     @staticmethod
     def calculate_distance(
@@ -78,12 +157,120 @@ class GeoService:
         spots = await get_spots()
         nearest = []
 
-        for spot in spots:
-            distance = self.calculate_distance(
-                user_lat, user_lon,
-                spot["lat"], spot["lon"]
-            )
+        for i, (lat, lon) in enumerate(zip(spots.lats, spots.lons)):
+            distance = self.calculate_distance(user_lat, user_lon, lat, lon)
             if distance <= max_distance:
-                nearest.append((spot, distance))
+                nearest.append((spots[i], distance))
+
+        return sorted(nearest, key=lambda x: x[1])
+
+# Размер ячейки сеточного индекса спотов в градусах (~28 км по широте)
+SPOT_GRID_CELL_DEG = float(os.getenv("SPOT_GRID_CELL_DEG", "0.25"))
+KM_PER_DEGREE = 111.32
+
+
+class SpotIndex:
+    """
+    Сеточный индекс спотов для выдачи страниц «по расстоянию от пользователя».
+
+    Споты разложены по ячейкам lat/lon фиксированного размера. Страница после
+    ключа (расстояние в метрах, id) собирается обходом колец ячеек вокруг
+    пользователя: обход останавливается, как только ближайший непросмотренный
+    спот заведомо дальше последнего кандидата страницы. Кольца, целиком лежащие
+    ближе ключа, пропускаются, поэтому стоимость страницы зависит от числа
+    спотов рядом, а не от размера каталога. Индекс перестраивается при смене
+    поколения таблицы spots (правки из любого процесса).
+    """
+
+    def __init__(self, cell_deg: float = SPOT_GRID_CELL_DEG):
+        self.cell_deg = cell_deg
+        self.generation = None
+        self._spots = SpotColumns()
+        # Ячейка -> номера спотов в столбцах self._spots
+        self._cells: Dict[Tuple[int, int], list] = {}
+        self._lock = asyncio.Lock()
+
+    def _cell(self, lat: float, lon: float) -> Tuple[int, int]:
+        return math.floor(lat / self.cell_deg), math.floor(lon / self.cell_deg)
+
+    async def refresh(self) -> None:
+        """Перестраивает индекс, если каталог спотов изменился."""
+        from database import get_generation, get_spots
+
+        generation = await get_generation("spots")
+        if generation == self.generation:
+            return
+        async with self._lock:
+            if generation == self.generation:
+                return
+            spots = await get_spots()
+            cells = {}
+            for i, (lat, lon) in enumerate(zip(spots.lats, spots.lons)):
+                cells.setdefault(self._cell(lat, lon), []).append(i)
+            self._spots, self._cells = spots, cells
+            self.generation = generation
+            logger.info(f"🗺 Индекс спотов перестроен: {sum(map(len, cells.values()))} спотов в {len(cells)} ячейках")
+
+    def __len__(self) -> int:
+        return len(self._spots)
+
+    def _ring(self, ci: int, cj: int, ring: int):
+        """Ячейки на расстоянии ровно ring ячеек (по Чебышёву) от (ci, cj)."""
+        if ring == 0:
+            yield ci, cj
+            return
+        for dj in range(-ring, ring + 1):
+            yield ci - ring, cj + dj
+            yield ci + ring, cj + dj
+        for di in range(-ring + 1, ring):
+            yield ci + di, cj - ring
+            yield ci + di, cj + ring
+
+    def page(self, lat: float, lon: float, after: tuple = None, limit: int = 10) -> list:
+        """
+        До limit спотов по возрастанию расстояния после ключа after.
+        Возвращает список (key, spot, distance_km), где key = (метры, spot_id).
+        """
+        if not self._cells:
+            return []
+        ci, cj = self._cell(lat, lon)
+        cell_km = self.cell_deg * KM_PER_DEGREE
+        # Самая дальняя точка кольца r не дальше (r + 1) диагоналей ячейки
+        ring = max(0, int(after[0] / 1000 / (cell_km * math.sqrt(2))) - 1) if after else 0
+        max_ring = max(max(abs(i - ci), abs(j - cj)) for i, j in self._cells)
+        spots = self._spots
+        candidates = []
+
+        def collect(positions):
+            for i in positions:
+                distance = GeoService.calculate_distance(lat, lon, spots.lats[i], spots.lons[i])
+                key = (round(distance * 1000), spots.ids[i])
+                if after is None or key > after:
+                    candidates.append((key, i, distance))
+
+        while ring <= max_ring:
+            if 8 * ring > len(self._cells):
+                # Кольцо шире, чем занятых ячеек: дешевле разобрать оставшиеся ячейки напрямую
+                for (i, j), positions in self._cells.items():
+                    if max(abs(i - ci), abs(j - cj)) >= ring:
+                        collect(positions)
+                break
+            for cell in self._ring(ci, cj, ring):
+                positions = self._cells.get(cell)
+                if positions:
+                    collect(positions)
+            if len(candidates) >= limit:
+                candidates.sort(key=lambda item: item[0])
+                # Непросмотренные ячейки не ближе ring ячеек; по долготе ячейка сужается к полюсам
+                edge_lat = min(abs(lat) + (ring + 1) * self.cell_deg, 89.9)
+                bound_km = ring * cell_km * math.cos(math.radians(edge_lat))
+                if candidates[limit - 1][2] <= bound_km:
+                    break
+            ring += 1
+
+        candidates.sort(key=lambda item: item[0])
+        # Строки Spot создаются только для спотов страницы
+        return [(key, spots[i], distance) for key, i, distance in candidates[:limit]]
+
 
-        return sorted(nearest, key=lambda x: x[1])
\ No newline at end of file
+spot_index = SpotIndex()
@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Optional
+
+from services.metrics import counter, histogram
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Период пробы цикла событий (сек)
+LOOP_MONITOR_INTERVAL = float(os.getenv("LOOP_MONITOR_INTERVAL", "0.1"))
+# Задержка, после которой цикл считается зависшим и снимается стек (сек)
+LOOP_STALL_THRESHOLD = float(os.getenv("LOOP_STALL_THRESHOLD", "0.25"))
+# Порог slow_callback_duration для debug-режима asyncio; пусто — режим выключен
+LOOP_SLOW_CALLBACK = os.getenv("LOOP_SLOW_CALLBACK")
+
+loop_lag = histogram("loop_lag_seconds", "Опоздание пробуждения цикла событий относительно плана")
+loop_stalls = counter("loop_stalls_total", "Сколько раз цикл событий был заблокирован дольше порога")
+slow_callbacks = histogram("loop_slow_callback_seconds", "Длительность медленных колбэков по данным debug-режима asyncio")
+
+
+class _SlowCallbackFilter(logging.Filter):
+    """Перехватывает предупреждения asyncio 'Executing ... took N seconds' и пишет их в гистограмму."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.msg == "Executing %s took %.3f seconds" and isinstance(record.args, tuple):
+            slow_callbacks.observe(record.args[1])
+        return True
+
+
+class LoopMonitor:
+    """
+    Следит за отзывчивостью цикла событий.
+
+    Корутина-проба засыпает на interval и измеряет, насколько позже плана она
+    проснулась. Сторожевой поток проверяет время последнего пробуждения: если
+    цикл не отвечает дольше stall_threshold, он снимает стек потока цикла —
+    это и есть код, который блокирует всех пользователей.
+    """
+
+    def __init__(
+        self,
+        interval: float = LOOP_MONITOR_INTERVAL,
+        stall_threshold: float = LOOP_STALL_THRESHOLD,
+        slow_callback: Optional[float] = None
+    ):
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+        self.slow_callback = slow_callback
+        self.recent_stalls = deque(maxlen=20)
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id = None
+        self._task = None
+        self._watchdog = None
+        self._stopped = threading.Event()
+
+    def start(self) -> None:
+        """Запускает пробу и сторожевой поток; вызывается из работающего цикла."""
+        loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._task = loop.create_task(self._probe())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+        if self.slow_callback:
+            loop.set_debug(True)
+            loop.slow_callback_duration = self.slow_callback
+            logging.getLogger("asyncio").addFilter(_SlowCallbackFilter())
+            logger.info(f"Включён debug-режим asyncio, порог медленных колбэков {self.slow_callback} с")
+        logger.info(f"Монитор цикла событий запущен: интервал {self.interval} с, порог {self.stall_threshold} с")
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._task:
+            self._task.cancel()
+
+    async def _probe(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = loop.time() - started - self.interval
+            loop_lag.observe(max(lag, 0.0))
+            self._heartbeat = time.monotonic()
+
+    def _watch(self) -> None:
+        reported_heartbeat = None
+        while not self._stopped.wait(self.stall_threshold / 2):
+            heartbeat = self._heartbeat
+            blocked_for = time.monotonic() - heartbeat - self.interval
+            if blocked_for < self.stall_threshold or heartbeat == reported_heartbeat:
+                continue
+            # Одно зависание — одна запись, даже если оно длится несколько проверок
+            reported_heartbeat = heartbeat
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else "стек недоступен"
+            loop_stalls.inc()
+            self.recent_stalls.append((time.time(), blocked_for, stack))
+            logger.warning(f"Цикл событий заблокирован более {blocked_for:.3f} с. Стек:\n{stack}")
+
+
+def start_loop_monitor() -> LoopMonitor:
+    """Создаёт и запускает монитор с настройками из окружения."""
+    monitor = LoopMonitor(slow_callback=float(LOOP_SLOW_CALLBACK) if LOOP_SLOW_CALLBACK else None)
+    monitor.start()
+    return monitor
@@ -0,0 +1,216 @@
+import asyncio
+import logging
+import os
+import time
+
+from services.events import bus, CheckinEvent, CheckinCreated, Arrived, SpotChanged
+from services.metrics import counter, gauge
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Как часто проверять поколение таблицы checkins (сек): записи других процессов-воркеров
+OCCUPANCY_CHECK_INTERVAL = float(os.getenv("OCCUPANCY_CHECK_INTERVAL", "5"))
+# Полная сверка с БД не реже, чем раз в столько секунд, даже если поколение не менялось
+OCCUPANCY_RECONCILE_INTERVAL = float(os.getenv("OCCUPANCY_RECONCILE_INTERVAL", "300"))
+
+occupancy_reconciles = counter("occupancy_reconciles_total", "Сверки модели занятости с БД")
+occupancy_remote = counter("occupancy_remote_updates_total", "Записи модели занятости, полученные из БД после записей других процессов")
+occupancy_drift = counter("occupancy_drift_total", "Записи модели занятости, исправленные сверкой с БД")
+occupancy_on_spot = gauge("occupancy_on_spot", "Пользователей на спотах по модели занятости")
+occupancy_arriving = gauge("occupancy_arriving", "Планов приезда по модели занятости")
+
+
+class OccupancyModel:
+    """
+    Активные чек-ины всех спотов в памяти процесса: кто на споте (тип 1) и кто
+    собирается приехать (тип 2, со временем прибытия). Из модели строятся
+    карточки спотов, версия спота в модели меняется только при изменении его
+    активных чек-инов.
+
+    Модель загружается из БД при старте и обновляется синхронными подписчиками
+    шины событий, поэтому записи этого процесса видны сразу. При изменении
+    поколения таблицы checkins перечитываются только споты, чья версия в
+    spot_versions сменилась: после своих записей они совпадают с моделью, после
+    записей других процессов-воркеров — обновляются. Полная сверка раз в
+    OCCUPANCY_RECONCILE_INTERVAL считает расхождением (drift) только отличия
+    на спотах, которые в БД не менялись: такие изменения модель должна была
+    получить через шину, но не получила.
+    """
+
+    def __init__(self):
+        # checkin_id -> (spot_id, user_id, checkin_type, arrival_time)
+        self._checkins = {}
+        # spot_id -> {checkin_id: (user_id, checkin_type, arrival_time)}
+        self._by_spot = {}
+        # spot_id -> версия спота в модели (значение общего счётчика _clock)
+        self._versions = {}
+        self._clock = 0
+        # spot_id -> версия из spot_versions, с которой модель сверена
+        self._db_versions = {}
+        self.generation = None
+        self.reconciled_at = 0.0
+        # События, опубликованные во время чтения снимка из БД
+        self._journal = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self.generation is not None
+
+    def _touch(self, spot_id: int) -> None:
+        self._clock += 1
+        self._versions[spot_id] = self._clock
+
+    def _add(self, checkin_id: int, spot_id: int, user_id: int, checkin_type: int, arrival_time) -> None:
+        entry = (spot_id, user_id, checkin_type, arrival_time)
+        if self._checkins.get(checkin_id) == entry:
+            return
+        self._remove(checkin_id)
+        self._checkins[checkin_id] = entry
+        self._by_spot.setdefault(spot_id, {})[checkin_id] = entry[1:]
+        self._touch(spot_id)
+
+    def _remove(self, checkin_id: int) -> None:
+        entry = self._checkins.pop(checkin_id, None)
+        if entry is None:
+            return
+        spot_checkins = self._by_spot[entry[0]]
+        del spot_checkins[checkin_id]
+        if not spot_checkins:
+            del self._by_spot[entry[0]]
+        self._touch(entry[0])
+
+    def _apply(self, event) -> None:
+        if isinstance(event, CheckinCreated):
+            # Чек-ин «Я на споте» активируется только после выбора длительности (Arrived)
+            if event.checkin_type == 2:
+                self._add(event.checkin_id, event.spot_id, event.user_id, 2, event.arrival_time)
+        elif isinstance(event, Arrived):
+            self._add(event.checkin_id, event.spot_id, event.user_id, 1, None)
+        elif isinstance(event, SpotChanged):
+            # Удаление спота удаляет и чек-ины на нём
+            if event.removed:
+                for checkin_id in list(self._by_spot.get(event.spot_id, ())):
+                    self._remove(checkin_id)
+        else:
+            self._remove(event.checkin_id)
+
+    def on_event(self, event) -> None:
+        """Подписчик шины: изменение чек-ина или каталога в этом процессе."""
+        if self._journal is not None:
+            self._journal.append(event)
+        self._apply(event)
+
+    async def reconcile(self, full: bool = True) -> int:
+        """
+        Сверяет модель с БД: full — все активные чек-ины, иначе только споты,
+        чья версия в spot_versions сменилась. Возвращает число исправленных
+        записей на спотах, которые в БД не менялись (drift).
+        """
+        from database import get_active_checkins, get_all_spot_versions, get_generation
+
+        async with self._lock:
+            full = full or not self.loaded
+            self._journal = []
+            try:
+                # Поколение и версии читаются до данных: запись между ними вызовет лишнюю сверку, а не пропуск
+                generation = await get_generation("checkins")
+                db_versions = await get_all_spot_versions()
+                changed = {spot_id for spot_id, version in db_versions.items() if self._db_versions.get(spot_id) != version}
+                if full:
+                    rows = await get_active_checkins()
+                elif changed:
+                    rows = await get_active_checkins(list(changed))
+                else:
+                    rows = []
+                journal = self._journal
+            finally:
+                self._journal = None
+
+            scope = (set(self._by_spot) | {row[2] for row in rows}) if full else changed
+            previous = {spot_id: (dict(self._by_spot.get(spot_id, {})), self._versions.get(spot_id)) for spot_id in scope}
+            for spot_id in scope:
+                for checkin_id in list(self._by_spot.get(spot_id, ())):
+                    self._remove(checkin_id)
+            for checkin_id, user_id, spot_id, checkin_type, arrival_time in rows:
+                self._add(checkin_id, spot_id, user_id, checkin_type, arrival_time)
+            # Записи этого процесса, закоммиченные после чтения снимка
+            for event in journal:
+                self._apply(event)
+
+            drift = remote = 0
+            for spot_id, (before, version) in previous.items():
+                after = self._by_spot.get(spot_id, {})
+                if before == after:
+                    # Пересборка спота без изменений не меняет его версию: карточка остаётся в кеше
+                    if version is not None:
+                        self._versions[spot_id] = version
+                    continue
+                differences = sum(1 for checkin_id in before.keys() | after.keys() if before.get(checkin_id) != after.get(checkin_id))
+                if spot_id in changed:
+                    remote += differences
+                else:
+                    drift += differences
+            if self.loaded:
+                occupancy_remote.inc(remote)
+                if drift:
+                    occupancy_drift.inc(drift)
+                    logger.info(f"🔄 Модель занятости расходилась с БД: исправлено записей — {drift}")
+            else:
+                drift = 0
+            self._db_versions = db_versions
+            self.generation = generation
+            if full:
+                self.reconciled_at = time.monotonic()
+            occupancy_reconciles.inc()
+            arriving = sum(1 for entry in self._checkins.values() if entry[2] == 2)
+            occupancy_arriving.set(arriving)
+            occupancy_on_spot.set(len(self._checkins) - arriving)
+            return drift
+
+    async def active_spot_ids(self) -> frozenset:
+        """Споты, на которых кто-то есть или собирается приехать."""
+        if not self.loaded:
+            await self.reconcile()
+        return frozenset(self._by_spot)
+
+    async def spot_checkins(self, spot_ids: list) -> dict:
+        """
+        Версии и активные чек-ины спотов: {spot_id: (version, [(user_id, checkin_type, arrival_time), ...])},
+        чек-ины в порядке создания.
+        """
+        if not self.loaded:
+            await self.reconcile()
+        return {
+            spot_id: (self._versions.get(spot_id, 0), [entry for _, entry in sorted(self._by_spot.get(spot_id, {}).items())])
+            for spot_id in spot_ids
+        }
+
+    async def watch(self, check_interval: float = OCCUPANCY_CHECK_INTERVAL,
+                    reconcile_interval: float = OCCUPANCY_RECONCILE_INTERVAL) -> None:
+        """Загружает модель и сверяет её с БД при изменении checkins или по таймеру."""
+        from database import get_generation
+
+        while True:
+            try:
+                if not self.loaded or time.monotonic() - self.reconciled_at >= reconcile_interval:
+                    await self.reconcile()
+                elif await get_generation("checkins") != self.generation:
+                    await self.reconcile(full=False)
+            except Exception as e:
+                logger.error(f"❌ Ошибка сверки модели занятости: {e}")
+            await asyncio.sleep(check_interval)
+
+
+occupancy = OccupancyModel()
+bus.subscribe((CheckinEvent, SpotChanged), occupancy.on_event)
+
+_watch_task = None
+
+
+def start_occupancy_watcher() -> asyncio.Task:
+    """Запускает загрузку и фоновую сверку модели занятости в текущем цикле событий."""
+    global _watch_task
+    _watch_task = asyncio.create_task(occupancy.watch())
+    return _watch_task
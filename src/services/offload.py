@@ -0,0 +1,120 @@
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
+
+from services.metrics import gauge, histogram
+from services.timezones import service as timezone_service
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Потоки для блокирующего ввода-вывода и библиотек без async API
+OFFLOAD_THREADS = int(os.getenv("OFFLOAD_THREADS", "4"))
+# Процессы для тяжёлых вычислений; 0 — по числу ядер
+OFFLOAD_PROCESSES = int(os.getenv("OFFLOAD_PROCESSES", "0")) or os.cpu_count() or 1
+
+thread_pending = gauge("offload_thread_pending", "Задачи в пуле потоков (в очереди и выполняются)")
+thread_wait = histogram("offload_thread_wait_seconds", "Время ожидания задачи в очереди пула потоков")
+thread_exec = histogram("offload_thread_exec_seconds", "Время выполнения задачи в пуле потоков")
+process_pending = gauge("offload_process_pending", "Задачи в пуле процессов (в очереди и выполняются)")
+process_total = histogram("offload_process_seconds", "Полное время задачи в пуле процессов, включая очередь")
+
+_thread_pool: Optional[ThreadPoolExecutor] = None
+_process_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _get_thread_pool() -> ThreadPoolExecutor:
+    global _thread_pool
+    if _thread_pool is None:
+        with _pool_lock:
+            if _thread_pool is None:
+                _thread_pool = ThreadPoolExecutor(max_workers=OFFLOAD_THREADS, thread_name_prefix="offload")
+    return _thread_pool
+
+
+def _get_process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    if _process_pool is None:
+        with _pool_lock:
+            if _process_pool is None:
+                # spawn: fork процесса с работающим циклом событий и потоками небезопасен
+                _process_pool = ProcessPoolExecutor(
+                    max_workers=OFFLOAD_PROCESSES,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+    return _process_pool
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Выполняет блокирующую функцию в пуле потоков и замеряет очередь и время выполнения."""
+    loop = asyncio.get_running_loop()
+    submitted = time.perf_counter()
+
+    def call():
+        started = time.perf_counter()
+        thread_wait.observe(started - submitted)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            thread_exec.observe(time.perf_counter() - started)
+
+    thread_pending.inc()
+    try:
+        return await loop.run_in_executor(_get_thread_pool(), call)
+    finally:
+        thread_pending.dec()
+
+
+async def run_cpu(func, *args):
+    """
+    Выполняет тяжёлую функцию в пуле процессов. Функция и аргументы должны
+    сериализоваться pickle (функция — на уровне модуля).
+    """
+    loop = asyncio.get_running_loop()
+    submitted = time.perf_counter()
+    process_pending.inc()
+    try:
+        return await loop.run_in_executor(_get_process_pool(), func, *args)
+    finally:
+        process_pending.dec()
+        process_total.observe(time.perf_counter() - submitted)
+
+
+def shutdown() -> None:
+    """Останавливает пулы (при завершении бота)."""
+    global _thread_pool, _process_pool
+    if _thread_pool is not None:
+        _thread_pool.shutdown(wait=False, cancel_futures=True)
+        _thread_pool = None
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
+
+
+# Типизированные помощники для известных блокирующих операций
+async def tz_at(lat: float, lon: float) -> Optional[str]:
+    """Название часового пояса для координат (поиск по полигонам вне цикла событий)."""
+    found, name = timezone_service.cached(lat, lon)
+    if found:
+        return name
+    return await run_blocking(timezone_service.lookup, lat, lon)
+
+
+def _hash_file(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+async def hash_file(path: str) -> str:
+    """SHA-256 файла, вычисленный в пуле потоков."""
+    return await run_blocking(_hash_file, path)
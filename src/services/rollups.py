@@ -0,0 +1,153 @@
+import logging
+import os
+import time
+from datetime import datetime
+
+import pytz
+
+from services import epoch, offload
+from services.metrics import counter
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Имя водяного знака почасовой занятости в rollup_watermarks
+HOURLY_ROLLUP = "spot_hourly"
+HOURS_PER_WEEK = 168
+# Сколько сессий обрабатывать за одну пачку (одна транзакция записи)
+ROLLUP_BATCH = int(os.getenv("ROLLUP_BATCH", "2000"))
+# Сессии, закрытые позже now - ROLLUP_SETTLE (сек), ждут следующего запуска:
+# запись с более ранним closed_at могла ещё не закоммититься
+ROLLUP_SETTLE = float(os.getenv("ROLLUP_SETTLE", "120"))
+# Сколько секунд агрегаты спотов живут в памяти процесса
+BUSY_HOURS_TTL = float(os.getenv("BUSY_HOURS_TTL", "900"))
+# Меньше стольких человеко-минут за день недели — подсказку не показываем
+BUSY_MIN_MINUTES = int(os.getenv("BUSY_MIN_MINUTES", "180"))
+
+rollup_sessions = counter("rollup_sessions_total", "Сессии, учтённые в почасовой занятости спотов")
+busy_loads = counter("busy_hours_loads_total", "Загрузки почасовой занятости спотов из БД")
+
+WEEKDAYS = ("пн", "вт", "ср", "чт", "пт", "сб", "вс")
+
+
+# 1 января 1970 — четверг: час epoch 0 — это час 72 недели, начинающейся с понедельника
+_EPOCH_WEEK_HOUR = 3 * 24
+
+
+def bin_sessions(sessions: list) -> dict:
+    """
+    Раскладывает сессии (id, spot_id, timestamp, end_time, closed_at) по часам
+    недели в UTC: {spot_id: [человеко-минуты × HOURS_PER_WEEK]}. Сессия
+    заканчивается уходом со спота или истечением выбранного времени, смотря что
+    раньше. Работа — простой цикл по пачке строк, поэтому выполняется в пуле
+    потоков (offload.run_blocking): пул процессов нельзя создать в процессе-воркере
+    (daemon), а запуск spawn-процессов стоит дороже самой раскладки.
+    """
+    deltas = {}
+    for _, spot_id, start, end_time, closed_at in sessions:
+        end = min(end_time, closed_at)
+        if end <= start:
+            continue
+        seconds = deltas.setdefault(spot_id, [0] * HOURS_PER_WEEK)
+        cursor = start
+        while cursor < end:
+            hour = cursor // epoch.HOUR
+            chunk_end = min((hour + 1) * epoch.HOUR, end)
+            seconds[(hour + _EPOCH_WEEK_HOUR) % HOURS_PER_WEEK] += chunk_end - cursor
+            cursor = chunk_end
+    return {spot_id: [round(value / 60) for value in seconds] for spot_id, seconds in deltas.items()}
+
+
+async def run_hourly_rollup() -> int:
+    """
+    Учитывает в почасовой занятости сессии, закрытые после водяного знака.
+    Каждая пачка записывается вместе с новым знаком в одной транзакции, поэтому
+    повторный или прерванный запуск не считает сессии дважды. Возвращает число
+    учтённых сессий.
+    """
+    from database import get_rollup_watermark, get_closed_sessions, save_hourly_rollup
+
+    until = epoch.now() - int(ROLLUP_SETTLE)
+    watermark = await get_rollup_watermark(HOURLY_ROLLUP)
+    processed = 0
+    while True:
+        sessions = await get_closed_sessions(watermark, until, ROLLUP_BATCH)
+        if not sessions:
+            break
+        deltas = await offload.run_blocking(bin_sessions, sessions)
+        last = sessions[-1]
+        new_watermark = (last[4], last[0])
+        if not await save_hourly_rollup(HOURLY_ROLLUP, watermark, new_watermark, deltas):
+            logger.warning("⚠️ Водяной знак почасовой занятости изменён другим процессом, пачка пропущена")
+            break
+        watermark = new_watermark
+        processed += len(sessions)
+        rollup_sessions.inc(len(sessions))
+        if len(sessions) < ROLLUP_BATCH:
+            break
+    return processed
+
+
+class BusyHours:
+    """
+    Почасовая занятость спотов в памяти и подсказки «обычно людно» по ней.
+
+    Агрегаты загружаются одним запросом для спотов экрана и живут
+    BUSY_HOURS_TTL: задача агрегации обновляет их не чаще, чем раз в несколько
+    минут. Подсказка зависит от спота, дня недели и смещения пояса зрителя и
+    запоминается по этому ключу.
+    """
+
+    def __init__(self, ttl: float = BUSY_HOURS_TTL):
+        self.ttl = ttl
+        # spot_id -> array; None — у спота нет истории
+        self._hours = {}
+        self._hints = {}
+        self._loaded_at = 0.0
+
+    async def load(self, spot_ids: list) -> None:
+        """Подгружает агрегаты спотов, которых ещё нет в памяти (или все — по истечении TTL)."""
+        from database import get_spot_hourly
+
+        if time.monotonic() - self._loaded_at >= self.ttl:
+            self._hours.clear()
+            self._hints.clear()
+            self._loaded_at = time.monotonic()
+        missing = [spot_id for spot_id in spot_ids if spot_id not in self._hours]
+        if not missing:
+            return
+        busy_loads.inc()
+        loaded = await get_spot_hourly(missing)
+        for spot_id in missing:
+            self._hours[spot_id] = loaded.get(spot_id)
+
+    def hint(self, spot_id: int, user_timezone) -> str:
+        """Строка «Обычно людно» на сегодня в поясе зрителя; пустая, если данных мало."""
+        hours = self._hours.get(spot_id)
+        if hours is None:
+            return ""
+        now = datetime.now(pytz.utc).astimezone(user_timezone)
+        offset = round(now.utcoffset().total_seconds() / 3600)
+        key = (spot_id, now.weekday(), offset)
+        text = self._hints.get(key)
+        if text is None:
+            text = self._hints[key] = _busy_text(hours, now.weekday(), offset)
+        return text
+
+
+def _busy_text(hours, weekday: int, offset: int) -> str:
+    """Самые людные часы дня недели weekday (местное время со смещением offset от UTC)."""
+    day = [hours[(weekday * 24 + hour - offset) % HOURS_PER_WEEK] for hour in range(24)]
+    if sum(day) < BUSY_MIN_MINUTES:
+        return ""
+    peak = max(range(24), key=day.__getitem__)
+    start = end = peak
+    # Расширяем окно вокруг пика, пока занятость не ниже половины пиковой
+    while start > 0 and day[start - 1] * 2 >= day[peak]:
+        start -= 1
+    while end < 23 and day[end + 1] * 2 >= day[peak]:
+        end += 1
+    return f"📈 *Обычно людно:* {WEEKDAYS[weekday]} {start:02d}:00–{end + 1:02d}:00\n"
+
+
+busy_hours = BusyHours()
@@ -0,0 +1,108 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Optional, Tuple
+
+import pytz
+
+from services.metrics import counter
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Размер ячейки сетки в градусах (0.01° ≈ 1 км): точки в одной ячейке делят результат
+TZ_GRID_DEGREES = float(os.getenv("TZ_GRID_DEGREES", "0.01"))
+TZ_CACHE_SIZE = int(os.getenv("TZ_CACHE_SIZE", "4096"))
+# in_memory=True держит полигоны TimezoneFinder в памяти: быстрее поиск, больше RSS
+TZ_IN_MEMORY = os.getenv("TZ_IN_MEMORY", "0") == "1"
+
+tz_cache_hits = counter("tz_cache_hits_total", "Попадания в кеш часовых поясов")
+tz_cache_misses = counter("tz_cache_misses_total", "Поиски часового пояса по полигонам")
+
+
+class TimezoneService:
+    """
+    Единый на процесс поиск часового пояса по координатам.
+
+    TimezoneFinder создаётся при первом обращении. Координаты округляются до
+    ячейки сетки, результаты хранятся в LRU-кеше, поэтому повторные запросы
+    из того же места не трогают полигоны.
+    """
+
+    def __init__(self, grid: float = TZ_GRID_DEGREES, cache_size: int = TZ_CACHE_SIZE, in_memory: bool = TZ_IN_MEMORY):
+        self.grid = grid
+        self.cache_size = cache_size
+        self.in_memory = in_memory
+        self._finder = None
+        self._cache: "OrderedDict[Tuple[int, int], Optional[str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def cell(self, lat: float, lon: float) -> Tuple[int, int]:
+        """Ячейка сетки, в которой точки делят один результат поиска."""
+        return round(lat / self.grid), round(lon / self.grid)
+
+    def _get_finder(self):
+        if self._finder is None:
+            from timezonefinder import TimezoneFinder
+            self._finder = TimezoneFinder(in_memory=self.in_memory)
+            logger.info(f"TimezoneFinder инициализирован (in_memory={self.in_memory})")
+        return self._finder
+
+    def cached(self, lat: float, lon: float) -> Tuple[bool, Optional[str]]:
+        """Быстрая проверка кеша без поиска: (найдено ли, название пояса)."""
+        key = self.cell(lat, lon)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                tz_cache_hits.inc()
+                return True, self._cache[key]
+        return False, None
+
+    def lookup(self, lat: float, lon: float) -> Optional[str]:
+        """Синхронный поиск с кешем; при промахе обходит полигоны (вызывать вне цикла событий)."""
+        found, name = self.cached(lat, lon)
+        if found:
+            return name
+        key = self.cell(lat, lon)
+        with self._lock:
+            # Повторная проверка: пока ждали блокировку, другой поток мог найти пояс
+            if key in self._cache:
+                return self._cache[key]
+            tz_cache_misses.inc()
+            # TimezoneFinder не потокобезопасен, поэтому поиск тоже под блокировкой
+            name = self._get_finder().timezone_at(lat=lat, lng=lon)
+            self._cache[key] = name
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return name
+
+
+service = TimezoneService()
+
+
+async def user_timezone_at(user, lat: float, lon: float) -> str:
+    """
+    Часовой пояс пользователя (UserRecord или None) в точке lat/lon. Пока
+    геопозиция не покинула ячейку сетки, в которой пояс был определён, берётся
+    пояс из профиля без поиска; в профиль пишется только изменившийся пояс.
+    """
+    from database import update_user_timezone
+    from services import offload
+
+    cell = service.cell(lat, lon)
+    if user is not None and user.timezone and user.timezone_cell == cell:
+        return user.timezone
+    name = await offload.tz_at(lat, lon) or "UTC"
+    if user is not None:
+        if name != user.timezone:
+            await update_user_timezone(user.user_id, name)
+        user.timezone_cell = cell
+    return name
+
+
+@lru_cache(maxsize=None)
+def get_tz(name: str):
+    """Кешированный объект pytz; для неизвестного пояса бросает UnknownTimeZoneError."""
+    return pytz.timezone(name)
@@ -0,0 +1,183 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import secrets
+import time
+from typing import Optional
+
+from aiogram import Bot
+from aiohttp import web
+
+from services.metrics import counter
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Типы обновлений, в которых лежит объект с полем "from"
+USER_UPDATE_KEYS = (
+    "message", "edited_message", "callback_query", "inline_query",
+    "chosen_inline_result", "shipping_query", "pre_checkout_query",
+    "my_chat_member", "chat_member", "chat_join_request"
+)
+
+updates_routed = counter("supervisor_updates_routed_total", "Обновления, переданные воркерам")
+workers_restarted = counter("supervisor_workers_restarted_total", "Перезапуски упавших воркеров")
+
+
+def update_user_id(update: dict) -> Optional[int]:
+    """Возвращает ID пользователя-отправителя из сырого обновления Telegram."""
+    for key in USER_UPDATE_KEYS:
+        payload = update.get(key)
+        if payload and "from" in payload:
+            return payload["from"]["id"]
+    return None
+
+
+def shard_for(update: dict, workers: int) -> int:
+    """Номер воркера для обновления: все обновления пользователя попадают в один процесс."""
+    user_id = update_user_id(update)
+    key = user_id if user_id is not None else update.get("update_id", 0)
+    return hash(key) % workers
+
+
+# Блок 1: Воркер
+def worker_main(index: int, queue) -> None:
+    """Точка входа процесса-воркера (запускается через spawn)."""
+    asyncio.run(_run_worker(index, queue))
+
+
+async def _run_worker(index: int, queue) -> None:
+    # Импорт внутри процесса; точку входа bot.py не импортируем: её код выполняет
+    # spawn (как __mp_main__), и диспетчер строится здесь один раз
+    from dispatcher import build_dispatcher
+    from scheduler import start_scheduler
+    from keyboards import start_menu_watcher
+    from services.occupancy import start_occupancy_watcher
+    from notifications import setup_notifications
+    from services.loop_monitor import start_loop_monitor
+
+    bot, dp = build_dispatcher(os.getenv("BOT_TOKEN"))
+    start_loop_monitor()
+    # События чек-инов публикуются в процессе, выполнившем запись, поэтому подписка — в каждом воркере
+    setup_notifications(bot)
+    # Планировщик запускается во всех воркерах, задачи выполняет владелец аренды в БД
+    start_scheduler()
+    # Каталог спотов могут менять другие воркеры
+    start_menu_watcher()
+    # Чек-ины пишут все воркеры: модель занятости сверяется с БД по поколению checkins
+    start_occupancy_watcher()
+
+    loop = asyncio.get_running_loop()
+    # Порядок обновлений одного пользователя обеспечивает UserLockMiddleware,
+    # поэтому каждое обновление обрабатывается отдельной задачей
+    tasks = set()
+    logger.info(f"Воркер {index} запущен")
+    while True:
+        update = await loop.run_in_executor(None, queue.get)
+        if update is None:
+            break
+        task = asyncio.create_task(dp.feed_raw_update(bot, update))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+    await bot.session.close()
+    logger.info(f"Воркер {index} остановлен")
+
+
+# Блок 2: Супервизор
+class Supervisor:
+    """
+    Принимает обновления (вебхук или polling) и раскладывает их по процессам-воркерам
+    по хэшу from_user.id. Состояние FSM каждого пользователя живёт в одном воркере,
+    общие данные — в SQLite. Задачи планировщика выполняет воркер, владеющий арендой.
+    """
+
+    def __init__(self, bot: Bot, workers: int, allowed_updates: list):
+        self.bot = bot
+        self.workers = workers
+        self.allowed_updates = allowed_updates
+        self._ctx = multiprocessing.get_context("spawn")
+        self.queues = [self._ctx.Queue() for _ in range(workers)]
+        self.processes = [None] * workers
+
+    def _start_worker(self, index: int) -> None:
+        process = self._ctx.Process(
+            target=worker_main,
+            args=(index, self.queues[index]),
+            name=f"bot-worker-{index}",
+            daemon=True
+        )
+        process.start()
+        self.processes[index] = process
+        logger.info(f"Запущен воркер {index} (pid {process.pid})")
+
+    def start(self) -> None:
+        for index in range(self.workers):
+            self._start_worker(index)
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """
+        Просит воркеров завершиться и ждёт их не дольше timeout. Ожидание —
+        опрос is_alive() через asyncio.sleep, а не join(): цикл событий
+        супервизора продолжает работать. Не успевшие завершиться воркеры
+        останавливаются принудительно.
+        """
+        for queue in self.queues:
+            queue.put(None)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and any(process is not None and process.is_alive() for process in self.processes):
+            await asyncio.sleep(0.1)
+        for index, process in enumerate(self.processes):
+            if process is not None and process.is_alive():
+                logger.warning(f"Воркер {index} не завершился за {timeout:.0f} с, останавливаем принудительно")
+                process.terminate()
+
+    def route(self, update: dict) -> None:
+        self.queues[shard_for(update, self.workers)].put(update)
+        updates_routed.inc()
+
+    async def watch(self, interval: float = 5.0) -> None:
+        """Перезапускает упавших воркеров; очередь воркера сохраняется."""
+        while True:
+            await asyncio.sleep(interval)
+            for index, process in enumerate(self.processes):
+                if process is not None and not process.is_alive():
+                    logger.error(f"Воркер {index} завершился с кодом {process.exitcode}, перезапускаем")
+                    workers_restarted.inc()
+                    self._start_worker(index)
+
+    def webhook_handler(self, secret_token: Optional[str]):
+        """aiohttp-обработчик вебхука: проверяет секрет и сразу отвечает Telegram."""
+        async def handle(request: web.Request) -> web.Response:
+            received = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+            if secret_token and not secrets.compare_digest(received, secret_token):
+                return web.Response(status=401, text="Unauthorized")
+            self.route(await request.json())
+            return web.Response()
+        return handle
+
+    async def poll(self, timeout: int = 30) -> None:
+        """Long polling в супервизоре, если вебхук не используется."""
+        await self.bot.delete_webhook(drop_pending_updates=False)
+        offset = None
+        backoff = 1
+        while True:
+            try:
+                updates = await self.bot.get_updates(
+                    offset=offset,
+                    timeout=timeout,
+                    allowed_updates=self.allowed_updates,
+                    request_timeout=timeout + 10
+                )
+                backoff = 1
+            except Exception as e:
+                logger.error(f"Ошибка получения обновлений: {e}")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                self.route(update.model_dump(mode="json", by_alias=True, exclude_none=True))
@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+# Модули бота импортируются от корня src, как при запуске python src/bot.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+os.environ.setdefault("BOT_TOKEN", "1:test")
+os.environ.setdefault("GITHUB_TOKEN", "test")
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Рабочий каталог с пустой data/: пути к БД и бэкапам в модулях относительные."""
+    (tmp_path / "data").mkdir()
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
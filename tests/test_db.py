@@ -0,0 +1,718 @@
+import asyncio
+import multiprocessing
+import os
+import sqlite3
+from datetime import datetime, timezone
+
+import aiosqlite
+import pytest
+import pytz
+
+from services import epoch
+
+# Схема checkins до перехода на секунды epoch: время хранилось строками ISO
+BASELINE_SCHEMA = '''
+    CREATE TABLE users (
+        user_id INTEGER PRIMARY KEY,
+        first_name TEXT,
+        last_name TEXT,
+        username TEXT,
+        is_admin BOOLEAN NOT NULL DEFAULT 0,
+        created_at TEXT NOT NULL,
+        timezone TEXT NOT NULL DEFAULT 'UTC'
+    );
+    CREATE TABLE spots (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        latitude REAL NOT NULL,
+        longitude REAL NOT NULL,
+        creator_id INTEGER NOT NULL
+    );
+    CREATE TABLE checkins (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        spot_id INTEGER NOT NULL,
+        timestamp TEXT NOT NULL,
+        active BOOLEAN NOT NULL DEFAULT 1,
+        checkin_type INTEGER NOT NULL,
+        duration_hours REAL,
+        arrival_time TEXT,
+        end_time TEXT
+    );
+    CREATE TABLE favorite_spots (
+        user_id INTEGER NOT NULL,
+        spot_id INTEGER NOT NULL,
+        PRIMARY KEY(user_id, spot_id)
+    );
+'''
+
+T0 = int(datetime(2025, 4, 1, 10, 0, tzinfo=timezone.utc).timestamp())
+
+
+def test_to_epoch_formats():
+    assert epoch.to_epoch("2025-04-01T10:00:00+00:00") == T0
+    assert epoch.to_epoch("2025-04-01T13:00:00+03:00") == T0
+    assert epoch.to_epoch("2025-04-01T10:00:00Z") == T0
+    # Наивное время (старые datetime.utcnow().isoformat()) считается UTC
+    assert epoch.to_epoch("2025-04-01T10:00:00.500000") == T0
+    assert epoch.to_epoch("2025-04-01 10:00:00") == T0
+    assert epoch.to_epoch(datetime(2025, 4, 1, 10, 0)) == T0
+    assert epoch.to_epoch(pytz.timezone("Europe/Moscow").localize(datetime(2025, 4, 1, 13, 0))) == T0
+    # Только время — текущие сутки UTC
+    today = datetime.utcnow().date()
+    assert epoch.to_epoch("21:47") == int(datetime(today.year, today.month, today.day, 21, 47, tzinfo=timezone.utc).timestamp())
+    assert epoch.to_epoch(T0) == T0
+    assert epoch.to_epoch(float(T0) + 0.9) == T0
+    assert epoch.to_epoch(str(T0)) == T0
+    assert epoch.to_epoch(None) is None
+    assert epoch.to_epoch("") is None
+    with pytest.raises(ValueError):
+        epoch.to_epoch("not a time")
+
+
+def test_to_datetime_roundtrip():
+    moment = epoch.to_datetime(T0, pytz.timezone("Europe/Moscow"))
+    assert moment.strftime("%H:%M") == "13:00"
+    assert epoch.to_epoch(moment) == T0
+    assert epoch.to_datetime(None) is None
+
+
+def _legacy_db(path):
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.execute("INSERT INTO users (user_id, first_name, created_at) VALUES (1, 'A', '2025-01-01T00:00:00')")
+    conn.execute("INSERT INTO spots (name, latitude, longitude, creator_id) VALUES ('S', 55.0, 37.0, 1)")
+    conn.executemany('''
+        INSERT INTO checkins (id, user_id, spot_id, timestamp, active, checkin_type, duration_hours, arrival_time, end_time)
+        VALUES (?, 1, 1, ?, ?, ?, ?, ?, ?)
+    ''', [
+        # Закрытый чек-ин «на споте»: наивный utcnow() и время с поясом вперемешку
+        (1, "2025-04-01T10:00:00.123456", 0, 1, 2.0, None, "2025-04-01T14:00:00+02:00"),
+        # План приезда со временем без даты и активный чек-ин со строкой epoch
+        (2, "2025-04-01 10:00:00", 0, 2, None, "12:30", None),
+        (3, str(T0), 1, 1, 1.5, None, str(T0 + 5400)),
+        # Нераспознаваемое время сбрасывается, начало берётся из конца сессии
+        (7, "garbage", 0, 1, 1.0, None, "2025-04-01T11:00:00+00:00"),
+    ])
+    conn.commit()
+    conn.close()
+
+
+def _checkins(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute('''
+            SELECT id, timestamp, active, checkin_type, duration_hours, arrival_time, end_time, closed_at
+            FROM checkins ORDER BY id
+        ''').fetchall()
+    finally:
+        conn.close()
+
+
+def test_migration_from_baseline_schema(workdir):
+    import database
+
+    _legacy_db(database.DB_PATH)
+    asyncio.run(database.init_db())
+
+    today = datetime.utcnow().date()
+    arrival = int(datetime(today.year, today.month, today.day, 12, 30, tzinfo=timezone.utc).timestamp())
+    migrated = _checkins(database.DB_PATH)
+    assert migrated == [
+        (1, T0, 0, 1, 2.0, None, T0 + 2 * epoch.HOUR, T0 + 2 * epoch.HOUR),
+        (2, T0, 0, 2, None, arrival, None, None),
+        (3, T0, 1, 1, 1.5, None, T0 + 5400, None),
+        (7, T0 + epoch.HOUR, 0, 1, 1.0, None, T0 + epoch.HOUR, T0 + epoch.HOUR),
+    ]
+    for row in migrated:
+        assert all(value is None or isinstance(value, (int, float)) for value in row)
+
+    conn = sqlite3.connect(database.DB_PATH)
+    try:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == database.SCHEMA_VERSION
+        # AUTOINCREMENT продолжает нумерацию после старых id
+        assert conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'checkins'").fetchone()[0] == 7
+        # Агрегаты пользователя пересчитаны из сконвертированных строк
+        first, last = conn.execute("SELECT first_session, last_session FROM user_stats WHERE user_id = 1").fetchone()
+        assert (first, last) == (T0, T0 + epoch.HOUR)
+    finally:
+        conn.close()
+
+
+def test_migration_is_idempotent(workdir):
+    import database
+
+    _legacy_db(database.DB_PATH)
+    asyncio.run(database.init_db())
+    migrated = _checkins(database.DB_PATH)
+
+    # Повторный старт не трогает данные
+    asyncio.run(database.init_db())
+    assert _checkins(database.DB_PATH) == migrated
+
+    # Повторный прогон самой миграции над целыми секундами тоже ничего не меняет
+    async def rerun():
+        async with aiosqlite.connect(database.DB_PATH) as conn:
+            await database._migrate_to_epoch(conn)
+        await database.init_db()
+
+    asyncio.run(rerun())
+    assert _checkins(database.DB_PATH) == migrated
+
+
+def test_location_time_migrated_to_epoch(workdir, monkeypatch):
+    import database
+    from services.geo import LocationStore
+
+    asyncio.run(database.init_db())
+    # База версии 1: время геопозиции хранилось строкой ISO в колонке TEXT
+    conn = sqlite3.connect(database.DB_PATH)
+    conn.execute("ALTER TABLE users DROP COLUMN location_updated_at")
+    conn.execute("ALTER TABLE users ADD COLUMN location_updated_at TEXT")
+    conn.executemany('''
+        INSERT INTO users (user_id, first_name, created_at, last_lat, last_lon, location_updated_at)
+        VALUES (?, 'U', '2025-01-01T00:00:00', 55.0, 37.0, ?)
+    ''', [(1, "2025-04-01T13:00:00+03:00"), (2, "garbage")])
+    conn.execute("PRAGMA user_version = 1")
+    conn.commit()
+    conn.close()
+
+    asyncio.run(database.init_db())
+    conn = sqlite3.connect(database.DB_PATH)
+    try:
+        rows = conn.execute("SELECT user_id, location_updated_at, typeof(location_updated_at) FROM users ORDER BY user_id").fetchall()
+        assert rows == [(1, T0, "integer"), (2, None, "null")]
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == database.SCHEMA_VERSION
+    finally:
+        conn.close()
+
+    # Новые записи — тоже целые секунды; срок геопозиции из БД проверяется без разбора строк
+    monkeypatch.setattr(epoch, "now", lambda: T0 + epoch.HOUR)
+    asyncio.run(database.update_user_location(2, 56.0, 38.0))
+    assert asyncio.run(database.get_user_location(2)) == (56.0, 38.0, T0 + epoch.HOUR)
+    monkeypatch.setattr("services.geo.time.time", lambda: T0 + 2 * epoch.HOUR)
+    store = LocationStore(ttl=2 * epoch.HOUR)
+    assert asyncio.run(store.get(1)) == (55.0, 37.0)
+    assert asyncio.run(store.get(2, max_age=epoch.HOUR - 1)) is None
+
+
+def test_bin_sessions_sums_minutes_by_week_hour():
+    from services.rollups import bin_sessions, HOURS_PER_WEEK
+
+    sunday_23 = T0 + 5 * epoch.DAY + 13 * epoch.HOUR
+    # (id, spot_id, timestamp, end_time, closed_at); T0 — вторник 10:00 UTC
+    sessions = [
+        (1, 1, T0, T0 + 90 * 60, T0 + 5 * epoch.HOUR),  # 90 минут: время истекло раньше ухода
+        (2, 1, T0 + 30 * 60, T0 + 4 * epoch.HOUR, T0 + 45 * 60),  # 15 минут: ушёл раньше срока
+        (3, 2, sunday_23, sunday_23 + 2 * epoch.HOUR, sunday_23 + 3 * epoch.HOUR),  # через конец недели
+        (4, 2, T0, T0, T0),  # пустая сессия не учитывается
+    ]
+    hours = bin_sessions(sessions)
+
+    assert set(hours) == {1, 2}
+    assert all(len(spot_hours) == HOURS_PER_WEEK for spot_hours in hours.values())
+    # Сумма по часам совпадает с суммарной длительностью сессий
+    assert sum(hours[1]) == 90 + 15
+    assert sum(hours[2]) == 120
+    tuesday_10 = 1 * 24 + 10
+    assert (hours[1][tuesday_10], hours[1][tuesday_10 + 1]) == (60 + 15, 30)
+    assert (hours[2][HOURS_PER_WEEK - 1], hours[2][0]) == (60, 60)
+
+
+def test_backup_full_and_delta_restore_byte_identical(workdir):
+    from services.backup import run_backup, restore_backup, _take_snapshot, MANIFEST_NAME, PAGE_HASHES_NAME
+
+    db_path, backup_dir = "data/source.db", "data/backups"
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE notes (id INTEGER PRIMARY KEY, body TEXT)")
+    conn.executemany("INSERT INTO notes (body) VALUES (?)", [("x" * 500,) for _ in range(200)])
+    conn.commit()
+    assert run_backup(db_path, backup_dir).startswith("full-")
+
+    # Изменение части страниц и рост файла попадают в дельту
+    conn.execute("UPDATE notes SET body = 'changed' WHERE id % 50 = 0")
+    conn.executemany("INSERT INTO notes (body) VALUES (?)", [("y" * 500,) for _ in range(100)])
+    conn.commit()
+    assert run_backup(db_path, backup_dir).startswith("delta-")
+    # Без изменений новый файл не создаётся, а манифест не переписывается
+    manifest_path = os.path.join(backup_dir, MANIFEST_NAME)
+    with open(manifest_path, "rb") as f:
+        manifest = f.read()
+    assert run_backup(db_path, backup_dir) is None
+    with open(manifest_path, "rb") as f:
+        assert f.read() == manifest
+    # Хэши страниц лежат отдельно от коммитимого манифеста
+    assert b"page_hashes\"" not in manifest
+    assert os.path.getsize(os.path.join(backup_dir, PAGE_HASHES_NAME)) == os.path.getsize(db_path) // 4096 * 8
+
+    restore_backup("data/restored.db", backup_dir)
+    _take_snapshot(db_path, "data/expected.db")
+    with open("data/restored.db", "rb") as restored, open("data/expected.db", "rb") as expected:
+        assert restored.read() == expected.read()
+
+    # Без локальных хэшей (каталог бэкапов с другой машины) дельту не посчитать — снимается полная копия
+    os.remove(os.path.join(backup_dir, PAGE_HASHES_NAME))
+    conn.execute("UPDATE notes SET body = 'again' WHERE id = 1")
+    conn.commit()
+    conn.close()
+    assert run_backup(db_path, backup_dir).startswith("full-")
+
+
+def _add_sessions(sessions):
+    """Закрытые сессии «Я на споте»: (spot_id, начало, конец выбранного времени, уход)."""
+    import database
+
+    conn = sqlite3.connect(database.DB_PATH)
+    conn.executemany('''
+        INSERT INTO checkins (user_id, spot_id, timestamp, active, checkin_type, duration_hours, end_time, closed_at)
+        VALUES (1, ?, ?, 0, 1, 2, ?, ?)
+    ''', sessions)
+    conn.commit()
+    conn.close()
+
+
+def _run_rollup():
+    from services.rollups import run_hourly_rollup
+
+    return asyncio.run(run_hourly_rollup())
+
+
+def test_hourly_rollup_job(workdir):
+    import database
+
+    asyncio.run(database.init_db())
+    asyncio.run(database.add_spot("S", 55.0, 37.0, 1))
+    _add_sessions([
+        (1, T0, T0 + 2 * epoch.HOUR, T0 + 90 * 60),
+        (1, T0 + 7 * epoch.DAY, T0 + 7 * epoch.DAY + 30 * 60, T0 + 7 * epoch.DAY + epoch.HOUR),
+    ])
+
+    assert _run_rollup() == 2
+    # Водяной знак не даёт учесть те же сессии повторно
+    assert _run_rollup() == 0
+    hours = asyncio.run(database.get_spot_hourly([1]))[1]
+    tuesday_10 = 1 * 24 + 10
+    assert (hours[tuesday_10], hours[tuesday_10 + 1]) == (60 + 30, 30)
+    assert sum(hours) == 90 + 30
+
+
+def test_hourly_rollup_runs_in_daemon_worker(workdir):
+    import database
+
+    asyncio.run(database.init_db())
+    asyncio.run(database.add_spot("S", 55.0, 37.0, 1))
+    _add_sessions([(1, T0, T0 + epoch.HOUR, T0 + epoch.HOUR)])
+    # Процессы-воркеры бота — daemon: задача не должна запускать дочерние процессы
+    process = multiprocessing.get_context("spawn").Process(target=_run_rollup, daemon=True)
+    process.start()
+    process.join(timeout=60)
+    assert process.exitcode == 0
+    assert sum(asyncio.run(database.get_spot_hourly([1]))[1]) == 60
+
+
+def _occupancy_model(monkeypatch):
+    from services.events import bus, CheckinEvent, SpotChanged
+    from services.occupancy import OccupancyModel
+
+    model = OccupancyModel()
+    monkeypatch.setattr(bus, "_sync", bus._sync + [((CheckinEvent, SpotChanged), model.on_event)])
+    return model
+
+
+def test_occupancy_model_follows_own_and_other_writes(workdir, monkeypatch):
+    import database
+    from services.events import Arrived
+
+    model = _occupancy_model(monkeypatch)
+
+    async def scenario():
+        await database.init_db()
+        await database.add_or_update_user(101, "Ann")
+        await database.add_or_update_user(102, "Bob")
+        spot_id = await database.add_spot("S", 55.0, 37.0, 101)
+        assert await model.active_spot_ids() == frozenset()
+
+        # Свои записи приходят через шину: сверка по изменившимся спотам их не перечитывает как новые
+        checkin_id = await database.checkin_user(101, spot_id, 1)
+        await database.activate_checkin(checkin_id, 2.0)
+        version, entries = (await model.spot_checkins([spot_id]))[spot_id]
+        assert entries == [(101, 1, None)]
+        assert await model.reconcile(full=False) == 0
+        assert (await model.spot_checkins([spot_id]))[spot_id][0] == version
+
+        # Запись другого процесса (мимо шины этого) — обновление, а не расхождение
+        async with aiosqlite.connect(database.DB_PATH) as conn:
+            await conn.execute('''
+                INSERT INTO checkins (user_id, spot_id, timestamp, active, checkin_type, arrival_time)
+                VALUES (102, ?, ?, 1, 2, ?)
+            ''', (spot_id, T0, T0 + epoch.HOUR))
+            await conn.commit()
+        assert await model.reconcile(full=False) == 0
+        version2, entries = (await model.spot_checkins([spot_id]))[spot_id]
+        assert version2 != version
+        assert entries == [(101, 1, None), (102, 2, T0 + epoch.HOUR)]
+
+        # Событие, которому нет записи в БД, исправляет только полная сверка — это и есть drift
+        model.on_event(Arrived(10_000, 102, spot_id, 1.0, T0))
+        assert await model.reconcile(full=False) == 0
+        assert await model.reconcile() == 1
+        assert (await model.spot_checkins([spot_id]))[spot_id][1] == entries
+
+        await database.checkout_user(checkin_id)
+        assert await model.reconcile() == 0
+        assert (await model.spot_checkins([spot_id]))[spot_id][1] == [(102, 2, T0 + epoch.HOUR)]
+
+    asyncio.run(scenario())
+
+
+def test_spot_cards_are_built_from_occupancy_model(workdir, monkeypatch):
+    import cards
+    import database
+
+    model = _occupancy_model(monkeypatch)
+    monkeypatch.setattr(cards, "occupancy", model)
+    cache = cards.CardCache()
+
+    async def scenario():
+        await database.init_db()
+        await database.add_or_update_user(201, "Cat")
+        spot_id = await database.add_spot("S", 55.0, 37.0, 201)
+        empty = (await cache.get_many([spot_id]))[spot_id]
+        assert not empty.active
+        assert (await cache.get_many([spot_id]))[spot_id] is empty
+
+        await database.checkin_user(201, spot_id, 2, arrival_time=T0)
+        card = (await cache.get_many([spot_id]))[spot_id]
+        assert card is not empty
+        assert card.occupancy == (0, [], [database.Visitor("Cat", T0)])
+        # Сверка без изменений не меняет версию: карточка остаётся в кеше
+        await model.reconcile()
+        assert (await cache.get_many([spot_id]))[spot_id] is card
+
+    asyncio.run(scenario())
+
+
+def _table(name, order_by):
+    import database
+
+    conn = sqlite3.connect(database.DB_PATH)
+    try:
+        return conn.execute(f"SELECT * FROM {name} ORDER BY {order_by}").fetchall()
+    finally:
+        conn.close()
+
+
+def _checkin_history(monkeypatch):
+    """Чек-ины пользователя 1 на двух спотах: подтверждённые, отменённые и выход; возвращает id спотов."""
+    import database
+
+    def at(moment):
+        monkeypatch.setattr(epoch, "now", lambda: moment)
+
+    async def history():
+        await database.add_or_update_user(1, "Ann")
+        first = await database.add_spot("First", 55.0, 37.0, 1)
+        second = await database.add_spot("Second", 56.0, 38.0, 1)
+        at(T0)
+        checkin_id = await database.checkin_user(1, first, 1)
+        await database.activate_checkin(checkin_id, 2.0)
+        # Новый план приезда закрывает чек-ин на первом споте
+        at(T0 + 3 * epoch.HOUR)
+        planned_id = await database.checkin_user(1, second, 2, arrival_time=T0 + 4 * epoch.HOUR)
+        at(T0 + 4 * epoch.HOUR)
+        await database.update_checkin_to_arrived(planned_id, 1.5)
+        at(T0 + 6 * epoch.HOUR)
+        await database.checkout_user(planned_id)
+        # Отменённый план и чек-ин без выбранной длительности в статистику не попадают
+        at(T0 + 7 * epoch.HOUR)
+        cancelled_id = await database.checkin_user(1, second, 2, arrival_time=T0 + 8 * epoch.HOUR)
+        assert await database.delete_planned_checkin(cancelled_id, 1)
+        unconfirmed_id = await database.checkin_user(1, first, 1)
+        assert await database.delete_unconfirmed_checkin(unconfirmed_id)
+        return first, second
+
+    asyncio.run(database.init_db())
+    return asyncio.run(history())
+
+
+def test_user_stats_follow_checkins_via_triggers(workdir, monkeypatch):
+    import database
+    from rows import UserStats
+
+    first, second = _checkin_history(monkeypatch)
+    stats = asyncio.run(database.get_user_stats(1))
+    # Любимый спот при равном числе чек-инов — с большим временем
+    assert stats == UserStats(2, 3.5, T0, T0 + 4 * epoch.HOUR, first, "First", None)
+
+    # Агрегаты триггеров совпадают с полным пересчётом по истории
+    maintained = _table("user_stats", "user_id"), _table("user_spot_stats", "user_id, spot_id")
+    assert asyncio.run(database.rebuild_user_stats()) == 1
+    assert (_table("user_stats", "user_id"), _table("user_spot_stats", "user_id, spot_id")) == maintained
+
+
+def test_spot_popularity_pages_by_key(workdir, monkeypatch):
+    import database
+
+    first, second = _checkin_history(monkeypatch)
+    # Отменённые чек-ины вычтены триггерами
+    assert _table("spot_popularity", "spot_id") == [(first, 1), (second, 1)]
+
+    conn = sqlite3.connect(database.DB_PATH)
+    counts = [3, 0, 2, 3, 1, 0, 2, 3, 1]
+    for i, count in enumerate(counts):
+        spot_id = conn.execute(
+            "INSERT INTO spots (name, latitude, longitude, creator_id) VALUES (?, 55.0, 37.0, 1)", (f"S{i}",)
+        ).lastrowid
+        conn.executemany('''
+            INSERT INTO checkins (user_id, spot_id, timestamp, active, checkin_type, duration_hours, end_time, closed_at)
+            VALUES (1, ?, ?, 0, 1, 1, ?, ?)
+        ''', [(spot_id, T0, T0 + epoch.HOUR, T0 + epoch.HOUR)] * count)
+    conn.commit()
+    expected = conn.execute('''
+        SELECT s.id, (SELECT COUNT(*) FROM checkins_all c WHERE c.spot_id = s.id) AS checkins
+        FROM spots s ORDER BY checkins DESC, s.id
+    ''').fetchall()
+    conn.close()
+
+    # Страницы по ключу (популярность, id) без пропусков и повторов при равной популярности
+    pages, after = [], None
+    while True:
+        page = asyncio.run(database.get_spots_by_popularity(after, limit=2))
+        if not page:
+            break
+        pages.append(page)
+        after = (page[-1].popularity, page[-1].id)
+    assert [(spot.id, spot.popularity) for page in pages for spot in page] == expected
+    assert all(len(page) == 2 for page in pages[:-1])
+
+
+def test_archive_keeps_history_and_waits_for_rollup(workdir, monkeypatch):
+    import database
+    import scheduler
+    from services.rollups import HOURLY_ROLLUP
+
+    asyncio.run(database.init_db())
+    asyncio.run(database.add_or_update_user(1, "Ann"))
+    asyncio.run(database.add_spot("S", 55.0, 37.0, 1))
+    _add_sessions([
+        (1, T0 - epoch.HOUR, T0 + epoch.HOUR, T0),
+        (1, T0 + 10 * epoch.DAY - epoch.HOUR, T0 + 10 * epoch.DAY, T0 + 10 * epoch.DAY),
+        (1, T0 + 59 * epoch.DAY - epoch.HOUR, T0 + 59 * epoch.DAY, T0 + 59 * epoch.DAY),
+    ])
+    conn = sqlite3.connect(database.DB_PATH)
+    # Активный чек-ин не архивируется, каким бы старым он ни был
+    conn.execute('''
+        INSERT INTO checkins (user_id, spot_id, timestamp, active, checkin_type, duration_hours, end_time)
+        VALUES (1, 1, ?, 1, 1, 2, ?)
+    ''', (T0 + 20 * epoch.DAY, T0 + 61 * epoch.DAY))
+    conn.commit()
+    conn.close()
+    stats = asyncio.run(database.get_user_stats(1))
+    popularity = _table("spot_popularity", "spot_id")
+
+    def archive(watermark):
+        conn = sqlite3.connect(database.DB_PATH)
+        conn.execute("INSERT OR REPLACE INTO rollup_watermarks (name, closed_at, checkin_id) VALUES (?, ?, ?)", (HOURLY_ROLLUP, *watermark))
+        conn.commit()
+        conn.close()
+        asyncio.run(scheduler.archive_checkins.__wrapped__())
+        return [row[0] for row in _table("checkins_archive", "id")], [row[0] for row in _table("checkins", "id")]
+
+    monkeypatch.setattr(epoch, "now", lambda: T0 + 60 * epoch.DAY)
+    monkeypatch.setattr(scheduler, "ARCHIVE_BATCH", 1)
+    monkeypatch.setattr(scheduler, "ARCHIVE_PAUSE", 0)
+    # Сессия 2 старше 30 дней, но ещё не учтена в почасовой занятости
+    assert archive((T0 + 10 * epoch.DAY, 2)) == ([1], [2, 3, 4])
+    assert archive((T0 + 59 * epoch.DAY, 3)) == ([1, 2], [3, 4])
+
+    # История читается через checkins_all, агрегаты перенос не меняет
+    conn = sqlite3.connect(database.DB_PATH)
+    try:
+        assert [row[0] for row in conn.execute("SELECT id FROM checkins_all ORDER BY id")] == [1, 2, 3, 4]
+    finally:
+        conn.close()
+    assert asyncio.run(database.get_user_stats(1)) == stats
+    # Первая сессия — уже в архиве
+    assert stats.checkins == 4 and stats.first_session == T0 - epoch.HOUR
+    assert _table("spot_popularity", "spot_id") == popularity
+    assert asyncio.run(database.rebuild_user_stats()) == 1
+    assert asyncio.run(database.get_user_stats(1)) == stats
+
+
+def test_card_cache_invalidated_by_spot_version(workdir, monkeypatch):
+    import cards
+    import database
+
+    model = _occupancy_model(monkeypatch)
+    monkeypatch.setattr(cards, "occupancy", model)
+    clock = [1000.0]
+    monkeypatch.setattr(cards.time, "monotonic", lambda: clock[0])
+    cache = cards.CardCache(size=2, ttl=600)
+
+    async def scenario():
+        await database.init_db()
+        await database.add_or_update_user(301, "Dan")
+        busy = await database.add_spot("Busy", 55.0, 37.0, 301)
+        quiet = await database.add_spot("Quiet", 56.0, 38.0, 301)
+        before = await cache.get_many([busy, quiet])
+        assert cache.forecast_text(busy, {"speed": 5.0, "direction": 90}) == cache.forecast_text(busy, {"speed": 5.0, "direction": 90})
+
+        # Чек-ин другого процесса: версия спота в модели меняется после сверки
+        conn = sqlite3.connect(database.DB_PATH)
+        conn.execute('''
+            INSERT INTO checkins (user_id, spot_id, timestamp, active, checkin_type, duration_hours, end_time)
+            VALUES (301, ?, ?, 1, 1, 2, ?)
+        ''', (busy, T0, T0 + 2 * epoch.HOUR))
+        conn.commit()
+        conn.close()
+        assert (await cache.get_many([busy]))[busy] is before[busy]
+        await model.reconcile(full=False)
+        after = await cache.get_many([busy, quiet])
+        assert after[busy] is not before[busy] and after[busy].occupancy == (1, [database.Visitor("Dan")], [])
+        assert after[quiet] is before[quiet]
+        assert "Dan" in after[busy].occupancy_text(pytz.utc)
+
+        # Страховочный срок жизни карточки
+        clock[0] += 601
+        assert (await cache.get_many([quiet]))[quiet] is not before[quiet]
+
+        # Вытеснение самой старой карточки вместе с её прогнозом
+        third = await database.add_spot("Third", 57.0, 39.0, 301)
+        await cache.get_many([third])
+        assert busy not in cache._cards and busy not in cache._forecasts
+
+    asyncio.run(scenario())
+
+
+def test_generation_counters_track_each_table(workdir):
+    import database
+
+    async def scenario():
+        await database.init_db()
+        spots, everything = await database.get_generation("spots"), await database.get_generation()
+        assert await database.changed_since(spots, "spots") == (False, spots)
+
+        spot_id = await database.add_spot("S", 55.0, 37.0, 1)
+        changed, spots_after = await database.changed_since(spots, "spots")
+        assert changed and spots_after > spots
+
+        # Запись в другую таблицу меняет её счётчик и общий, но не счётчик спотов
+        favorites = await database.get_generation("favorite_spots")
+        await database.add_favorite_spot(1, spot_id)
+        assert await database.get_generation("favorite_spots") > favorites
+        assert await database.changed_since(spots_after, "spots") == (False, spots_after)
+        assert await database.get_generation() > everything
+
+    asyncio.run(scenario())
+
+
+def test_scheduler_lease_has_one_owner(workdir, monkeypatch):
+    import database
+    import scheduler
+
+    clock = [T0]
+    monkeypatch.setattr(database.time, "time", lambda: clock[0])
+
+    async def scenario():
+        await database.init_db()
+        assert await database.acquire_lease("scheduler", "a", 60)
+        assert not await database.acquire_lease("scheduler", "b", 60)
+        # Владелец продлевает аренду, чужой забирает её только после истечения
+        clock[0] += 50
+        assert await database.acquire_lease("scheduler", "a", 60)
+        clock[0] += 50
+        assert not await database.acquire_lease("scheduler", "b", 60)
+        clock[0] += 11
+        assert await database.acquire_lease("scheduler", "b", 60)
+        await database.release_lease("scheduler", "a")
+        assert not await database.acquire_lease("scheduler", "a", 60)
+        await database.release_lease("scheduler", "b")
+        assert await database.acquire_lease("scheduler", "a", 60)
+
+    asyncio.run(scenario())
+
+    # Задача с leader_only выполняется только у действующего владельца аренды
+    runs = []
+
+    @scheduler.leader_only
+    async def job():
+        runs.append(True)
+
+    monkeypatch.setattr(scheduler, "_lease_valid_until", 0.0)
+    asyncio.run(job())
+    monkeypatch.setattr(scheduler, "_lease_valid_until", clock[0] + scheduler.LEASE_TTL)
+    asyncio.run(job())
+    assert runs == [True]
+
+
+def test_user_cache_is_bounded_and_expires(workdir, monkeypatch):
+    import database
+    from collections import OrderedDict
+
+    monkeypatch.setattr(database, "_user_cache", OrderedDict())
+    monkeypatch.setattr(database, "_admin_ids", set())
+    monkeypatch.setattr(database, "_admin_ids_loaded_at", None)
+    monkeypatch.setattr(database, "USER_CACHE_SIZE", 2)
+    misses = database.user_cache_misses
+
+    async def scenario():
+        await database.init_db()
+        for user_id in (1, 2, 3):
+            await database.add_or_update_user(user_id, f"U{user_id}")
+        # Размер ограничен: самый давний профиль вытеснен
+        assert list(database._user_cache) == [2, 3]
+        before = misses.value
+        assert (await database.get_user(3)).first_name == "U3"
+        await database.update_user_timezone(3, "Europe/Moscow")
+        assert (await database.get_user(3)).timezone == "Europe/Moscow"
+        assert misses.value == before
+        assert (await database.get_user(1)).first_name == "U1"
+        assert misses.value == before + 1
+
+        # Права, выданные в БД вручную, и новое имя видны после USER_CACHE_TTL
+        assert not await database.is_user_admin(3)
+        conn = sqlite3.connect(database.DB_PATH)
+        conn.execute("UPDATE users SET is_admin = 1, first_name = 'Renamed' WHERE user_id = 3")
+        conn.commit()
+        conn.close()
+        assert not await database.is_user_admin(3)
+        assert (await database.get_user(3)).first_name == "U3"
+        monkeypatch.setattr(database, "USER_CACHE_TTL", 0)
+        assert await database.is_user_admin(3)
+        assert (await database.get_user(3)).first_name == "Renamed"
+
+    asyncio.run(scenario())
+
+
+def test_favorites_index_applies_own_writes_and_sees_others(workdir, monkeypatch):
+    import database
+
+    index = database.FavoritesIndex(check_interval=3600)
+    monkeypatch.setattr(database, "favorites", index)
+    reloads = database.favorites_reloads
+
+    async def scenario():
+        await database.init_db()
+        await database.add_favorite_spot(1, 10)
+        assert await database.get_favorite_spots(1) == [10]
+        loaded = reloads.value
+        # Свои записи применяются к индексу без перечитывания таблицы
+        await database.add_favorite_spot(1, 11)
+        await database.add_favorite_spot(2, 11)
+        await database.remove_favorite_spot(1, 10)
+        assert await index.spots_of(1) == frozenset({11})
+        assert await index.followers(11) == frozenset({1, 2})
+        assert reloads.value == loaded
+
+        # Запись другого процесса видна после интервала сверки по поколению
+        conn = sqlite3.connect(database.DB_PATH)
+        conn.execute("INSERT INTO favorite_spots (user_id, spot_id) VALUES (3, 11)")
+        conn.commit()
+        conn.close()
+        await database.add_favorite_spot(1, 12)
+        index.check_interval = 0
+        assert await index.followers(11) == frozenset({1, 2, 3})
+        assert await index.spots_of(1) == frozenset({11, 12})
+        assert reloads.value == loaded + 1
+
+    asyncio.run(scenario())
@@ -0,0 +1,316 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+from aiogram.methods import AnswerCallbackQuery
+from aiogram.types import CallbackQuery, User
+
+import middlewares
+from middlewares import ThrottlingMiddleware
+
+USER = User(id=42, is_bot=False, first_name="Test")
+
+
+class FakeCallback(CallbackQuery):
+    """CallbackQuery без бота: answer() только запоминает текст."""
+
+    async def answer(self, text=None, **kwargs):
+        answers.append(text)
+
+
+answers = []
+
+
+def press(middleware, data, at, monkeypatch):
+    """Нажатие кнопки в момент at; возвращает, дошло ли оно до обработчика."""
+    monkeypatch.setattr(middlewares.time, "monotonic", lambda: at)
+    handled = []
+
+    async def handler(event, data):
+        handled.append(event)
+
+    event = FakeCallback(id=str(at), from_user=USER, chat_instance="chat", data=data)
+    asyncio.run(middleware(handler, event, {"event_from_user": USER}))
+    return bool(handled)
+
+
+def test_action_ignores_ids_and_page_cursors():
+    def action(data):
+        return ThrottlingMiddleware.action_for(FakeCallback(id="1", from_user=USER, chat_instance="chat", data=data))
+
+    assert action("plan_to_arrive_15") == "plan_to_arrive"
+    assert action("spots_page:p:12:34") == action("spots_page:d:500:7") == "spots_page"
+    assert action("nearby_spots") == "nearby_spots"
+
+
+def test_repeated_presses_do_not_extend_dedup_window(monkeypatch):
+    middleware = ThrottlingMiddleware("test_dedup", rate=100, burst=100, dedup_window=1.5)
+    assert press(middleware, "profile", 0.0, monkeypatch)
+    assert not press(middleware, "profile", 1.0, monkeypatch)
+    # Окно отсчитывается от принятого нажатия в 0.0, а не от повтора в 1.0
+    assert press(middleware, "profile", 2.0, monkeypatch)
+
+
+def test_heavy_screen_limit(monkeypatch):
+    middleware = ThrottlingMiddleware("test_heavy", limits={"nearby_spots": (1 / 10, 2)})
+    assert press(middleware, "nearby_spots", 0.0, monkeypatch)
+    assert press(middleware, "nearby_spots", 2.0, monkeypatch)
+    assert not press(middleware, "nearby_spots", 4.0, monkeypatch)
+    assert press(middleware, "nearby_spots", 14.0, monkeypatch)
+
+
+def test_user_lock_serializes_one_user_only():
+    middleware = middlewares.UserLockMiddleware()
+    log = []
+
+    async def handler(event, data):
+        log.append(("start", event))
+        await asyncio.sleep(0.02)
+        log.append(("end", event))
+
+    async def scenario():
+        other = User(id=7, is_bot=False, first_name="Other")
+        await asyncio.gather(
+            middleware(handler, "a1", {"event_from_user": USER}),
+            middleware(handler, "a2", {"event_from_user": USER}),
+            middleware(handler, "b1", {"event_from_user": other}),
+        )
+
+    asyncio.run(scenario())
+    # Обновления одного пользователя — по очереди и в порядке поступления, другого — параллельно
+    assert log.index(("end", "a1")) < log.index(("start", "a2"))
+    assert log.index(("start", "b1")) < log.index(("end", "a1"))
+    # Блокировки пользователей без ожидающих обновлений удаляются
+    assert middleware._locks == {}
+
+
+class FakeAnswerBot:
+    """Бот, чьи запросы проходят через middleware сессии; ответ на callback идёт delay секунд."""
+
+    def __init__(self, callback_answers, delay, failures=0):
+        self.interceptor = callback_answers.request_middleware
+        self.delay = delay
+        self.failures = failures
+        self.requests = []
+        self.completed = []
+        self.messages = []
+
+    async def _make_request(self, bot, method):
+        self.requests.append(method)
+        await asyncio.sleep(self.delay)
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("network")
+        self.completed.append(method)
+        return True
+
+    async def __call__(self, method):
+        return await self.interceptor(self._make_request, self, method)
+
+    async def send_message(self, chat_id, text):
+        self.messages.append(text)
+
+
+def run_callback(callback_answers, bot, handler_time):
+    query = SimpleNamespace(id="q1", message=None)
+
+    async def handler(event, data):
+        await asyncio.sleep(handler_time)
+
+    async def scenario():
+        await callback_answers(handler, SimpleNamespace(callback_query=query), {"bot": bot})
+        # Дать завершиться автоответу, если он ещё идёт
+        await asyncio.sleep(bot.delay * 2)
+
+    asyncio.run(scenario())
+
+
+def test_auto_answer_survives_handler_finishing_mid_request():
+    callback_answers = middlewares.CallbackAnswerMiddleware(budget=0.01)
+    bot = FakeAnswerBot(callback_answers, delay=0.05)
+    # Обработчик завершается, пока автоответ ещё в пути: запрос не обрывается и не дублируется
+    run_callback(callback_answers, bot, handler_time=0.02)
+    assert len(bot.requests) == 1
+    assert len(bot.completed) == 1
+
+
+def test_failed_auto_answer_is_retried_and_late_text_delivered():
+    callback_answers = middlewares.CallbackAnswerMiddleware(budget=0.01)
+    bot = FakeAnswerBot(callback_answers, delay=0.02, failures=1)
+    run_callback(callback_answers, bot, handler_time=0.04)
+    # Неудачный автоответ не считается подтверждением: финальный ответ отправляется снова
+    assert len(bot.requests) == 2
+    assert len(bot.completed) == 1
+
+    bot = FakeAnswerBot(callback_answers, delay=0.05)
+    query = SimpleNamespace(id="q1", message=SimpleNamespace(chat=SimpleNamespace(id=7)))
+
+    async def handler(event, data):
+        await asyncio.sleep(0.02)
+        # Ответ обработчика во время автоответа ждёт его и приходит сообщением
+        await bot(AnswerCallbackQuery(callback_query_id="q1", text="Готово"))
+
+    asyncio.run(callback_answers(handler, SimpleNamespace(callback_query=query), {"bot": bot}))
+    assert len(bot.completed) == 1
+    assert bot.messages == ["Готово"]
+
+
+def test_timezone_is_reused_within_grid_cell(workdir, monkeypatch):
+    import database
+    from services import offload, timezones
+
+    lookups, writes = [], []
+
+    async def tz_at(lat, lon):
+        lookups.append((lat, lon))
+        return "Europe/Moscow" if lat < 50 else "Asia/Yekaterinburg"
+
+    update_user_timezone = database.update_user_timezone
+
+    async def counting_update(user_id, timezone):
+        writes.append(timezone)
+        await update_user_timezone(user_id, timezone)
+
+    monkeypatch.setattr(offload, "tz_at", tz_at)
+    monkeypatch.setattr(database, "update_user_timezone", counting_update)
+
+    async def scenario():
+        await database.init_db()
+        await database.add_or_update_user(user_id=42, first_name="Test", last_name=None, username=None, timezone="Europe/Moscow")
+        user = await database.get_user(42)
+        names = [await timezones.user_timezone_at(user, lat, 37.6) for lat in (45.0, 45.001, 45.002, 55.0)]
+        return names, (await database.get_user(42)).timezone
+
+    names, stored = asyncio.run(scenario())
+    assert names == ["Europe/Moscow", "Europe/Moscow", "Europe/Moscow", "Asia/Yekaterinburg"]
+    # Поиск — при первом показе и после выхода из ячейки; запись — только при смене пояса
+    assert len(lookups) == 2
+    assert writes == ["Asia/Yekaterinburg"]
+    assert stored == "Asia/Yekaterinburg"
+
+
+def test_spot_index_pages_match_full_sort(workdir):
+    import random
+
+    import database
+    from services.geo import GeoService, SpotIndex
+
+    rng = random.Random(7)
+    points = [(rng.uniform(50, 60), rng.uniform(30, 40)) for _ in range(200)]
+    # Несколько спотов в одной точке: порядок внутри страницы задаёт spot_id
+    points += [points[0]] * 3
+
+    async def build():
+        await database.init_db()
+        for i, (lat, lon) in enumerate(points):
+            await database.add_spot(f"spot {i}", lat, lon, 1)
+        index = SpotIndex(cell_deg=0.5)
+        await index.refresh()
+        return index
+
+    index = asyncio.run(build())
+    assert len(index) == len(points)
+
+    user = (55.3, 35.1)
+    expected = sorted(
+        (round(GeoService.calculate_distance(*user, lat, lon) * 1000), spot_id)
+        for spot_id, (lat, lon) in enumerate(points, start=1)
+    )
+
+    keys, after = [], None
+    while True:
+        page = index.page(*user, after=after, limit=7)
+        if not page:
+            break
+        keys += [key for key, spot, distance in page]
+        assert all(key[1] == spot.id for key, spot, distance in page)
+        after = page[-1][0]
+    assert keys == expected
+
+
+class FakeScreenMessage:
+    """Сообщение, у которого первые правки отклоняются указанными ошибками."""
+
+    def __init__(self, failures):
+        self.failures = list(failures)
+        self.text = None
+        self.markup = None
+        self.edits = 0
+
+    async def answer(self, text, parse_mode=None, reply_markup=None):
+        self.text, self.markup = text, reply_markup
+        return self
+
+    async def edit_text(self, text, parse_mode=None):
+        self.edits += 1
+        if self.failures:
+            raise self.failures.pop(0)
+        self.text = text
+
+
+def test_spot_screen_final_edit_survives_telegram_errors(monkeypatch):
+    from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter
+
+    import screens
+    from rows import Spot
+
+    async def forecast(lat, lon):
+        return f"wind {lat:.0f}"
+
+    monkeypatch.setattr(screens, "get_open_meteo_forecast", forecast)
+    monkeypatch.setattr(screens, "SCREEN_EDIT_INTERVAL", 0)
+    monkeypatch.setattr(
+        screens, "render_card",
+        lambda spot, distance, card, wind, tz: f"{spot.name}: {'⏳' if wind is screens.PENDING else wind}\n"
+    )
+    message = FakeScreenMessage([
+        TelegramRetryAfter(method=None, message="flood", retry_after=0),
+        TelegramNetworkError(method=None, message="timeout"),
+    ])
+    entries = [(Spot(1, "A", 10.0, 20.0), 1.0, None), (Spot(2, "B", 30.0, 40.0), 2.0, None)]
+
+    async def scenario():
+        sent = await screens.render_spots(message, "Споты\n", entries, None)
+        assert sent.markup is None and "⏳" in sent.text
+        await asyncio.gather(*screens._background)
+
+    asyncio.run(scenario())
+    assert message.text == "Споты\nA: wind 10\nB: wind 30\n"
+    assert message.edits >= 3
+
+
+def test_main_menu_cache_follows_checkin_events(workdir, monkeypatch):
+    import database
+    import keyboards
+
+    monkeypatch.setattr(keyboards, "_menu_states", keyboards.OrderedDict())
+    monkeypatch.setattr(keyboards, "_catalog_non_empty", None)
+    reads = []
+
+    async def get_active_checkin(user_id):
+        reads.append(user_id)
+        return await database.get_active_checkin(user_id)
+
+    monkeypatch.setattr(keyboards, "get_active_checkin", get_active_checkin)
+
+    def callbacks(markup):
+        return [row[0].callback_data for row in markup.inline_keyboard]
+
+    async def scenario():
+        await database.init_db()
+        await database.add_or_update_user(USER.id, USER.first_name)
+        assert callbacks(await keyboards.get_main_keyboard(USER.id)) == ["checkin", "profile"]
+        # Новый спот сбрасывает признак каталога, состояние пользователя берётся из кеша
+        spot_id = await database.add_spot("S", 55.0, 37.0, USER.id)
+        assert "nearby_spots" in callbacks(await keyboards.get_main_keyboard(USER.id))
+        assert reads == [USER.id]
+
+        # Чек-ин этого процесса сбрасывает состояние пользователя через шину
+        await database.checkin_user(USER.id, spot_id, 2, arrival_time=int(time.time()) + 3600)
+        first = await keyboards.get_main_keyboard(USER.id)
+        assert "confirm_arrival" in callbacks(first)
+        # Та же клавиатура из кеша без чтения БД
+        assert await keyboards.get_main_keyboard(USER.id) is first
+        assert reads == [USER.id, USER.id]
+
+    asyncio.run(scenario())
@@ -0,0 +1,119 @@
+import asyncio
+import hashlib
+import threading
+import time
+
+from services import offload
+from services.loop_monitor import LoopMonitor
+
+
+def block_loop(seconds):
+    time.sleep(seconds)
+
+
+def test_loop_monitor_reports_blocking_call_stack():
+    monitor = LoopMonitor(interval=0.01, stall_threshold=0.05)
+
+    async def scenario():
+        monitor.start()
+        await asyncio.sleep(0.05)
+        # Блокирующий вызов в цикле событий: сторожевой поток снимает его стек
+        block_loop(0.3)
+        await asyncio.sleep(0.05)
+        monitor.stop()
+
+    asyncio.run(scenario())
+    # Одно зависание — одна запись; на загруженной машине могут добавиться короткие
+    stalls = [(blocked_for, stack) for _, blocked_for, stack in monitor.recent_stalls if "block_loop" in stack]
+    assert len(stalls) == 1
+    assert stalls[0][0] >= 0.05
+
+
+def test_offload_runs_blocking_work_off_the_loop(tmp_path):
+    ticks = []
+
+    def blocking():
+        time.sleep(0.2)
+        return threading.current_thread().name
+
+    async def scenario():
+        async def tick():
+            while True:
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.01)
+
+        ticker = asyncio.create_task(tick())
+        thread_name = await offload.run_blocking(blocking)
+        ticker.cancel()
+        # sum считается в процессе пула: аргументы и результат передаются pickle
+        total = await offload.run_cpu(sum, range(1000))
+        path = tmp_path / "blob"
+        path.write_bytes(b"x" * 3_000_000)
+        digest = await offload.hash_file(str(path))
+        return thread_name, total, digest
+
+    try:
+        thread_name, total, digest = asyncio.run(scenario())
+    finally:
+        offload.shutdown()
+    assert thread_name.startswith("offload")
+    # Пока поток спал, цикл событий продолжал работать
+    assert len(ticks) > 10
+    assert total == sum(range(1000))
+    assert digest == hashlib.sha256(b"x" * 3_000_000).hexdigest()
+
+
+def test_event_bus_delivers_to_sync_and_async_subscribers():
+    from services.events import EventBus, CheckinEvent, CheckinCreated, Left, SpotChanged
+
+    bus = EventBus(queue_size=2)
+    seen, delivered = [], []
+
+    def broken(event):
+        raise RuntimeError("boom")
+
+    async def slow(event):
+        await asyncio.sleep(0.01)
+        delivered.append(event)
+
+    bus.subscribe(CheckinEvent, broken)
+    bus.subscribe((CheckinEvent, SpotChanged), seen.append)
+    bus.subscribe_async(Left, slow)
+
+    async def scenario():
+        bus.publish(CheckinCreated(1, 42, 7, 2, 100))
+        # Синхронный подписчик уже вызван, несмотря на ошибку соседнего
+        assert len(seen) == 1
+        for checkin_id in (2, 3, 4):
+            bus.publish(Left(checkin_id, 42, 7))
+        bus.publish(SpotChanged(7))
+        await bus.join()
+
+    asyncio.run(scenario())
+    assert [type(event).__name__ for event in seen] == ["CheckinCreated", "Left", "Left", "Left", "SpotChanged"]
+    # Очередь асинхронного подписчика ограничена: лишнее событие отброшено
+    assert [event.checkin_id for event in delivered] == [2, 3]
+
+
+def test_checkin_lifecycle_publishes_typed_events(workdir, monkeypatch):
+    import database
+    from services.events import bus, CheckinEvent
+
+    events = []
+    monkeypatch.setattr(bus, "_sync", bus._sync + [((CheckinEvent,), events.append)])
+
+    async def scenario():
+        await database.init_db()
+        await database.add_or_update_user(1, "Ann")
+        spot_id = await database.add_spot("S", 55.0, 37.0, 1)
+        checkin_id = await database.checkin_user(1, spot_id, 1)
+        await database.activate_checkin(checkin_id, 1.5)
+        await database.checkout_user(checkin_id)
+        # Повторный выход ничего не меняет и не публикует
+        await database.checkout_user(checkin_id)
+        return checkin_id, spot_id
+
+    checkin_id, spot_id = asyncio.run(scenario())
+    assert [type(event).__name__ for event in events] == ["CheckinCreated", "Arrived", "Left"]
+    assert all((event.checkin_id, event.user_id, event.spot_id) == (checkin_id, 1, spot_id) for event in events)
+    assert events[1].duration_hours == 1.5
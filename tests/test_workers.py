@@ -0,0 +1,107 @@
+import asyncio
+import multiprocessing
+import os
+import runpy
+import time
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from workers import Supervisor, worker_main, shard_for
+
+BOT_PY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src", "bot.py")
+
+
+class FakeQueue:
+    """Очередь воркера без супервизора: отдаёт заранее заданные обновления."""
+
+    def __init__(self, updates):
+        self.updates = list(updates)
+
+    def get(self):
+        return self.updates.pop(0)
+
+
+def run_worker_under_bot(index, queue):
+    """Как при запуске python src/bot.py: spawn сначала выполняет bot.py как __mp_main__."""
+    runpy.run_path(BOT_PY, run_name="__mp_main__")
+    worker_main(index, queue)
+
+
+def test_worker_starts_and_stops(workdir):
+    # Обновление без обработчиков: воркер должен его принять и завершиться по None
+    update = {
+        "update_id": 1,
+        "edited_message": {
+            "message_id": 1, "date": 0, "text": "hi",
+            "chat": {"id": 42, "type": "private"},
+            "from": {"id": 42, "is_bot": False, "first_name": "Test"},
+        },
+    }
+    ctx = multiprocessing.get_context("spawn")
+    process = ctx.Process(target=run_worker_under_bot, args=(0, FakeQueue([update, None])))
+    process.start()
+    process.join(timeout=60)
+    if process.is_alive():
+        process.kill()
+    assert process.exitcode == 0
+
+
+class ExitingProcess:
+    """Процесс воркера, который завершается через delay секунд (или никогда при None)."""
+
+    def __init__(self, delay):
+        self.exits_at = None if delay is None else time.monotonic() + delay
+        self.terminated = False
+
+    def is_alive(self):
+        return not self.terminated and (self.exits_at is None or time.monotonic() < self.exits_at)
+
+    def terminate(self):
+        self.terminated = True
+
+
+def test_supervisor_stop_does_not_block_event_loop():
+    supervisor = Supervisor(None, 2, [])
+    supervisor.processes = [ExitingProcess(0.3), ExitingProcess(None)]
+    ticks = []
+
+    async def scenario():
+        async def tick():
+            while True:
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.01)
+
+        ticker = asyncio.create_task(tick())
+        await supervisor.stop(timeout=0.5)
+        ticker.cancel()
+
+    asyncio.run(scenario())
+    # Пока супервизор ждал воркеров, цикл событий обслуживал другие задачи
+    assert len(ticks) > 20
+    assert not supervisor.processes[0].terminated
+    assert supervisor.processes[1].terminated
+
+
+def test_updates_of_one_user_go_to_one_worker():
+    message = {"update_id": 1, "message": {"from": {"id": 42}}}
+    callback = {"update_id": 2, "callback_query": {"from": {"id": 42}}}
+    assert shard_for(message, 4) == shard_for(callback, 4)
+
+
+def test_webhook_checks_secret_and_routes_update():
+    supervisor = Supervisor(None, 2, [])
+    app = web.Application()
+    app.router.add_post("/webhook", supervisor.webhook_handler("s3cret"))
+    update = {"update_id": 7, "message": {"from": {"id": 42}, "text": "hi"}}
+
+    async def scenario():
+        async with TestClient(TestServer(app)) as client:
+            rejected = await client.post("/webhook", json=update, headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+            accepted = await client.post("/webhook", json=update, headers={"X-Telegram-Bot-Api-Secret-Token": "s3cret"})
+            return rejected.status, accepted.status
+
+    assert asyncio.run(scenario()) == (401, 200)
+    # Принятое обновление — в очереди воркера пользователя, отклонённое никуда не попало
+    assert supervisor.queues[shard_for(update, 2)].get(timeout=5) == update
+    assert all(queue.empty() for queue in supervisor.queues)